@@ -0,0 +1,80 @@
+"""
+Measures simulation step time and collision checking cost as the number of cars grows.
+
+   python3 benchmarks/collision_benchmark.py --cars 10 25 50
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+from six import iteritems
+
+import fluids
+from fluids.assets import Car
+
+
+def brute_force_collision(state, obj):
+    # Reference implementation that tests obj against every object in the scene
+    for ctype in obj.collideables:
+        for k, other in iteritems(state.type_map.get(ctype, {})):
+            if obj.collides(other):
+                return True
+    return False
+
+
+def run(layout, n_cars, n_steps, seed):
+    np.random.seed(seed)
+    random.seed(seed)
+    simulator = fluids.FluidSim(visualization_level=0,
+                                fps=0,
+                                obs_space=fluids.OBS_NONE,
+                                background_control=fluids.BACKGROUND_CSP)
+    state = fluids.State(layout=layout,
+                         background_cars=n_cars,
+                         controlled_cars=1,
+                         background_peds=10,
+                         vis_level=0)
+    simulator.set_state(state)
+    car_keys = simulator.get_control_keys()
+    cars = list(state.type_map[Car].values())
+
+    step_time = indexed_time = brute_time = 0
+    for i in range(n_steps):
+        actions = {k: fluids.VelocityAction(1) for k in car_keys}
+        start = time.time()
+        simulator.step(actions)
+        step_time += time.time() - start
+
+        start = time.time()
+        indexed = [state.is_in_collision(car) for car in cars]
+        indexed_time += time.time() - start
+
+        start = time.time()
+        brute = [brute_force_collision(state, car) for car in cars]
+        brute_time += time.time() - start
+        assert(indexed == brute)
+
+    return step_time / n_steps, indexed_time / n_steps, brute_time / n_steps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FLUIDS collision checking benchmark")
+    parser.add_argument("--state", type=str, default=fluids.STATE_BIG_CITY,
+                        help="Layout file for state generation")
+    parser.add_argument("--cars", type=int, nargs="+", default=[10, 25, 50],
+                        help="Background car counts to benchmark")
+    parser.add_argument("--steps", type=int, default=50,
+                        help="Number of steps to simulate per car count")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print("{:>6} {:>12} {:>18} {:>18}".format("cars", "step (ms)",
+                                              "all cars idx (ms)",
+                                              "all cars brute (ms)"))
+    for n_cars in args.cars:
+        step_t, idx_t, brute_t = run(args.state, n_cars, args.steps, args.seed)
+        print("{:>6} {:>12.2f} {:>18.2f} {:>18.2f}".format(n_cars,
+                                                            step_t * 1000,
+                                                            idx_t * 1000,
+                                                            brute_t * 1000))
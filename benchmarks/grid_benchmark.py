@@ -0,0 +1,61 @@
+"""
+Measures the cost per car of grid observations when every car draws its own
+dynamic objects, against cropping them from the shared DynamicMap. The shared
+map is drawn again on every step, and its cost is spread over the observers.
+
+   python3 benchmarks/grid_benchmark.py --cars 10 40 --shapes 50 200
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+import fluids
+from fluids.assets import Car
+from fluids.obs.grid import GridObservation
+
+
+def run(state, cars, shape, shared, n_steps):
+    start = time.time()
+    for i in range(n_steps):
+        state.time += 1
+        for car in cars:
+            GridObservation(car, obs_dim=500, shape=(shape, shape), dtype=bool,
+                            shared=shared).get_array()
+    return (time.time() - start) / (n_steps * len(cars))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FLUIDS shared grid observation benchmark")
+    parser.add_argument("--state", type=str, default=fluids.STATE_CITY,
+                        help="Layout file for state generation")
+    parser.add_argument("--cars", type=int, nargs="+", default=[10, 40],
+                        help="Numbers of observing cars to benchmark")
+    parser.add_argument("--shapes", type=int, nargs="+", default=[50, 200],
+                        help="Grid resolutions to benchmark")
+    parser.add_argument("--peds", type=int, default=20,
+                        help="Number of pedestrians")
+    parser.add_argument("--steps", type=int, default=10,
+                        help="Number of steps every car observes")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="Number of times both modes run in turn. The best time is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print("{:>6} {:>8} {:>12} {:>12}".format("cars", "shape", "drawn (ms)", "shared (ms)"))
+    for n_cars in args.cars:
+        np.random.seed(args.seed)
+        random.seed(args.seed)
+        state = fluids.State(layout=args.state,
+                             background_cars=n_cars,
+                             background_peds=args.peds,
+                             vis_level=0)
+        cars = list(state.type_map[Car].values())
+        for shape in args.shapes:
+            drawn = shared = np.inf
+            for i in range(args.rounds):
+                drawn = min(drawn, run(state, cars, shape, False, args.steps))
+                shared = min(shared, run(state, cars, shape, True, args.steps))
+            print("{:>6} {:>8} {:>12.3f} {:>12.3f}".format(n_cars, shape,
+                                                          drawn * 1000, shared * 1000))
@@ -0,0 +1,80 @@
+"""
+Measures the cost of casting lidar beams against the static layout as the
+detection range grows, against testing every beam with every static edge.
+
+   python3 benchmarks/lidar_benchmark.py --beams 8 64 360 --ranges 50 200 1000 5000
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+import fluids
+from fluids.assets import Car
+from fluids.utils import ray_segment_distances
+
+
+def brute_force_cast(segments, x, y, angles, max_dist, allowed):
+    # Reference implementation that tests every beam against every static edge
+    hits = ray_segment_distances(x, y, angles, max_dist, segments.starts, segments.ends)
+    hits = np.where(allowed[0, segments.labels[segments.owner]], hits, np.inf)
+    return hits.min(axis=1)
+
+
+def run(state, cars, n_beams, det_range, n_repeats):
+    segments = state.static_segments
+    allowed = np.array([[type(obj) in cars[0].collideables and cars[0].can_collide(obj)
+                         for obj in state.static_segment_groups]])
+    angles = np.linspace(-1, 1, n_beams + 1) * np.pi
+
+    cast_time = brute_time = 0
+    for i in range(n_repeats):
+        for car in cars:
+            beams = (car.angle + angles) % (2 * np.pi)
+            start = time.time()
+            cast = segments.cast(car.x, car.y, beams, det_range, allowed)[:, 0]
+            cast_time += time.time() - start
+
+            start = time.time()
+            brute = brute_force_cast(segments, car.x, car.y, beams, det_range, allowed)
+            brute_time += time.time() - start
+            # Rays that start inside a polygon hit it at 0, which only cast reports
+            outside = cast > 0
+            assert(np.allclose(np.minimum(cast, det_range)[outside],
+                               np.minimum(brute, det_range)[outside]))
+
+    n_casts = n_repeats * len(cars)
+    return cast_time / n_casts, brute_time / n_casts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FLUIDS lidar casting benchmark")
+    parser.add_argument("--state", type=str, default=fluids.STATE_BIG_CITY,
+                        help="Layout file for state generation")
+    parser.add_argument("--beams", type=int, nargs="+", default=[8, 64, 360],
+                        help="Beam counts to benchmark")
+    parser.add_argument("--ranges", type=float, nargs="+",
+                        default=[50, 100, 200, 500, 1000, 2000, 5000],
+                        help="Detection ranges to benchmark")
+    parser.add_argument("--cars", type=int, default=16,
+                        help="Number of cars to cast from")
+    parser.add_argument("--repeats", type=int, default=10,
+                        help="Number of casts per car")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    random.seed(args.seed)
+    state = fluids.State(layout=args.state,
+                         background_cars=args.cars,
+                         vis_level=0)
+    cars = list(state.type_map[Car].values())
+
+    print("{:>6} {:>8} {:>12} {:>12}".format("beams", "range", "cast (ms)", "brute (ms)"))
+    for n_beams in args.beams:
+        for det_range in args.ranges:
+            cast_t, brute_t = run(state, cars, n_beams, det_range, args.repeats)
+            print("{:>6} {:>8.0f} {:>12.3f} {:>12.3f}".format(n_beams, det_range,
+                                                             cast_t * 1000,
+                                                             brute_t * 1000))
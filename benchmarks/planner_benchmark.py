@@ -0,0 +1,85 @@
+"""
+Compares the background planners on planning time, traffic throughput,
+collisions and deadlocks as the number of cars grows.
+
+   python3 benchmarks/planner_benchmark.py --cars 10 25 50
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+import fluids
+
+
+PLANNERS = {"csp"      : fluids.BACKGROUND_CSP,
+            "priority" : fluids.BACKGROUND_PRIORITY}
+
+
+def run(layout, planner, n_cars, n_steps, seed):
+    np.random.seed(seed)
+    random.seed(seed)
+    simulator = fluids.FluidSim(visualization_level=0,
+                                fps=0,
+                                obs_space=fluids.OBS_NONE,
+                                background_control=planner,
+                                integrator=fluids.INTEGRATOR_BATCH)
+    state = fluids.State(layout=layout,
+                         background_cars=n_cars,
+                         controlled_cars=1,
+                         background_peds=10,
+                         vis_level=0)
+    simulator.set_state(state)
+    car_keys = simulator.get_control_keys()
+    cars = list(state.background_cars.values())
+
+    plan = simulator.multiagent_plan
+    plan_time = [0]
+    def timed_plan():
+        start = time.time()
+        plan()
+        plan_time[0] += time.time() - start
+    simulator.multiagent_plan = timed_plan
+
+    step_time = distance = collisions = deadlocked = 0
+    for i in range(n_steps):
+        before = np.array([(car.x, car.y) for car in cars])
+        start = time.time()
+        simulator.step({k: fluids.VelocityAction(1) for k in car_keys})
+        step_time += time.time() - start
+        after = np.array([(car.x, car.y) for car in cars])
+        distance += np.linalg.norm(after - before, axis=1).sum()
+        collisions += sum(state.is_in_collision(car) for car in cars)
+        deadlocked += simulator.in_deadlock()
+
+    n_car_steps = float(n_steps * len(cars))
+    return {"plan"      : plan_time[0] / n_steps * 1000,
+            "step"      : step_time / n_steps * 1000,
+            "speed"     : distance / n_car_steps,
+            "collision" : collisions / n_car_steps,
+            "deadlock"  : deadlocked}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FLUIDS background planner benchmark")
+    parser.add_argument("--state", type=str, default=fluids.STATE_BIG_CITY,
+                        help="Layout file for state generation")
+    parser.add_argument("--cars", type=int, nargs="+", default=[10, 25, 50],
+                        help="Background car counts to benchmark")
+    parser.add_argument("--planners", type=str, nargs="+", default=sorted(PLANNERS),
+                        choices=sorted(PLANNERS), help="Background planners to compare")
+    parser.add_argument("--steps", type=int, default=200,
+                        help="Number of steps to simulate per run")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print("{:>6} {:>9} {:>10} {:>10} {:>12} {:>15} {:>15}".format(
+        "cars", "planner", "plan (ms)", "step (ms)", "speed (px)",
+        "collision rate", "deadlock steps"))
+    for n_cars in args.cars:
+        for name in args.planners:
+            r = run(args.state, PLANNERS[name], n_cars, args.steps, args.seed)
+            print("{:>6} {:>9} {:>10.2f} {:>10.2f} {:>12.2f} {:>15.4f} {:>15}".format(
+                n_cars, name, r["plan"], r["step"], r["speed"],
+                r["collision"], r["deadlock"]))
@@ -1,14 +1,38 @@
 import fluids
 from fluids.utils import fluids_print
+from fluids.layout import CompiledLayout
 import argparse
+import os
+import sys
 
 key_help = """
 Keyboard commands for when visualizer is running:
    .            Increases debug visualization
    ,            Decreases debug visualization
    o            Switches observation type
+
+To compile a layout ahead of time, run python -m fluids compile-layout -h
 """
 
+if sys.argv[1:2] == ["compile-layout"]:
+    compile_parser = argparse.ArgumentParser(prog='python -m fluids compile-layout',
+                                             description='Compiles a layout so that states load it without rebuilding its waypoints')
+    compile_parser.add_argument('--state', metavar='file', type=str, default=fluids.STATE_CITY,
+                                help='Layout file to compile')
+    compile_parser.add_argument('--waypoint-width', metavar='N', dest='waypoint_width', type=int, default=5,
+                                help='Width of lane waypoints')
+    compile_parser.add_argument('--out', metavar='file', type=str, default="",
+                                help='Path for the compiled layout, which State accepts as its layout. '
+                                     'Empty string stores it in the layout cache.')
+    args = compile_parser.parse_args(sys.argv[2:])
+    if args.out:
+        with open(os.path.join(os.path.dirname(fluids.__file__), "layouts", args.state + ".json"), "rb") as f:
+            CompiledLayout.compile(f.read(), args.waypoint_width).save(args.out)
+        fluids_print("Compiled layout stored at " + args.out)
+    else:
+        fluids.State(layout=args.state, waypoint_width=args.waypoint_width, vis_level=0)
+    sys.exit(0)
+
 parser = argparse.ArgumentParser(description='FLUIDS First Order Lightweight Urban Intersection Driving Simulator',
                                  formatter_class=argparse.RawDescriptionHelpFormatter,
                                  epilog=key_help)
@@ -10,6 +10,7 @@ from fluids.assets.crosswalk_light import CrossWalkLight
 from fluids.assets.crosswalk import CrossWalk
 from fluids.assets.waypoint import Waypoint
 from fluids.assets.shape import Shape
+from fluids.assets.dynamic_store import DynamicStore, DynamicShape
 
 ALL_OBJS = [Terrain,
             Street,
@@ -6,13 +6,19 @@ import random
 import shapely
 import shapely.ops
 
-from fluids.assets.shape import Shape
+from fluids.assets.dynamic_store import DynamicShape
 from fluids.actions import *
-from fluids.utils import PIDController, fluids_assert
+from fluids.utils import PIDController, fluids_assert, make_capsule, rounded_box_polygon
 from fluids.obs import *
 from fluids.consts import *
 
 
+# Simulated time covered by a single call to Car.step
+STEP_TIME = 1.0
+# A moving car is expected to stay this close to the path to its next waypoints
+FUTURE_RADIUS = 20
+
+
 def integrator(state, t, steer, acc, lr, lf):
     x, y, vel, angle = state
 
@@ -24,6 +30,62 @@ def integrator(state, t, steer, acc, lr, lf):
     return dx, dy, dvel, dangle
 
 
+def batch_integrator(x, y, vel, angle, steer, acc, lr, lf, t=1.0, n_substeps=4):
+    """
+    Advances many cars through the same bicycle model as integrator at once, using
+    fixed step RK4. All arguments are arrays with one entry per car (or scalars).
+    Returns the x, y, vel, angle arrays at time t.
+    """
+    beta = np.arctan(lr / (lf + lr) * np.tan(steer))
+    yaw_rate = np.sin(beta) / lr
+    dt = float(t) / n_substeps
+
+    def derivative(vel, angle):
+        return (vel * np.cos(angle + beta),
+                vel * -np.sin(angle + beta),
+                vel * yaw_rate)
+
+    x, y, vel, angle = [np.array(v, dtype=np.float64) for v in (x, y, vel, angle)]
+    for _ in range(n_substeps):
+        # vel is linear in time, so its midpoint and endpoint values are exact
+        vel_mid = vel + 0.5 * dt * acc
+        vel_end = vel + dt * acc
+        k1x, k1y, k1a = derivative(vel, angle)
+        k2x, k2y, k2a = derivative(vel_mid, angle + 0.5 * dt * k1a)
+        k3x, k3y, k3a = derivative(vel_mid, angle + 0.5 * dt * k2a)
+        k4x, k4y, k4a = derivative(vel_end, angle + dt * k3a)
+        x     = x     + dt / 6.0 * (k1x + 2 * k2x + 2 * k3x + k4x)
+        y     = y     + dt / 6.0 * (k1y + 2 * k2y + 2 * k3y + k4y)
+        angle = angle + dt / 6.0 * (k1a + 2 * k2a + 2 * k3a + k4a)
+        vel   = vel_end
+    return x, y, vel, angle
+
+
+def batch_raw_step(cars, controls):
+    """
+    Equivalent of calling car.raw_step(steer, f_acc) for every car, with the
+    dynamics of all cars integrated in a single vectorized call.
+
+    Parameters
+    ----------
+    cars: list of Car
+    controls: list of (steer, f_acc)
+    """
+    if not len(cars):
+        return
+    store = cars[0].state.dynamic_store
+    rows = store.indices(cars)
+    x, y, angle, vel = store.pose[rows].T
+    steer, acc = np.array([car.get_raw_controls(steer, f_acc)
+                           for car, (steer, f_acc) in zip(cars, controls)]).T
+    lr, lf = np.array([(car.l_r, car.l_f) for car in cars]).T
+    xs, ys, vels, angles = batch_integrator(x, y, vel, angle, steer, acc, lr, lf,
+                                            t=STEP_TIME)
+    store.move(rows, xs, ys, angles, vels)
+    for car in cars:
+        car.running_time += 1
+
+
 DEFAULT_TUNABLE_PARAMETERS = {
     'max_vel': 5,
     'pid_acc_p': 1,
@@ -39,7 +101,7 @@ DEFAULT_TUNABLE_PARAMETERS = {
 #              to the duration of the trip (number of waypoints).
 #              For now, that value is hard-coded to 60.
 # NOTE(Mike) - The max_vel value that is passed in is ignored if tunable parameters are set later.
-class Car(Shape):
+class Car(DynamicShape):
     def __init__(self, vel=0, mass=400, max_vel=5,
                  planning_depth=60, **kwargs):
 
@@ -51,12 +113,12 @@ class Car(Shape):
                         Terrain,
                         Sidewalk,
                         PedCrossing]
-        Shape.__init__(self,
-                       collideables=collideables,
-                       color=(0x1d,0xb1,0xb0),#769BB0
-                       xdim=70,
-                       ydim=35,
-                       **kwargs)
+        DynamicShape.__init__(self,
+                              collideables=collideables,
+                              color=(0x1d,0xb1,0xb0),#769BB0
+                              xdim=70,
+                              ydim=35,
+                              **kwargs)
 
         assert planning_depth == 60
 
@@ -64,8 +126,9 @@ class Car(Shape):
         self.mass           = mass
         self.max_vel        = max_vel
         self.vel            = vel
-        self.waypoints      = []
+        self.route          = []
         self.trajectory     = []
+        self.trajectory_key = None
         self.planning_depth = planning_depth
         self.PID_acc        = PIDController(1, 0, 0)
         self.PID_steer      = PIDController(2, 0, 0)
@@ -75,9 +138,6 @@ class Car(Shape):
         self.last_to_goal   = 0
         self.stopped_time   = 0
         self.running_time   = 0
-
-        self.last_blob_time = -1
-        self.cached_blob    = self.get_future_shape()
         self.first_goal = True
         self.reached_goal = False
 
@@ -102,7 +162,11 @@ class Car(Shape):
             fluids_assert(False, "Observation space not legal")
         return self.last_obs
 
-    def raw_step(self, steer, f_acc):
+    def get_raw_controls(self, steer, f_acc):
+        """
+        Converts normalized steer and acceleration commands into the
+        steering angle and acceleration used by the dynamics model
+        """
         steer = max(min(1, steer), -1)
         f_acc = max(min(1, f_acc), -1)
         steer = np.radians(30 * steer)
@@ -112,15 +176,20 @@ class Car(Shape):
             acc = self.max_vel - self.vel
         elif acc < -self.max_vel - self.vel:
             acc = - self.max_vel - self.vel
+        return steer, acc
+
+    def raw_step(self, steer, f_acc):
+        steer, acc = self.get_raw_controls(steer, f_acc)
 
         ode_state = [self.x, self.y, self.vel, self.angle]
         aux_state = (steer, acc, self.l_r, self.l_f)
 
-        t = np.arange(0.0, 1.5, 0.5)
+        t = np.linspace(0.0, STEP_TIME, 3)
         delta_ode_state = odeint(integrator, ode_state, t, args=aux_state)
         x, y, vel, angle = delta_ode_state[-1]
+        self.apply_dynamics(x, y, vel, angle)
 
-
+    def apply_dynamics(self, x, y, vel, angle):
         self.vel = vel
         self.update_points(x, y, angle)
         #print(self.running_time)
@@ -135,49 +204,55 @@ class Car(Shape):
 
 
     def step(self, action):
+        steer, acc = self.begin_step(action)
+        self.raw_step(steer, acc)
+        self.end_step()
+
+    def begin_step(self, action):
+        """
+        First phase of a step. Records the starting pose and resolves action
+        into the (steer, acc) pair to pass to raw_step.
+        """
+        if type(action) == LastValidAction:
+            action = self.last_action
 
-        distance_to_next = self.dist_to(self.waypoints[0])
-        startx, starty = self.x, self.y
+        self.step_start = (self.dist_to(self.waypoint(0)), self.x, self.y)
 
         if action == None:
-            self.raw_step(0, 0)
-            self.last_action = action
+            steer, acc = 0, 0
         elif type(action) == SteeringAccAction:
-            self.raw_step(*action.get_action())
-            self.last_action = action
+            steer, acc = action.get_action()
         elif type(action) == SteeringAction:
             fluids_assert(False, "Cars cannot receive a raw steering action")
         elif type(action) == VelocityAction:
             steer, acc = self.PIDController(action).get_action()
             #steer += np.random.randn() * 0.5 * steer
             #acc += np.random.randn() * 0.5 * acc / 5
-            self.raw_step(steer, acc)
-            self.last_action = action
         elif type(action) == SteeringVelAction:
             steer, vel = action.get_action()
             _, acc = self.PIDController(VelocityAction(vel)).get_action()
-            self.raw_step(steer, acc)
-            self.last_action = action
-        elif type(action) == LastValidAction:
-            self.step(self.last_action)
-            return
         else:
             fluids_assert(False, "Car received an illegal action")
+        self.last_action = action
+        return steer, acc
+
+    def end_step(self):
+        """
+        Last phase of a step, run after the dynamics have been integrated.
+        Extends the route and advances through reached waypoints.
+        """
+        distance_to_next, startx, starty = self.step_start
 
         # only populate final goal once
         if self.first_goal:
-            while len(self.waypoints) < self.planning_depth and len(self.waypoints) and len(self.waypoints[-1].nxt):
-                next_edge = random.choice(self.waypoints[-1].nxt)
-                next_waypoint = next_edge.out_p
-                line = next_edge.shapely_obj
-                # line = shapely.geometry.LineString([(self.waypoints[-1].x, self.waypoints[-1].y),
-                #                                     (next_waypoint.x, next_waypoint.y)]).buffer(self.ydim*0.5)
-                self.trajectory.append(((self.waypoints[-1].x, self.waypoints[-1].y),
-                                        (next_waypoint.x, next_waypoint.y), line))
-                self.waypoints.append(next_waypoint)
+            graph = self.state.waypoint_graph
+            for e in graph.extend(self.route, self.planning_depth):
+                (x0, y0), (x1, y1) = graph.segment(e)
+                self.trajectory.append(((x0, y0), (x1, y1),
+                                        make_capsule(x0, y0, x1, y1, FUTURE_RADIUS)))
             self.first_goal = False
 
-        self.last_to_goal = distance_to_next - self.dist_to(self.waypoints[0])
+        self.last_to_goal = distance_to_next - self.dist_to(self.waypoint(0))
         self.last_distance = np.linalg.norm([self.x - startx, self.y - starty])
         if self.last_distance == 0:
             self.stopped_time += 1
@@ -185,12 +260,12 @@ class Car(Shape):
             self.stopped_time = 0
 
         # did the car reach it's goal waypoint
-        if self.intersects(self.waypoints[-1]):
+        if self.intersects(self.waypoint(-1)):
             self.reached_goal = True
             return
 
-        if len(self.waypoints) and self.intersects(self.waypoints[0]):
-            self.waypoints.pop(0)
+        if len(self.route) and self.intersects(self.waypoint(0)):
+            self.route.pop(0)
             if len(self.trajectory):
                 self.trajectory.pop(0)
 
@@ -200,11 +275,11 @@ class Car(Shape):
         """
         Returns predicted direction of the car based on waypoints
         """
-        if self.waypoints == []: return
-        future_index = min(len(self.waypoints) - 1, 1)
+        if self.route == []: return
+        future_index = min(len(self.route) - 1, 1)
         start = np.array([self.x , self.y])
-        first = np.array([self.waypoints[0].x, self.waypoints[0].y]) - start
-        future = np.array([self.waypoints[future_index].x, self.waypoints[future_index].y]) - start
+        first = np.array([self.waypoint(0).x, self.waypoint(0).y]) - start
+        future = np.array([self.waypoint(future_index).x, self.waypoint(future_index).y]) - start
         c = np.dot(first, future) / np.linalg.norm(first) / np.linalg.norm(future)
         angle = np.math.atan2(np.linalg.det([first,future]),np.dot(first,future))
         angle = np.degrees(angle)
@@ -222,9 +297,9 @@ class Car(Shape):
     def PIDController(self, target_vel, update=True):
         target_vel = target_vel.get_action() * self.max_vel
 
-        if len(self.waypoints):
-            target_x = self.waypoints[0].x
-            target_y = self.waypoints[0].y
+        if len(self.route):
+            target_x = self.waypoint(0).x
+            target_y = self.waypoint(0).y
         else:
             target_x = self.x
             target_y = self.y
@@ -258,29 +333,36 @@ class Car(Shape):
             return False
         return super(Car, self).can_collide(other)
 
-    def get_future_shape(self):
-        if self.last_blob_time != self.running_time:
-            if len(self.waypoints) and len(self.trajectory):
-
-                line = shapely.geometry.LineString([(self.waypoints[0].x, self.waypoints[0].y),
-                                                    (self.x, self.y)]).buffer(20, resolution=2)
-                buf = [t[2] for t in self.trajectory][:max(int(1+6*self.vel/self.max_vel), 0)]
-                self.cached_blob = shapely.ops.unary_union([line] + buf)
-            else:
-                self.cached_blob = self.shapely_obj
+    def get_future_pieces(self):
+        """
+        Returns the region the car may occupy over the next steps if it keeps
+        moving, as an (n, 9) array of rounded boxes (see make_capsule). This is the
+        path to its next waypoint and the trajectory edges ahead, as many as its
+        velocity allows, or the car itself if it has nowhere to go.
+        """
+        if len(self.route) and len(self.trajectory):
+            head = make_capsule(self.waypoint(0).x, self.waypoint(0).y,
+                                self.x, self.y, FUTURE_RADIUS)
+            n_edges = max(int(1+6*self.vel/self.max_vel), 0)
+            return np.concatenate([[head], self.get_trajectory_pieces(n_edges)])
+        return np.array([self.box + (0,)])
 
-        self.last_blob_time = self.running_time
-        return self.cached_blob
+    def get_future_shape(self):
+        """
+        Returns get_future_pieces as a shapely polygon, for drawing
+        """
+        return shapely.ops.unary_union([rounded_box_polygon(p)
+                                        for p in self.get_future_pieces()])
 
     def render(self, surface, **kwargs):
         super(Car, self).render(surface, **kwargs)
-        if "waypoints" not in self.__dict__:
+        if "route" not in self.__dict__:
             return
-        if len(self.waypoints) and self.vis_level > 1:
+        if len(self.route) and self.vis_level > 1:
             pygame.draw.line(surface,
                              (255, 0, 0),
                              (self.x, self.y),
-                             (self.waypoints[0].x, self.waypoints[0].y),
+                             (self.waypoint(0).x, self.waypoint(0).y),
                              2)
             for line in self.trajectory:
                 pygame.draw.line(surface,
@@ -288,7 +370,7 @@ class Car(Shape):
                                  line[0],
                                  line[1],
                                  2)
-        if len(self.waypoints) and self.vis_level > 4:
+        if len(self.route) and self.vis_level > 4:
             blob = self.get_future_shape()
 
             traj_ob = list(zip(*(blob).exterior.coords.xy))
@@ -298,5 +380,5 @@ class Car(Shape):
                                 traj_ob,
                                 5)
 
-            for wp in self.waypoints[0].owner.waypoints:
+            for wp in self.waypoint(0).owner.waypoints:
                 wp.render_debug(surface, color=(0, 100, 0), width=20)
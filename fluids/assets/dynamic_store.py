@@ -0,0 +1,150 @@
+import numpy as np
+
+from fluids.assets.shape import Shape
+from fluids.utils import batch_make_box, fluids_assert
+
+
+class DynamicShape(Shape):
+    """
+    Shape that moves along a route of the State's WaypointGraph. The route is
+    kept in route, as waypoint numbers of the graph. Once added to the State's
+    DynamicStore, its corner points are a view into the store, and the store
+    keeps a copy of its pose.
+    """
+    store       = None
+    store_index = None
+
+    def update_points(self, x, y, angle):
+        super(DynamicShape, self).update_points(x, y, angle)
+        if self.store is not None:
+            self.store.pose[self.store_index] = (self.x, self.y, self.angle, self.vel)
+
+    @property
+    def waypoints(self):
+        """
+        Waypoints of the route, for code that predates routes of waypoint
+        numbers. Read only, as the route is kept in route.
+        """
+        waypoints = self.state.waypoint_graph.waypoints
+        return [waypoints[i] for i in self.route]
+
+    def waypoint(self, i):
+        """
+        Returns waypoint i of the route
+        """
+        return self.state.waypoint_graph.waypoints[self.route[i]]
+
+    def get_trajectory_pieces(self, n_edges, grow=0):
+        """
+        Returns the rounded boxes of the first n_edges trajectory edges, with
+        their radius grown by grow, as an (n, 9) array. Edge i of the trajectory
+        runs from waypoint i to waypoint i + 1 of the route, so the array is
+        kept until the route advances or n_edges changes.
+        """
+        key = (tuple(self.route[:n_edges + 1]), grow)
+        if self.trajectory_key != key:
+            pieces = np.array([t[2] for t in self.trajectory[:n_edges]],
+                              dtype=np.float64).reshape(-1, 9)
+            pieces[:, 8] += grow
+            self.trajectory_key, self.trajectory_pieces = key, pieces
+        return self.trajectory_pieces
+
+
+class DynamicStore(object):
+    """
+    Struct-of-arrays storage for every DynamicShape in a State.
+
+    Each object owns one row of every array. pose holds x, y, angle and vel,
+    origin the corners of the object around its center, and points its corners
+    in the world. The points attribute of every stored object is a view of its
+    row, so Shape.update_points writes straight into the store.
+
+    Parameters
+    ----------
+    capacity: int
+        Number of rows to preallocate. Arrays grow as objects are added.
+    """
+    X, Y, ANGLE, VEL = range(4)
+
+    def __init__(self, capacity=64):
+        self.size    = 0
+        self.keys    = []
+        self.objects = []
+        self.pose    = np.zeros((capacity, 4))
+        self.dims    = np.zeros((capacity, 2))
+        self.origin  = np.zeros((capacity, 4, 2))
+        self.points  = np.zeros((capacity, 4, 2))
+
+    def __len__(self):
+        return self.size
+
+    def add(self, key, obj):
+        """
+        Copies obj's pose and corners into the next free row, makes obj.points
+        a view of that row and returns its index
+        """
+        fluids_assert(np.shape(obj.points) == (4, 2),
+                      "DynamicStore only holds rectangles, got points of shape {}"
+                      .format(np.shape(obj.points)))
+        if self.size == len(self.pose):
+            self.pose, self.dims, self.origin, self.points = \
+                [np.concatenate([arr, np.zeros_like(arr)])
+                 for arr in (self.pose, self.dims, self.origin, self.points)]
+            for i, o in enumerate(self.objects):
+                o.points = self.points[i]
+        index = self.size
+        self.pose[index]   = (obj.x, obj.y, obj.angle, obj.vel)
+        self.dims[index]   = (obj.xdim, obj.ydim)
+        self.origin[index] = obj.origin_points
+        self.points[index] = obj.points
+        obj.points = self.points[index]
+        obj.store, obj.store_index = self, index
+        self.keys.append(key)
+        self.objects.append(obj)
+        self.size += 1
+        return index
+
+    def indices(self, objs):
+        """
+        Returns the row index of each object in objs
+        """
+        return np.array([obj.store_index for obj in objs], dtype=np.int64)
+
+    def move(self, rows, x, y, angle, vel):
+        """
+        Vectorized Shape.update_points for the objects in rows, which also sets
+        their velocities. Corners are rotated for every row at once, and only
+        the scalar attributes are then set one object at a time.
+        """
+        old = self.pose[rows, self.ANGLE]
+        min_delta = np.minimum(np.abs(angle - (old - 2 * np.pi)), np.abs(angle - old))
+        dangle = (angle - old + 6 * np.pi) % (2 * np.pi)
+        angle = angle % (2 * np.pi)
+        self.pose[rows] = np.stack([x, y, angle, vel], axis=1)
+
+        c, s = np.cos(angle)[:, None], np.sin(angle)[:, None]
+        ox, oy = self.origin[rows, :, 0], self.origin[rows, :, 1]
+        points = np.stack([ox * c + oy * s + x[:, None],
+                           oy * c - ox * s + y[:, None]], axis=2)
+        self.points[rows] = points
+        lo, hi = points.min(axis=1), points.max(axis=1)
+        boxes = batch_make_box(x, y, angle, self.dims[rows, 0], self.dims[rows, 1])
+
+        for i, obj in enumerate([self.objects[r] for r in rows]):
+            obj.x, obj.y, obj.angle, obj.vel = x[i], y[i], angle[i], vel[i]
+            obj.dangle = dangle[i]
+            if min_delta[i] > 0.07:
+                obj.large_corrections += 1.0
+            obj.minx, obj.miny = lo[i]
+            obj.maxx, obj.maxy = hi[i]
+            obj._shapely_obj = None
+            if obj.box is not None:
+                obj.box = tuple(boxes[i].tolist())
+
+    def bounds(self):
+        """
+        Returns an (n, 4) array of (minx, miny, maxx, maxy) for all stored
+        objects, computed from their corners
+        """
+        points = self.points[:self.size]
+        return np.concatenate([points.min(axis=1), points.max(axis=1)], axis=1)
@@ -5,9 +5,10 @@ from fluids.assets.shape import Shape
 from fluids.assets.waypoint import Waypoint
 
 class Lane(Shape):
+    COLOR = (0xff, 0xff, 0xff)
     def __init__(self, start_wp=None, end_wp=None, wp_width=5, **kwargs):
         #FCF59B
-        Shape.__init__(self, color=(0xff, 0xff, 0xff), **kwargs)
+        Shape.__init__(self, color=self.COLOR, **kwargs)
 
         if start_wp is not None and end_wp is not None:
             self.start_waypoint = start_wp
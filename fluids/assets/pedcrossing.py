@@ -1,7 +1,8 @@
 from fluids.assets.shape import Shape
 
 class PedCrossing(Shape):
+    COLOR = (0xf7, 0xf7, 0xf7)
     def __init__(self, **kwargs):
-        Shape.__init__(self, color=(0xf7, 0xf7, 0xf7), **kwargs)
+        Shape.__init__(self, color=self.COLOR, **kwargs)
         self.in_waypoints = []
         self.out_waypoints = []
@@ -1,47 +1,65 @@
 import random
 import numpy as np
 import shapely
+import shapely.ops
 import pygame
-from fluids.assets.shape import Shape
+from fluids.assets.dynamic_store import DynamicShape
 from fluids.assets.car import Car
 from fluids.assets.crosswalk_light import CrossWalkLight
-class Pedestrian(Shape):
+from fluids.utils import make_capsule, rounded_box_polygon
+class Pedestrian(DynamicShape):
     collideables = [Car, CrossWalkLight]
+    COLOR = (0xf4, 0x80, 0x04)
     def __init__(self, max_vel=2, vel=0, planning_depth=2, dim=25, **kwargs):
-        Shape.__init__(self, color=(0xF4,0x80,0x04), xdim=dim, ydim=dim, **kwargs)
+        DynamicShape.__init__(self, color=self.COLOR, xdim=dim, ydim=dim, **kwargs)
         self.max_vel        = max_vel
         self.vel            = vel
-        self.waypoints      = []
+        self.route          = []
         self.trajectory     = []
+        self.trajectory_key = None
         self.planning_depth = planning_depth
+        self.stopped_time   = 0
+
+    def get_future_pieces(self):
+        """
+        Returns the region the pedestrian may occupy over the next steps, with
+        some room around it, as an (n, 9) array of rounded boxes (see make_capsule)
+        """
+        if len(self.route) and len(self.trajectory):
+            r = self.ydim*0.2
+            head = [self.box + (r,),
+                    make_capsule(self.waypoint(0).x, self.waypoint(0).y,
+                                 self.x, self.y, self.ydim*0.5 + r)]
+            return np.concatenate([head, self.get_trajectory_pieces(int(self.vel), r)])
+        return np.array([self.box + (self.ydim*0.3,)])
 
     def get_future_shape(self):
-        if len(self.waypoints) and len(self.trajectory):
-            line = shapely.geometry.LineString([(self.waypoints[0].x, self.waypoints[0].y),
-                                                (self.x, self.y)]).buffer(self.ydim * 0.5, resolution=2)
-            return shapely.geometry.MultiPolygon([t[2] for t in self.trajectory[:int(self.vel)]]
-                                                 + [self.shapely_obj, line]).buffer(self.ydim*0.2, resolution=2)
-        else:
-            return self.shapely_obj.buffer(self.ydim*0.3, resolution=2)
+        """
+        Returns get_future_pieces as a shapely polygon, for drawing
+        """
+        return shapely.ops.unary_union([rounded_box_polygon(p)
+                                        for p in self.get_future_pieces()])
+
     def step(self, action):
-        if len(self.waypoints) and action:
+        if len(self.route) and action:
             x0, y0 = self.x, self.y
-            x1, y1 = self.waypoints[0].x, self.waypoints[0].y
+            x1, y1 = self.waypoint(0).x, self.waypoint(0).y
             angle = np.arctan2([y0-y1], [x1-x0])[0]
             x = self.x + 1 * np.cos(angle)
             y = self.y - 1 * np.sin(angle)
             angle = angle
             self.update_points(x, y, angle)
-        while len(self.waypoints) < self.planning_depth and len(self.waypoints) and len(self.waypoints[-1].nxt):
-            next_waypoint = random.choice(self.waypoints[-1].nxt).out_p
-            line = shapely.geometry.LineString([(self.waypoints[-1].x, self.waypoints[-1].y),
-                                                (next_waypoint.x, next_waypoint.y)]).buffer(self.ydim*0.5)
-            self.trajectory.append(((self.waypoints[-1].x, self.waypoints[-1].y),
-                                    (next_waypoint.x, next_waypoint.y), line))
-            self.waypoints.append(next_waypoint)
-            
-        if len(self.waypoints) and self.intersects(self.waypoints[0]):
-            self.waypoints.pop(0)
+            self.stopped_time = 0
+        else:
+            self.stopped_time += 1
+        graph = self.state.waypoint_graph
+        for e in graph.extend(self.route, self.planning_depth):
+            (x0, y0), (x1, y1) = graph.segment(e)
+            self.trajectory.append(((x0, y0), (x1, y1),
+                                    make_capsule(x0, y0, x1, y1, self.ydim*0.5)))
+
+        if len(self.route) and self.intersects(self.waypoint(0)):
+            self.route.pop(0)
             if len(self.trajectory):
                 self.trajectory.pop(0)
 
@@ -51,17 +69,17 @@ class Pedestrian(Shape):
             if other.color == (200, 0, 0):
                 return super(Pedestrian, self).can_collide(other)
             return False
-        return super(Pedestrian, self.can_collide(other))
+        return super(Pedestrian, self).can_collide(other)
 
     def render(self, surface, **kwargs):
         super(Pedestrian, self).render(surface, **kwargs)
-        if "waypoints" not in self.__dict__:
+        if "route" not in self.__dict__:
             return
-        if len(self.waypoints) and self.vis_level > 1:
+        if len(self.route) and self.vis_level > 1:
             pygame.draw.line(surface,
                              (255, 0, 0),
                              (self.x, self.y),
-                             (self.waypoints[0].x, self.waypoints[0].y),
+                             (self.waypoint(0).x, self.waypoint(0).y),
                              2)
             for line in self.trajectory:
                 pygame.draw.line(surface,
@@ -69,7 +87,7 @@ class Pedestrian(Shape):
                                  line[0],
                                  line[1],
                                  2)
-        if len(self.waypoints) and self.vis_level > 2:
+        if len(self.route) and self.vis_level > 2:
             blob = self.get_future_shape()
 
             traj_ob = list(zip(*(blob).exterior.coords.xy))
@@ -2,7 +2,10 @@ import numpy as np
 import pygame
 import shapely.geometry
 
-from fluids.utils import rotation_array
+from fluids.utils import rotation_array, make_box, boxes_intersect
+
+# Corners of a rectangle, as multiples of its half dimensions
+CORNER_SIGNS = np.array([[1, 1], [1, -1], [-1, -1], [-1, 1]])
 
 class Shape(object):
     def __init__(self, x=0, y=0,
@@ -23,9 +26,7 @@ class Shape(object):
         if not len(points):
             corner_offsets = np.array([xdim / 2.0, ydim / 2.0])
             centers = np.array([x, y])
-            signs = np.array([[1,1], [1,-1], [-1,-1], [-1,1]])
-            corner_offsets = signs * corner_offsets
-            rotation_mat = rotation_array(angle)
+            corner_offsets = CORNER_SIGNS * corner_offsets
             self.x, self.y = x, y
             self.origin_points = corner_offsets
         else:
@@ -36,14 +37,16 @@ class Shape(object):
         self.points = self.origin_points.dot(rotation_array(angle)) + np.array([self.x,
                                                                                 self.y])
 
-        xs, ys = zip(*self.points)
-        self.minx, self.maxx = min(xs), max(xs)
-        self.miny, self.maxy = min(ys), max(ys)
+        self.minx, self.miny = self.points.min(axis=0)
+        self.maxx, self.maxy = self.points.max(axis=0)
         centers = np.array([self.x, self.y])
-        self.radius = max(np.linalg.norm([p -  centers for p in self.points], axis=1))
+        self.radius = np.sqrt(((self.points - centers) ** 2).sum(axis=1)).max()
 
         self.xdim          = xdim
         self.ydim          = ydim
+        # Oriented box used for fast rectangle-rectangle tests. None for general polygons
+        self.box           = make_box(self.x, self.y, angle, xdim, ydim) \
+                             if not len(points) and xdim > 0 and ydim > 0 else None
 
         self.angle         = angle
         self.dangle        = 0.0
@@ -51,12 +54,31 @@ class Shape(object):
         self.mass          = mass
         self.vis_level     = vis_level
         self.collideables  = collideables
-        self.shapely_obj   = shapely.geometry.Polygon(self.points)
+        self._shapely_obj  = None
         self.color         = color
         self.border_color  = border_color
         self.state         = state
-        self.waypoints     = [] if not waypoints else waypoints
+        # Moving shapes read their waypoints from their route instead
+        if not isinstance(getattr(self.__class__, "waypoints", None), property):
+            self.waypoints = [] if not waypoints else waypoints
+
+    @property
+    def shapely_obj(self):
+        """
+        Exact polygon of the shape, built from points the first time it is needed
+        after the shape moves
+        """
+        if self._shapely_obj is None:
+            self._shapely_obj = shapely.geometry.Polygon(self.points)
+        return self._shapely_obj
+
+    @shapely_obj.setter
+    def shapely_obj(self, value):
+        self._shapely_obj = value
+
     def intersects(self, other):
+        if self.box is not None and other.box is not None:
+            return boxes_intersect(self.box, other.box)
         return self.shapely_obj.intersects(other.shapely_obj)
 
     def get_relative(self, other, offset=(0,0)):
@@ -110,32 +132,21 @@ class Shape(object):
         pass
 
     def update_points(self, x, y, angle):
-        dx = self.x - x
-        dy = self.y - y
         min_delta = min(np.abs(angle - (self.angle-2*np.pi)), np.abs(angle - self.angle))
-        dangle = (angle - self.angle + 6 * np.pi) % (2 * np.pi)
+        self.dangle = (angle - self.angle + 6 * np.pi) % (2 * np.pi)
+        if min_delta > 0.07:
+            self.large_corrections += 1.0
         self.x = x
         self.y = y
         self.angle = angle % (2 * np.pi)
-        # origin = np.array([self.x, self.y])
-        # self.points = self.origin_points.dot(rotation_array(self.angle)) + origin
-        # xs, ys = self.points[:,0], self.points[:,1]
-
-        self.shapely_obj = shapely.affinity.translate(self.shapely_obj,
-                                                      -dx, -dy)
-        self.dangle = dangle
-        #min_delta = min(np.abs(angle - (self.angle-2*np.pi)), np.abs(angle - self.angle))
-        #print(min_delta)
-        if min_delta > 0.07:
-            self.large_corrections += 1.0
-        self.shapely_obj = shapely.affinity.rotate(self.shapely_obj,
-                                                   -dangle,
-                                                   (self.x, self.y),
-                                                   use_radians=True)
-        self.points = np.array(self.shapely_obj.exterior.coords)
-        xs, ys = self.points[:,0], self.points[:,1]
-        self.minx, self.maxx = min(xs), max(xs)
-        self.miny, self.maxy = min(ys), max(ys)
-
-        #self.shapely_obj = shapely.geometry.Polygon(self.points)
-        
+
+        # Rotate the corners straight into the existing points array. The shapely
+        #  polygon is only rebuilt when something asks for it
+        points = self.points
+        np.dot(self.origin_points, rotation_array(self.angle), out=points)
+        points += (x, y)
+        self.minx, self.miny = points.min(axis=0)
+        self.maxx, self.maxy = points.max(axis=0)
+        self._shapely_obj = None
+        if self.box is not None:
+            self.box = make_box(self.x, self.y, self.angle, self.xdim, self.ydim)
@@ -3,8 +3,9 @@ from fluids.assets.shape import Shape
 from fluids.assets.waypoint import Waypoint
 
 class Sidewalk(Shape):
+    COLOR = (0xf7, 0xf7, 0xf7)
     def __init__(self, start_wps=[], end_wps=[], **kwargs):
-        Shape.__init__(self, color=(0xf7, 0xf7, 0xf7), **kwargs)
+        Shape.__init__(self, color=self.COLOR, **kwargs)
         point0 = (self.points[2] + self.points[3]) / 2
         point1 = (self.points[0] + self.points[1]) / 2
 
@@ -1,5 +1,6 @@
 from fluids.assets.shape import Shape
 
 class Terrain(Shape):
+    COLOR = (0xfd, 0xf8, 0xef)
     def __init__(self, **kwargs):
-        Shape.__init__(self, color=(0xfd,0xF8,0xef), **kwargs)
+        Shape.__init__(self, color=self.COLOR, **kwargs)
@@ -4,44 +4,88 @@ import shapely.geometry
 
 import scipy.interpolate as si
 from fluids.assets.shape import Shape
-from fluids.assets.waypoint_edge import WaypointEdge
-def plan(x0,y0,a0,x1,y1,a1,smooth_level=3000):
-    def interpolate(p0,p1,p2,p3,t):
-        return [p0[0]*1.0*((1-t)**3) \
-                + p1[0]*3.0*t*(1-t)**2 \
-                + p2[0]*3.0*(t**2)*(1-t) \
-                + p3[0]*1.0*(t**3),
-                p0[1]*1.0*((1-t)**3) \
-                + p1[1]*3.0*t*(1-t)**2 \
-                + p2[1]*3.0*(t**2)*(1-t) \
-                + p3[1]*1.0*(t**3)]
+PLAN_SAMPLES = np.arange(0, 1, .001)
+PLAN_BATCH   = 256
+
+def bezier(p0, p1, p2, p3, t):
+    """
+    Evaluates cubic Bezier curves at every parameter in t.
+
+    Parameters
+    ----------
+    p0, p1, p2, p3: np.array of shape (n, 2)
+        Control points of n curves
+    t: np.array of shape (m,)
+
+    Returns
+    -------
+    np.array of shape (n, m, 2)
+    """
+    # Powers of t come from scalar pow, which rounds differently from numpy's
+    #  vectorized pow, so paths stay the same as when evaluated one t at a time
+    def power(values, n):
+        return np.array([v ** n for v in values.tolist()])[:, None]
+    s = 1 - t
+    return p0[:, None]*1.0*power(s, 3) \
+        + p1[:, None]*3.0*t[:, None]*power(s, 2) \
+        + p2[:, None]*3.0*power(t, 2)*s[:, None] \
+        + p3[:, None]*1.0*power(t, 3)
+
+def plan_paths(x0, y0, a0, x1, y1, a1, smooth_level=3000):
+    """
+    Plans smooth paths between many pairs of poses at once. Each path follows a
+    cubic Bezier curve, sampled at PLAN_SAMPLES, keeping the first sample farther
+    than sqrt(smooth_level) from the last point kept.
+
+    Parameters
+    ----------
+    x0, y0, a0, x1, y1, a1: np.array of shape (n,)
+        Start and end poses
+
+    Returns
+    -------
+    list of (path, angles) for every pair, as returned by plan
+    """
+    x0, y0, a0, x1, y1, a1 = [np.asarray(v, dtype=np.float64).reshape(-1)
+                              for v in (x0, y0, a0, x1, y1, a1)]
     distance_between_points = np.sqrt((x0-x1)**2+(y0-y1)**2)
-    p0 = [x0,y0]
-    p1 = [x0 + .3*distance_between_points*np.cos(a0),
-          y0 - .3*distance_between_points*np.sin(a0)]
-    p2 = [x1 - .3*distance_between_points*np.cos(a1),
-          y1 + .3*distance_between_points*np.sin(a1)]
-    p3 = [x1,y1]
-
-    first_point = interpolate(p0,p1,p2,p3,0)
-    res_path = [first_point]
-    for t in np.arange(0,1,.001):
-        new_point = interpolate(p0,p1,p2,p3,t)
-        old_point = res_path[-1]
-        if (new_point[0] - old_point[0])**2 \
-           + (new_point[1] - old_point[1])**2 > smooth_level:
-            res_path.append(new_point)
-
-
-    res_path.append([x1, y1])
-    if a1 - a0 > np.pi:
-        a1 = a1 - (2 * np.pi)
-    if a0 - a1 > np.pi:
-        a0 = a0 - (2 * np.pi)
-    new_angles = np.linspace(a0, a1, len(res_path))
-    return res_path, new_angles
+    p0 = np.stack([x0, y0], axis=1)
+    p1 = np.stack([x0 + .3*distance_between_points*np.cos(a0),
+                   y0 - .3*distance_between_points*np.sin(a0)], axis=1)
+    p2 = np.stack([x1 - .3*distance_between_points*np.cos(a1),
+                   y1 + .3*distance_between_points*np.sin(a1)], axis=1)
+    p3 = np.stack([x1, y1], axis=1)
+
+    plans = []
+    for start in range(0, len(x0), PLAN_BATCH):
+        batch = slice(start, start + PLAN_BATCH)
+        curves = bezier(p0[batch], p1[batch], p2[batch], p3[batch], PLAN_SAMPLES)
+        for i, points in enumerate(curves, start):
+            # Jump straight to the next sample far enough from the last one kept
+            res_path = [points[0]]
+            last = 0
+            while True:
+                step = points[last + 1:] - points[last]
+                far = np.flatnonzero(step[:, 0]**2 + step[:, 1]**2 > smooth_level)
+                if not len(far):
+                    break
+                last = last + 1 + far[0]
+                res_path.append(points[last])
+            res_path.append(np.array([x1[i], y1[i]]))
+
+            b0, b1 = a0[i], a1[i]
+            if b1 - b0 > np.pi:
+                b1 = b1 - (2 * np.pi)
+            if b0 - b1 > np.pi:
+                b0 = b0 - (2 * np.pi)
+            plans.append((res_path, np.linspace(b0, b1, len(res_path))))
+    return plans
+
+def plan(x0,y0,a0,x1,y1,a1,smooth_level=3000):
+    return plan_paths([x0], [y0], [a0], [x1], [y1], [a1], smooth_level=smooth_level)[0]
 
 class Waypoint(Shape):
+    COLOR = (0, 255, 255)
     def __init__(self, x, y, owner=None, angle=0, nxt=None, **kwargs):
 
         self.radius = 0
@@ -56,18 +100,25 @@ class Waypoint(Shape):
         super(Waypoint, self).__init__(x=x, y=y,
                                        angle=angle % (2 * (np.pi)),
                                        xdim=5,
-                                       color=(0, 255, 255),
+                                       color=self.COLOR,
                                        **kwargs)
 
-    def smoothen(self, smooth_level=3000):
+    def smoothen(self, smooth_level=3000, plans=None):
+        """
+        Replaces the links to next waypoints with smooth paths of new waypoints.
+        plans may give the paths to each next waypoint, as found by plan_paths,
+        so that many waypoints can be planned in one batch.
+
+        Returns
+        -------
+        list of the new waypoints
+        """
+        if plans is None:
+            plans = plan_paths(*self.edge_poses(), smooth_level=smooth_level)
         all_news = []
         new_nxt = []
-        for n_p in self.nxt:
+        for n_p, (path, angles) in zip(self.nxt, plans):
             interp = []
-            path, angles = plan(self.x, self.y,
-                                self.angle % (2 * np.pi),
-                                n_p.x, n_p.y, n_p.angle % (2 * np.pi),
-                                smooth_level=smooth_level)
             new_point = Waypoint(path[1][0], path[1][1], ydim=self.ydim,
                                  angle=angles[1], owner=self.owner)
             all_news.append(new_point)
@@ -85,11 +136,14 @@ class Waypoint(Shape):
         self.nxt = new_nxt
         return all_news
 
-    def create_edges(self, **kwargs):
-        new_nxt = []
-        for n_p in self.nxt:
-            new_nxt.append(WaypointEdge(self, n_p, **kwargs))
-        self.nxt = new_nxt
+    def edge_poses(self):
+        """
+        Returns the start and end poses of the links to next waypoints, as an
+        array of shape (6, n) whose rows are the arguments of plan_paths
+        """
+        return np.array([(self.x, self.y, self.angle % (2 * np.pi),
+                          n_p.x, n_p.y, n_p.angle % (2 * np.pi)) for n_p in self.nxt],
+                        dtype=np.float64).reshape(-1, 6).T
 
     def render(self, surface, **kwargs):
         kwargs["border"] = None
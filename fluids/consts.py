@@ -1,4 +1,5 @@
-STATE_CITY   = "fluids_state_city"
+STATE_CITY     = "fluids_state_city"
+STATE_BIG_CITY = "fluids_state_big_city"
 
 OBS_QLIDAR   = "fluids_obs_qlidar"
 OBS_GRID     = "fluids_obs_grid"
@@ -7,6 +8,10 @@ OBS_NONE     = "fluids_obs_none"
 
 BACKGROUND_CSP = "fluids_background_csp"
 BACKGROUND_NULL = "fluids_background_null"
+BACKGROUND_PRIORITY = "fluids_background_priority"
+
+INTEGRATOR_ODEINT = "fluids_integrator_odeint"
+INTEGRATOR_BATCH  = "fluids_integrator_batch"
 
 REWARD_PATH = "fluids_reward_path"
 REWARD_NONE = "fluids_reward_none"
@@ -14,7 +14,7 @@ class DataSaver():
     """
 
     #def __init__(self, fluid_sim, file, keys=None, obs=[OBS_NONE], act=[SteeringAccAction], batch_size=500, make_dir=True, obs_kwargs={}):
-    def __init__(self, fluid_sim, file_path, keys=None, obs={"obs_grid": (OBS_GRID, {"obs_dim": 300, "shape": (40, 40)})}, act={"steeringacc": SteeringAccAction}, batch_size=500, make_dir=True):   
+    def __init__(self, fluid_sim, file_path, keys=None, obs={"obs_grid": (OBS_GRID, {"obs_dim": 300, "shape": (40, 40), "coverage": True})}, act={"steeringacc": SteeringAccAction}, batch_size=500, make_dir=True):   
         """
             Save data from FLUIDS simulation.
 
@@ -57,7 +57,7 @@ class DataSaver():
         observations = [] #(obs_name, observation)
         actions = [] #(act_name, action)
         for obs_name, (obs_space, obs_kwargs) in self.obs.items():
-            curr_observation = self.fluid_sim.state.objects[key].make_observation(obs_space, **obs_kwargs).get_array() 
+            curr_observation = self.fluid_sim.state.get_observation(key, obs_space, **obs_kwargs).get_array()
             observations.append((obs_name, curr_observation))
         for act_name, act_space in self.act.items():
             curr_act = self.fluid_sim.get_supervisor_actions(act_space, [key])[key].get_array()
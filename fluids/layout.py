@@ -0,0 +1,402 @@
+import json
+import random
+import numpy as np
+
+from fluids.assets import *
+from fluids.assets.waypoint import plan_paths
+from fluids.utils import make_box, fluids_assert, cache_key, load_npz
+from fluids.version import __version__
+
+
+STATIC_TYPES = {"Terrain"    : Terrain,
+                "Lane"       : Lane,
+                "Street"     : Street,
+                "CrossWalk"  : CrossWalk,
+                "PedCrossing": PedCrossing,
+                "Sidewalk"   : Sidewalk}
+
+def connect(crossing, waypoints):
+    """
+    Links the waypoints entering a street or ped crossing to the ones leaving it
+    """
+    for waypoint in waypoints:
+        if crossing.intersects(waypoint):
+            test_point = (waypoint.x + np.cos(waypoint.angle),
+                          waypoint.y - np.sin(waypoint.angle))
+            if crossing.contains_point(test_point):
+                crossing.in_waypoints.append(waypoint)
+                if type(crossing) == Street:
+                    assert(waypoint == waypoint.owner.end_waypoint)
+                    waypoint.owner = crossing
+            else:
+                crossing.out_waypoints.append(waypoint)
+    for in_p in crossing.in_waypoints:
+        for out_p in crossing.out_waypoints:
+            dangle = (in_p.angle - out_p.angle) % (2 * np.pi)
+            if dangle < 0.75*np.pi or dangle > 1.25*np.pi:
+                in_p.nxt.append(out_p)
+
+
+def smoothen(waypoints, smooth_level):
+    """
+    Smoothens the links of all waypoints, planning every path in one batch
+    """
+    poses = [wp.edge_poses() for wp in waypoints]
+    plans = plan_paths(*np.concatenate(poses + [np.zeros((6, 0))], axis=1),
+                       smooth_level=smooth_level)
+    offsets = np.cumsum([0] + [p.shape[1] for p in poses]).tolist()
+    new_waypoints = []
+    for i, waypoint in enumerate(waypoints):
+        new_points = waypoint.smoothen(smooth_level=smooth_level,
+                                       plans=plans[offsets[i]:offsets[i + 1]])
+        new_waypoints.extend(new_points)
+        for wp in new_points:
+            wp.owner = waypoint.owner
+    return waypoints + new_waypoints
+
+
+def generate_waypoints(layout, waypoint_width=5):
+    """
+    Builds the car and pedestrian waypoint graphs of a layout that has none, and
+    adds them to it in the same format as stored layouts.
+
+    Parameters
+    ----------
+    layout: dict
+        Layout as parsed from its json file. It is modified in place.
+    waypoint_width: int
+        Width of the lane waypoints
+    """
+    objs = []
+    for obj_info in layout['static_objects']:
+        obj_info = dict(obj_info)
+        typ = STATIC_TYPES[obj_info.pop('type')]
+        if typ == Lane:
+            obj_info["wp_width"] = waypoint_width
+        objs.append(typ(**obj_info))
+
+    def of_type(*types):
+        return [obj for obj in objs if type(obj) in types]
+
+    waypoints = [lane.start_waypoint for lane in of_type(Lane)]
+    waypoints.extend([lane.end_waypoint for lane in of_type(Lane)])
+    for street in of_type(Street):
+        connect(street, waypoints)
+    waypoints = smoothen(waypoints, 2000)
+
+    ped_waypoints = []
+    for obj in of_type(CrossWalk, Sidewalk):
+        ped_waypoints.extend(obj.start_waypoints)
+        ped_waypoints.extend(obj.end_waypoints)
+    for cross in of_type(PedCrossing):
+        connect(cross, ped_waypoints)
+    ped_waypoints = smoothen(ped_waypoints, 1500)
+
+    for i, wp in enumerate(waypoints + ped_waypoints):
+        wp.index = i
+        wp.owner.waypoints.append(wp)
+
+    layout['waypoints'] = [{"index":wp.index, "x":wp.x, "y": wp.y, "angle":wp.angle,
+                            "nxt":[w.index for w in wp.nxt]} for wp in waypoints]
+    layout['ped_waypoints'] = [{"index":wp.index, "x":wp.x, "y": wp.y, "angle":wp.angle,
+                                "nxt":[w.index for w in wp.nxt]} for wp in ped_waypoints]
+    for obj_info, obj in zip(layout['static_objects'], objs):
+        if obj_info['type'] == 'Lane':
+            obj_info['start_wp']  = obj.start_waypoint.index
+            obj_info['end_wp']    = obj.end_waypoint.index
+        elif obj_info['type'] in ['Sidewalk', 'CrossWalk']:
+            obj_info['start_wps'] = [wp.index for wp in obj.start_waypoints]
+            obj_info['end_wps']   = [wp.index for wp in obj.end_waypoints]
+        obj_info['waypoints']     = [wp.index for wp in obj.waypoints]
+    return layout
+
+
+def pack(arrays):
+    """
+    Concatenates variable length arrays, returning them with CSR offsets
+    """
+    sizes = [len(a) for a in arrays]
+    offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    return np.concatenate(list(arrays) + [np.zeros((0, 2))]), offsets
+
+
+def restore(cls, template, attrs):
+    """
+    Creates a shape of type cls without running its constructor, from the
+    attributes of a template instance updated with attrs
+    """
+    obj = cls.__new__(cls)
+    obj.__dict__ = dict(template, **attrs)
+    return obj
+
+
+class CompiledLayout(object):
+    """
+    Layout with everything State derives from its json file precomputed, so
+    that states load it without parsing or building the waypoint graph.
+
+    Static and dynamic objects are kept as their json descriptions, which are
+    cheap to build. Waypoints, which are most of the objects of a layout, and
+    the links between them are kept as flat arrays. Waypoints are restored
+    without their constructors:
+
+    - static_points, static_offsets: exterior ring of every static object
+    - waypoint_pose: (x, y, angle, ydim) of every waypoint, lanes first. The
+      layout refers to waypoints by their position here.
+    - waypoint_points, waypoint_origin_points: (W, 4, 2) corners of each waypoint
+    - waypoint_bounds: (minx, maxx, miny, maxy, radius) of each waypoint
+    - edge_offsets, edge_targets: CSR list of the waypoints each waypoint leads to
+
+    source is a digest of the json file the layout was compiled from, and format
+    is bumped, as FORMAT, whenever the arrays change meaning.
+
+    Parameters
+    ----------
+    arrays: dict of (str -> np.array)
+        Arrays of a compiled layout, as made by compile or read by load
+    """
+    FORMAT = 4
+    ARRAYS = ("version", "format", "source", "layout", "waypoint_width", "n_waypoints",
+              "static_points", "static_offsets",
+              "waypoint_pose", "waypoint_points",
+              "waypoint_origin_points", "waypoint_bounds",
+              "edge_offsets", "edge_targets")
+
+    def __init__(self, arrays):
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def compile(cls, source, waypoint_width=5):
+        """
+        Compiles a layout
+
+        Parameters
+        ----------
+        source: str or bytes
+            Contents of the layout's json file, with or without waypoints
+        waypoint_width: int
+            Width of the lane waypoints
+        """
+        layout = json.loads(source)
+        if 'waypoints' not in layout:
+            layout = generate_waypoints(layout, waypoint_width)
+
+        static_rings = []
+        for obj_info in layout['static_objects']:
+            obj_info = dict(obj_info)
+            typ = STATIC_TYPES[obj_info.pop('type')]
+            if typ == Lane:
+                obj_info["wp_width"] = waypoint_width
+            obj = typ(**obj_info)
+            static_rings.append(np.array(obj.shapely_obj.exterior.coords)[:, :2])
+
+        wp_map = {}
+        waypoints = []
+        for ped, infos in enumerate([layout['waypoints'], layout['ped_waypoints']]):
+            for wp_info in infos:
+                wp_info = dict(wp_info)
+                index = wp_info.pop('index')
+                if ped:
+                    wp = Waypoint(owner=None, **wp_info)
+                else:
+                    wp = Waypoint(owner=None, ydim=waypoint_width, **wp_info)
+                wp.index = index
+                wp_map[index] = wp
+                waypoints.append(wp)
+        n_waypoints = len(layout['waypoints'])
+        for wp in waypoints:
+            wp.nxt = [wp_map[index] for index in wp.nxt]
+
+        # Waypoints are renumbered by their position in the graph
+        for i, wp in enumerate(waypoints):
+            wp.index = i
+        for obj_info in layout['static_objects']:
+            for key in ['start_wp', 'end_wp']:
+                if key in obj_info:
+                    obj_info[key] = wp_map[obj_info[key]].index
+            for key in ['start_wps', 'end_wps', 'waypoints']:
+                if key in obj_info:
+                    obj_info[key] = [wp_map[i].index for i in obj_info[key]]
+
+        def bounds(shapes):
+            return np.array([[s.minx, s.maxx, s.miny, s.maxy, s.radius] for s in shapes],
+                            dtype=np.float64).reshape(-1, 5)
+
+        position = {id(wp): i for i, wp in enumerate(waypoints)}
+        static_points, static_offsets = pack(static_rings)
+        layout = {k: layout[k] for k in ['dimension_x', 'dimension_y',
+                                         'static_objects', 'dynamic_objects']}
+        return cls({
+            "version"               : np.array(__version__),
+            "format"                : np.array(cls.FORMAT),
+            "source"                : np.array(cache_key(source)),
+            "layout"                : np.frombuffer(json.dumps(layout).encode(), dtype=np.uint8),
+            "waypoint_width"        : np.array(waypoint_width),
+            "n_waypoints"           : np.array(n_waypoints),
+            "static_points"         : static_points,
+            "static_offsets"        : static_offsets,
+            "waypoint_pose"         : np.array([[wp.x, wp.y, wp.angle, wp.ydim]
+                                                for wp in waypoints],
+                                               dtype=np.float64).reshape(-1, 4),
+            "waypoint_points"       : np.array([wp.points for wp in waypoints],
+                                               dtype=np.float64).reshape(-1, 4, 2),
+            "waypoint_origin_points": np.array([wp.origin_points for wp in waypoints],
+                                               dtype=np.float64).reshape(-1, 4, 2),
+            "waypoint_bounds"       : bounds(waypoints),
+            "edge_offsets"          : np.concatenate([[0], np.cumsum([len(wp.nxt) for wp in waypoints])]
+                                                     ).astype(np.int64),
+            "edge_targets"          : np.array([position[id(n_p)] for wp in waypoints
+                                                for n_p in wp.nxt], dtype=np.int64)})
+
+    def save(self, outfile):
+        """
+        Writes the layout uncompressed, so that load can memory map it
+
+        Parameters
+        ----------
+        outfile: str or file
+            File name or binary file object
+        """
+        np.savez(outfile, **{name: getattr(self, name) for name in self.ARRAYS})
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Memory maps a compiled layout. Its arrays are read only.
+        """
+        data = load_npz(fname)
+        fluids_assert(str(data["version"]) == __version__,
+                      "Compiled layout {} is from fluids {}, not {}".format(
+                          fname, data["version"], __version__))
+        fluids_assert("format" in data and int(data["format"]) == cls.FORMAT,
+                      "Compiled layout {} is in an older format, compile it again".format(
+                          fname))
+        return cls(data)
+
+    def get_layout(self):
+        """
+        Returns the json description of the layout's static and dynamic objects,
+        with waypoints given by index. A new copy is parsed every call.
+        """
+        return json.loads(self.layout.tobytes().decode())
+
+    def get_static_rings(self):
+        """
+        Returns the exterior ring of every static object, in layout order
+        """
+        return np.split(self.static_points, self.static_offsets[1:-1])
+
+    def get_waypoint_graph(self):
+        """
+        Restores the waypoint graphs, with their edges
+        """
+        return WaypointGraph(self)
+
+
+class WaypointGraph(object):
+    """
+    Car and pedestrian waypoint graphs of a State, as arrays. Waypoints are
+    numbered from 0, car waypoints first, and waypoint i is waypoints[i], whose
+    index is i. Routes of cars and pedestrians are lists of these numbers.
+
+    - xy, angle: position and angle of every waypoint
+    - bounds: (minx, miny, maxx, maxy) of every waypoint
+    - offsets, targets: the edges leaving waypoint i are numbered
+      offsets[i] to offsets[i + 1], and edge e leads to waypoint targets[e]
+    - sources: the waypoint edge e leaves
+    - rings: (W, 5, 2) closed exterior ring of every waypoint
+    - centers: mean of every ring, which is where a waypoint is drawn
+
+    The Waypoint objects are kept in waypoints, for the shape tests and drawing
+    that need them. Their nxt links are not restored, as edges only exist in the
+    arrays.
+
+    Parameters
+    ----------
+    compiled: CompiledLayout
+        Layout to restore the graph of
+    """
+    def __init__(self, compiled):
+        self.n_waypoints = int(compiled.n_waypoints)
+        self.xy          = compiled.waypoint_pose[:, :2]
+        self.angle       = compiled.waypoint_pose[:, 2]
+        self.bounds      = compiled.waypoint_bounds[:, [0, 2, 1, 3]]
+        self.offsets     = compiled.edge_offsets
+        self.targets     = compiled.edge_targets
+        self.sources     = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+        points           = compiled.waypoint_points
+        self.rings       = np.concatenate([points, points[:, :1]], axis=1)
+        self.centers     = self.rings.mean(axis=1)
+        # Route extension works on Python numbers
+        self.offset_list = self.offsets.tolist()
+        self.target_list = self.targets.tolist()
+        self.source_list = self.sources.tolist()
+        self.xy_list     = [tuple(p) for p in self.xy.tolist()]
+
+        width = float(compiled.waypoint_width)
+        template = Waypoint(0, 0, ydim=width).__dict__
+        del template["nxt"]
+        self.waypoints = []
+        for index, ((x, y, angle, ydim), points, origin_points,
+                    (minx, maxx, miny, maxy, radius)) in \
+            enumerate(zip(compiled.waypoint_pose.tolist(),
+                          compiled.waypoint_points,
+                          compiled.waypoint_origin_points,
+                          compiled.waypoint_bounds.tolist())):
+            self.waypoints.append(restore(Waypoint, template, {
+                "x": x, "y": y, "angle": angle, "ydim": ydim,
+                "points": points, "origin_points": origin_points,
+                "minx": minx, "maxx": maxx, "miny": miny, "maxy": maxy,
+                "radius": radius,
+                "box": make_box(x, y, angle, 5, ydim) if ydim > 0 else None,
+                "index": index, "waypoints": []}))
+
+    def successors(self, i):
+        """
+        Returns the waypoints that waypoint i leads to
+        """
+        return self.targets[self.offsets[i]:self.offsets[i + 1]]
+
+    def segment(self, e):
+        """
+        Returns the ((x0, y0), (x1, y1)) positions of the waypoints edge e joins
+        """
+        return self.xy_list[self.source_list[e]], self.xy_list[self.target_list[e]]
+
+    def choose_edge(self, i):
+        """
+        Picks one of the edges leaving waypoint i at random. This draws from
+        random the same way as random.choice(waypoint.nxt).
+        """
+        start = self.offset_list[i]
+        return start + random.randrange(self.offset_list[i + 1] - start)
+
+    def choose_next(self, i):
+        """
+        Picks one of the waypoints that waypoint i leads to at random
+        """
+        return self.target_list[self.choose_edge(i)]
+
+    def extend(self, route, depth):
+        """
+        Extends route in place with randomly chosen successors, until it has
+        depth waypoints or reaches a waypoint with none. Each choice depends on
+        the last, so this walks one waypoint at a time. Routes only fill up once,
+        and after that grow by the waypoints their agent has passed.
+
+        Returns
+        -------
+        list of int, the edges taken
+        """
+        edges = []
+        if not route:
+            return edges
+        offsets, targets = self.offset_list, self.target_list
+        i = route[-1]
+        while len(route) < depth and offsets[i] < offsets[i + 1]:
+            e = offsets[i] + random.randrange(offsets[i + 1] - offsets[i])
+            edges.append(e)
+            i = targets[e]
+            route.append(i)
+        return edges
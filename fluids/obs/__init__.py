@@ -1,5 +1,8 @@
 from fluids.obs.obs import FluidsObs
+from fluids.obs.scene import ObservationScene
+from fluids.obs.static_map import StaticMap
+from fluids.obs.dynamic_map import DynamicMap
 from fluids.obs.qlidar import QLidarObservation
-from fluids.obs.grid import GridObservation
+from fluids.obs.grid import GridObservation, pack_grid, unpack_grid, grid_channel
 from fluids.obs.birds_eye import BirdsEyeObservation
 
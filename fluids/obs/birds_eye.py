@@ -5,17 +5,52 @@ import pygame
 from fluids.assets.shape import Shape
 
 from fluids.obs.obs import FluidsObs
+from fluids.obs.scene import to_frame
 from fluids.utils import rotation_array
 
+
+def type_colors():
+    """
+    Returns the bird's eye color of every object type, in drawing order, as set
+    by the asset classes. Cars and traffic lights change color at runtime, so they
+    are drawn in their own colors and map to None.
+    """
+    from fluids.assets import Car, Lane, Sidewalk, Terrain, TrafficLight, Waypoint, \
+        PedCrossing, Pedestrian
+    return [(Terrain,      Terrain.COLOR),
+            (Sidewalk,     Sidewalk.COLOR),
+            (Lane,         Lane.COLOR),
+            (Car,          None),
+            (TrafficLight, None),
+            (Waypoint,     Waypoint.COLOR),
+            (PedCrossing,  PedCrossing.COLOR),
+            (Pedestrian,   Pedestrian.COLOR)]
+
+
 class BirdsEyeObservation(FluidsObs):
     """
     Bird's-eye 2D top-down image centered on the vehicle, similar to what is visualized.
     Minor difference is that drivable regions are colorless to differentiate from illegal drivable regions.
-    Array representation is (obs_dim, obs_dim, 3).
+    Array representation is (obs_dim, obs_dim, 3) uint8.
+
+    Rendering is headless and works at any visualization level. Every visible polygon
+    is moved into the observation frame in one pass, drawn on a surface of the
+    observation's own, and copied out once.
+
+    Parameters
+    ----------
+    car: fluids.Car
+        Car to observe from
+    obs_dim: int
+        Side length of the observed region in world units and pixels
+    out: np.array of uint8 with shape (obs_dim, obs_dim, 3), optional
+        Buffer to render into, for example one row of a preallocated batch.
+        A new array is allocated if not given.
     """
-    def __init__(self, car, obs_dim=500):
-        from fluids.assets import Car, Lane, Sidewalk, Terrain, TrafficLight, Waypoint, PedCrossing, Pedestrian
+    def __init__(self, car, obs_dim=500, out=None):
+        from fluids.assets import TrafficLight, Waypoint
         state = car.state
+        scene = state.get_observation_scene()
         self.car = car
         self.grid_dim = obs_dim
         self.grid_square = Shape(x=car.x+obs_dim/3*np.cos(car.angle),
@@ -24,29 +59,47 @@ class BirdsEyeObservation(FluidsObs):
                                  color=None)
         self.all_collideables = []
         collideable_map = {Waypoint:[]}
-        for k, obj in iteritems(state.objects):
-            if (car.can_collide(obj) or type(obj) in {TrafficLight}) and self.grid_square.intersects(obj):
+        for k in scene.query(self.grid_square):
+            obj = state.objects[k]
+            if car.can_collide(obj) or type(obj) in {TrafficLight}:
                 typ = type(obj)
                 if typ not in collideable_map:
                     collideable_map[typ] = []
-                collideable_map[typ].append(obj)
+                collideable_map[typ].append((obj, scene.coords(k)))
                 self.all_collideables.append(obj)
-        for waypoint in car.waypoints:
-            collideable_map[Waypoint].append(waypoint)
+        graph = state.waypoint_graph
+        for i in car.route:
+            waypoint = graph.waypoints[i]
+            collideable_map[Waypoint].append((waypoint, graph.rings[i]))
             self.all_collideables.append(waypoint)
 
-        debug_window = pygame.Surface((self.grid_dim, self.grid_dim))
         gd = self.grid_dim
         a0 = self.car.angle + np.pi / 2
         a1 = self.car.angle
-        for typ in [Terrain, Sidewalk, Lane, Car, TrafficLight, Waypoint, PedCrossing, Pedestrian]:
-            if typ in collideable_map:
-                for obj in collideable_map[typ]:
-                    rel_obj = obj.get_relative((self.car.x+gd/2*np.cos(a0)-gd/6*np.cos(a1),
-                                                self.car.y-gd/2*np.sin(a0)+gd/6*np.sin(a1),
-                                                self.car.angle))
-                    rel_obj.render(debug_window, border=None)
-        self.pygame_rep = pygame.transform.rotate(debug_window, 90)
+        rel = (self.car.x+gd/2*np.cos(a0)-gd/6*np.cos(a1),
+               self.car.y-gd/2*np.sin(a0)+gd/6*np.sin(a1),
+               self.car.angle)
+        polygons, colors = [], []
+        for typ, color in type_colors():
+            for obj, coords in collideable_map.get(typ, []):
+                if obj.color:
+                    polygons.append(coords)
+                    colors.append(color or obj.color)
+        if polygons:
+            points = to_frame(np.concatenate(polygons), rel)
+            polygons = np.split(points, np.cumsum([len(p) for p in polygons])[:-1])
+
+        # A new surface starts out black, and is cheaper to make than to clear
+        canvas = pygame.Surface((gd, gd))
+        for polygon, color in zip(polygons, colors):
+            pygame.draw.polygon(canvas, color, polygon)
+
+        # The canvas is indexed by (x, y) in the observation frame. The image is
+        #  that canvas turned by 90 degrees, as the visualizer shows it.
+        self.image = np.empty((gd, gd, 3), dtype=np.uint8) if out is None else out
+        pixels = pygame.surfarray.pixels3d(canvas)
+        np.copyto(self.image, pixels[::-1].swapaxes(0, 1))
+        del pixels
 
 
     def render(self, surface):
@@ -57,11 +110,11 @@ class BirdsEyeObservation(FluidsObs):
                 for obj in self.all_collideables:
                     obj.render_debug(surface)
 
-            surface.blit(self.pygame_rep, (surface.get_size()[0] - self.grid_dim, 0))        
+            surface.blit(pygame.surfarray.make_surface(self.image),
+                         (surface.get_size()[0] - self.grid_dim, 0))
             pygame.draw.rect(surface, (0, 0, 0),
                              pygame.Rect((surface.get_size()[0] - self.grid_dim-5, 0-5),
                                          (self.grid_dim+10, self.grid_dim+10)), 10)
 
     def get_array(self):
-        arr = pygame.surfarray.array3d(self.pygame_rep)
-        return arr
+        return self.image
@@ -0,0 +1,131 @@
+import numpy as np
+from six import iteritems
+
+from fluids.consts import RED, GREEN, YELLOW
+from fluids.utils import polygon_masks
+
+
+class DynamicMap(object):
+    """
+    World frame raster of a State at one time step, combining the terrain and
+    street layers of its StaticMap with its cars, pedestrians and traffic lights.
+
+    It is drawn once per step and shared by every grid observation that asks for
+    it, so each observation crops all of these layers out of the map at once
+    instead of culling and drawing the dynamic objects itself. Pixels line up with
+    the StaticMap, and use the same windows.
+
+    Every pixel is a uint8. The low 5 bits are the TERRAIN, STREET, PEDS,
+    LIGHT_RED and LIGHT_GREEN bits, where yellow lights count as green as in
+    GridObservation. The high 3 bits count the cars covering the pixel, up to 7,
+    so that observers can take out their own footprint. The footprint of every
+    car is kept with the map, and is not drawn again by its observers.
+
+    Parameters
+    ----------
+    state: fluids.State
+        State to draw
+    previous: DynamicMap, optional
+        Map of an earlier step of the same state. Its buffer is reused, with only
+        the pixels it drew restored from the StaticMap, so previous must not be
+        used afterwards.
+    """
+    TERRAIN     = 1
+    STREET      = 2
+    PEDS        = 4
+    LIGHT_RED   = 8
+    LIGHT_GREEN = 16
+    CAR         = 32
+
+    def __init__(self, state, previous=None):
+        from fluids.assets import Car, Pedestrian, TrafficLight
+        static_map = state.get_static_map()
+        self.time = state.time
+        self.scene = state.get_observation_scene()
+        self.origin = static_map.origin
+        self.height, self.width = static_map.height, static_map.width
+        if previous is None:
+            self.pixels = static_map.terrain * np.uint8(self.TERRAIN) \
+                | static_map.street * np.uint8(self.STREET)
+        else:
+            self.pixels = previous.pixels
+            for rows, cols in previous.patches:
+                self.pixels[rows, cols] = static_map.terrain[rows, cols] * np.uint8(self.TERRAIN) \
+                    | static_map.street[rows, cols] * np.uint8(self.STREET)
+            previous.pixels = None
+        self.patches = []
+        self.car_footprints = {}
+
+        objs = [(k, obj, self.CAR) for k, obj in iteritems(state.type_map[Car])]
+        objs += [(k, obj, self.PEDS) for k, obj in iteritems(state.type_map[Pedestrian])]
+        for k, obj in iteritems(state.type_map[TrafficLight]):
+            if obj.color == RED:
+                objs.append((k, obj, self.LIGHT_RED))
+            elif obj.color in (GREEN, YELLOW):
+                objs.append((k, obj, self.LIGHT_GREEN))
+        objs = [(k, obj, bit) for k, obj, bit in objs if obj.color]
+        patches = self.footprints([self.scene.coords(k) for k, obj, bit in objs])
+        for (k, obj, bit), ((rows, cols), mask) in zip(objs, patches):
+            if mask is None:
+                continue
+            self.patches.append((rows, cols))
+            pixels = self.pixels[rows, cols]
+            if bit == self.CAR:
+                self.car_footprints[obj] = (rows.start, cols.start, mask)
+                pixels += (mask & (pixels < np.uint8(7 * self.CAR))) * np.uint8(self.CAR)
+            else:
+                pixels[mask] |= np.uint8(bit)
+
+    def footprints(self, polygons):
+        """
+        Rasterizes polygons given in world coordinates into map pixels
+
+        Returns
+        -------
+        list of ((rows, cols), np.array of bool), the slices of the map each
+        polygon covers and its mask over them. The mask is None for polygons
+        off the map.
+        """
+        out = []
+        for (r0, c0), mask in polygon_masks([p - self.origin for p in polygons]):
+            h, w = mask.shape
+            top, left = max(-r0, 0), max(-c0, 0)
+            bottom = min(h, self.height - r0)
+            right = min(w, self.width - c0)
+            if top >= bottom or left >= right:
+                out.append(((None, None), None))
+                continue
+            out.append(((slice(r0 + top, r0 + bottom), slice(c0 + left, c0 + right)),
+                        mask[top:bottom, left:right]))
+        return out
+
+    def crop(self, window):
+        """
+        Samples the map under a window from StaticMap.window
+        """
+        return np.take(self.pixels.ravel(), window)
+
+    def car_mask(self, pixels, window, car=None):
+        """
+        Returns where cars lie in pixels cropped under window, leaving out the
+        footprint of car
+        """
+        counts = pixels >> 5
+        if car in self.car_footprints:
+            r0, c0, mask = self.car_footprints[car]
+            covered = np.flatnonzero(counts)
+            rows, cols = np.divmod(window.ravel()[covered], self.width)
+            rows -= r0
+            cols -= c0
+            inside = (rows >= 0) & (rows < mask.shape[0]) \
+                & (cols >= 0) & (cols < mask.shape[1])
+            covered, rows, cols = covered[inside], rows[inside], cols[inside]
+            counts.ravel()[covered[mask[rows, cols]]] -= 1
+        return counts > 0
+
+    @staticmethod
+    def mask(pixels, bit):
+        """
+        Returns where pixels cropped from the map have a bit set
+        """
+        return (pixels & np.uint8(bit)) != 0
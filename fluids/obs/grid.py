@@ -3,34 +3,148 @@ import numpy as np
 import pygame
 from fluids.assets.shape import Shape
 from fluids.obs.obs import FluidsObs
-from fluids.utils import rotation_array
-from scipy.misc import imresize
+from fluids.obs.scene import to_frame
+from fluids.utils import rotation_array, fill_polygons, fill_disk, segment_polygon, \
+    fluids_assert
 from fluids.consts import *
 
+# Channels of the grid observation
+GRID_TERRAIN         = 0
+GRID_DRIVABLE        = 1
+GRID_UNDRIVABLE      = 2
+GRID_CARS            = 3
+GRID_PEDS            = 4
+GRID_LIGHT_RED       = 5
+GRID_LIGHT_GREEN     = 6
+GRID_LIGHT_YELLOW    = 7
+GRID_DIRECTION       = 8
+GRID_DIRECTION_PIXEL = 9
+GRID_DIRECTION_EDGE  = 10
+N_GRID_CHANNELS      = 11
+
+
+def pack_grid(grid):
+    """
+    Packs the channels of a boolean (..., n_channels) grid into bits.
+    Channel c is bit c % 8 of byte c // 8 of every cell, so 11 channels take
+    2 bytes per cell instead of 88 as float64.
+
+    The packed array does not record how many channels it holds, or which. A
+    grid of selected channels packs them in the order they were asked for, so
+    unpacking it needs that number of channels, and bit c is the c-th channel
+    asked for rather than GRID_* channel c.
+    """
+    return np.packbits(np.asarray(grid, dtype=bool), axis=-1, bitorder="little")
+
+
+def unpack_grid(packed, n_channels):
+    """
+    Unpacks a grid from pack_grid into a boolean (..., n_channels) array.
+    Works on batches of grids, such as a slice of a replay buffer.
+
+    Parameters
+    ----------
+    packed: np.array of uint8
+        Grid from pack_grid
+    n_channels: int
+        Number of channels that were packed, N_GRID_CHANNELS for full grids
+        and len(channels) for grids of selected channels
+    """
+    packed = np.asarray(packed)
+    fluids_assert(packed.shape[-1] == (n_channels + 7) // 8,
+                  "Packed grid with {} bytes per cell cannot hold {} channels".format(
+                      packed.shape[-1], n_channels))
+    return np.unpackbits(packed, axis=-1, count=n_channels, bitorder="little").view(bool)
+
+
+def grid_channel(packed, channel):
+    """
+    Returns one channel of a grid from pack_grid as a boolean array, without
+    unpacking the others. channel is the position of the channel in the packed
+    grid.
+    """
+    return (packed[..., channel // 8] & np.uint8(1 << (channel % 8))) != 0
+
+
 class GridObservation(FluidsObs):
     """
     Grid observation type. 
     Observation is an occupancy grid over the detection region. 
     Observation has 11 dimensions: terrain, drivable regions, illegal drivable 
     regions, cars, pedestrians, traffic lights x 3, way points, point trajectory and edge trajectory.
-    Array representation is (grid_size, grid_size, 11)
+    Array representation is (shape[0], shape[1], 11), or (shape[0], shape[1], len(channels))
+    when only some channels are asked for. The grid covers obs_dim x obs_dim world units,
+    and is drawn directly at shape. With packed set, the channels are instead packed into
+    the bits of a uint8 array, in the same order. unpack_grid needs len(channels) to
+    unpack it, see pack_grid.
+
+    The grid is rasterized with NumPy straight into a boolean array, without pygame.
+    Static layers are cropped from the state's StaticMap, and only cars, pedestrians,
+    traffic lights and waypoints are drawn per observation. With shared set, cars,
+    pedestrians and traffic lights are cropped from the state's DynamicMap as well,
+    which is drawn once per step for every observer, so only waypoints are drawn
+    per observation.
+
+    Parameters
+    ----------
+    car: fluids.Car
+        Car to observe from
+    obs_dim: int
+        Side length of the observed region in world units
+    shape: tuple of int
+        Resolution of the grid
+    coverage: bool
+        If set, every cell holds the fraction of its area each channel covers
+        instead of whether the channel covers its center
+    coverage_samples: int
+        Coverage is estimated from coverage_samples x coverage_samples samples per cell
+    dtype: np.dtype
+        Type of the array. Occupancy fits in bool or uint8, while coverage needs
+        a floating point type.
+    packed: bool
+        If set, the array has the channels packed into bits. Incompatible with coverage.
+    shared: bool
+        If set, dynamic objects are sampled from a world frame map shared by all
+        observers. Their edges are then only accurate to a world unit.
+    channels: list of int, optional
+        GRID_* channels to return, in order. Channels that are not asked for are
+        never culled or drawn. Defaults to all of them.
     """
-    def __init__(self, car, obs_dim=500, shape=(500,500)):
-        from fluids.assets import ALL_OBJS, TrafficLight, Lane, Terrain, Sidewalk, \
-            PedCrossing, Street, Car, Waypoint, Pedestrian
+    def __init__(self, car, obs_dim=500, shape=(500,500), coverage=False, coverage_samples=4,
+                 dtype=np.float64, packed=False, shared=False, channels=None):
+        from fluids.assets import ALL_OBJS, TrafficLight, Lane, Street, Car, Pedestrian
         state = car.state
+        scene = state.get_observation_scene()
+        static_map = state.get_static_map()
         self.car = car
-        self.shape = shape
+        self.shape = tuple(shape)
         self.grid_dim = obs_dim
-        self.downsample = self.shape != (obs_dim, obs_dim)
+        self.coverage = coverage
+        self.dtype = np.dtype(dtype)
+        self.packed = packed
+        fluids_assert(not (coverage and packed), "Coverage grids cannot be packed")
+        fluids_assert(not coverage or self.dtype.kind == "f",
+                      "Coverage grids need a floating point dtype")
+        self.channels = list(range(N_GRID_CHANNELS)) if channels is None else list(channels)
+        fluids_assert(all(0 <= c < N_GRID_CHANNELS for c in self.channels)
+                      and len(set(self.channels)) == len(self.channels),
+                      "Grid channels must be distinct GRID_* constants")
+        index = {c: i for i, c in enumerate(self.channels)}
+        wants = lambda *cs: any(c in index for c in cs)
+        dynamic = wants(GRID_CARS, GRID_PEDS, GRID_LIGHT_RED, GRID_LIGHT_GREEN)
         self.grid_square = Shape(x=car.x+obs_dim/3*np.cos(car.angle),
                                  y=car.y-obs_dim/3*np.sin(car.angle),
                                  xdim=obs_dim, ydim=obs_dim, angle=car.angle,
                                  color=None, border_color=(200,0,0))
+        # Static objects come from the static map, and are only looked up
+        #  for debug rendering. So are dynamic objects in shared mode.
         self.all_collideables = []
         collideable_map = {typ:[] for typ in ALL_OBJS}
-        for k, obj in iteritems(state.objects):
-            if (car.can_collide(obj) or type(obj) in {TrafficLight, Lane, Street}) and self.grid_square.intersects(obj):
+        candidates = scene.query(self.grid_square, static=car.vis_level > 4) \
+            if (dynamic and not shared) or car.vis_level > 4 else []
+        for k in candidates:
+            obj = state.objects[k]
+            if car.can_collide(obj) or type(obj) in {TrafficLight, Lane, Street}:
                 typ = type(obj)
                 if typ == TrafficLight:
                     if obj.color == RED:
@@ -41,25 +155,11 @@ class GridObservation(FluidsObs):
                         typ = "TrafficLight-Yellow"
                 if typ not in collideable_map:
                     collideable_map[typ] = []
-                collideable_map[typ].append(obj)
+                collideable_map[typ].append((k, obj))
                 self.all_collideables.append(obj)
-        for waypoint in car.waypoints:
-            collideable_map[Waypoint].append(waypoint)
-            self.all_collideables.append(waypoint)
-
-        terrain_window    = pygame.Surface((self.grid_dim, self.grid_dim))
-        drivable_window   = pygame.Surface((self.grid_dim, self.grid_dim))
-        undrivable_window = pygame.Surface((self.grid_dim, self.grid_dim))
-        car_window        = pygame.Surface((self.grid_dim, self.grid_dim))
-        ped_window        = pygame.Surface((self.grid_dim, self.grid_dim))
-        light_window_red  = pygame.Surface((self.grid_dim, self.grid_dim))
-        light_window_green= pygame.Surface((self.grid_dim, self.grid_dim))
-        light_window_yellow=pygame.Surface((self.grid_dim, self.grid_dim))
-        direction_window  = pygame.Surface((self.grid_dim, self.grid_dim))
-        direction_pixel_window \
-                          = pygame.Surface((self.grid_dim, self.grid_dim))
-        direction_edge_window \
-                          = pygame.Surface((self.grid_dim, self.grid_dim))
+        if car.vis_level > 4:
+            graph = state.waypoint_graph
+            self.all_collideables.extend(graph.waypoints[i] for i in car.route)
 
         gd = self.grid_dim
         a0 = self.car.angle + np.pi / 2
@@ -67,85 +167,120 @@ class GridObservation(FluidsObs):
         rel = (self.car.x+gd/2*np.cos(a0)-gd/6*np.cos(a1),
                self.car.y-gd/2*np.sin(a0)+gd/6*np.sin(a1),
                self.car.angle)
-
-        for typ in [Terrain, Sidewalk, PedCrossing]:
-            for obj in collideable_map[typ]:
-                rel_obj = obj.get_relative(rel)
-                rel_obj.render(terrain_window, border=None)
-
-        for obj in collideable_map[Lane]:
-            rel_obj = obj.get_relative(rel)
-            if not car.can_collide(obj):
-                rel_obj.render(drivable_window, border=None)
-            else:
-                rel_obj.render(undrivable_window, border=None)
-        for obj in collideable_map[Street]:
-            rel_obj = obj.get_relative(rel)
-            rel_obj.render(drivable_window, border=None)
-
-        for obj in collideable_map[Car]:
-            rel_obj = obj.get_relative(rel)
-            rel_obj.render(car_window, border=None)
-
-        for obj in collideable_map[Pedestrian]:
-            rel_obj = obj.get_relative(rel)
-            rel_obj.render(ped_window, border=None)
-
-        for obj in collideable_map["TrafficLight-Red"]:
-            rel_obj = obj.get_relative(rel)
-            rel_obj.render(light_window_red, border=None)
-
-        for obj in collideable_map["TrafficLight-Green"]:
-            rel_obj = obj.get_relative(rel)
-            rel_obj.render(light_window_green, border=None)
-        
-        for obj in collideable_map["TrafficLight-Yellow"]:
-            rel_obj = obj.get_relative(rel)
-            rel_obj.render(light_window_green, border=None)
-
+        self.rel = rel
+        samples = coverage_samples if coverage else 1
+        h, w = self.shape[0] * samples, self.shape[1] * samples
+        grid = np.zeros((h, w, len(self.channels)), dtype=bool)
+        # Channels are drawn straight into their place in the returned array
+        def layer(channel):
+            return grid[:, :, index[channel]]
+
+        shared = shared and (dynamic or wants(GRID_TERRAIN, GRID_DRIVABLE))
+        if shared or wants(GRID_TERRAIN, GRID_DRIVABLE, GRID_UNDRIVABLE):
+            window = static_map.window(rel, gd, (h, w))
+            opposing = [car.can_collide(group[0]) for group in static_map.lane_groups]
+        if shared:
+            dynamic_map = state.get_dynamic_map()
+            pixels = dynamic_map.crop(window)
+        if wants(GRID_TERRAIN):
+            layer(GRID_TERRAIN)[:] = dynamic_map.mask(pixels, dynamic_map.TERRAIN) if shared \
+                else static_map.crop("terrain", window)
+        if wants(GRID_DRIVABLE):
+            layer(GRID_DRIVABLE)[:] = (dynamic_map.mask(pixels, dynamic_map.STREET) if shared
+                                       else static_map.crop("street", window)) \
+                | static_map.lane_mask(window, [g for g, o in enumerate(opposing) if not o])
+        if wants(GRID_UNDRIVABLE):
+            layer(GRID_UNDRIVABLE)[:] = static_map.lane_mask(
+                window, [g for g, o in enumerate(opposing) if o])
+
+        # In the car frame x points right and y down. The grid is stored rotated
+        #  by 90 degrees, so rows run along y and columns against x, and scaled
+        #  from obs_dim to the grid size
+        scale = np.array([w / float(gd), h / float(gd)])
+        def to_grid(points):
+            points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+            return np.stack([gd - points[:, 0], points[:, 1]], axis=1) * scale
+
+        def fill(channel, objs):
+            if wants(channel):
+                fill_polygons(layer(channel), [to_grid(scene.relative_coords(k, rel))
+                                               for k, obj in objs if obj.color])
+
+        if shared:
+            if wants(GRID_CARS):
+                layer(GRID_CARS)[:] = dynamic_map.car_mask(pixels, window, car)
+            for channel, bit in [(GRID_PEDS, dynamic_map.PEDS),
+                                 (GRID_LIGHT_RED, dynamic_map.LIGHT_RED),
+                                 (GRID_LIGHT_GREEN, dynamic_map.LIGHT_GREEN)]:
+                if wants(channel):
+                    layer(channel)[:] = dynamic_map.mask(pixels, bit)
+        else:
+            fill(GRID_CARS, collideable_map[Car])
+            fill(GRID_PEDS, collideable_map[Pedestrian])
+            fill(GRID_LIGHT_RED, collideable_map["TrafficLight-Red"])
+            fill(GRID_LIGHT_GREEN, collideable_map["TrafficLight-Green"]
+                 + collideable_map["TrafficLight-Yellow"])
+
+        # The trajectory channels walk every waypoint of the car
+        if wants(GRID_DIRECTION, GRID_DIRECTION_PIXEL, GRID_DIRECTION_EDGE):
+            self.draw_trajectory(rel, layer, wants, to_grid, scale)
+
+        if coverage:
+            grid = grid.reshape(self.shape[0], samples, self.shape[1], samples,
+                                len(self.channels)).mean(axis=(1, 3))
+        self.grid = grid
+
+    def draw_trajectory(self, rel, layer, wants, to_grid, scale):
+        """
+        Draws the direction, direction pixel and direction edge channels
+        """
+        gd = self.grid_dim
         point = (int(gd/6), int(gd/2))
         edge_point = None
 
         def is_on_screen(point, gd):
             return 0 <= point[0] < gd and 0 <= point[1] < gd
         
+        # Lines and circles are centered on the middle of their pixels
         line_width = 20
-        for p in self.car.waypoints:
-            relp = p.get_relative(rel)
-            new_point = int(relp.x), int(relp.y)
+        lines = []
+        # The center of a relative shape is the mean of its exterior coordinates
+        centers = self.car.state.waypoint_graph.centers[self.car.route]
+        for relx, rely in to_frame(centers, rel):
+            new_point = int(relx), int(rely)
             if not edge_point and is_on_screen(point, gd) and not is_on_screen(new_point, gd):
                 edge_point = new_point
+                if not wants(GRID_DIRECTION):
+                    break
 
-            pygame.draw.line(direction_window, (255, 255, 255), point, new_point, line_width)
+            lines.append(to_grid(segment_polygon(point[0] + 0.5, point[1] + 0.5,
+                                                 new_point[0] + 0.5, new_point[1] + 0.5,
+                                                 line_width)))
             point = new_point
+        if wants(GRID_DIRECTION):
+            fill_polygons(layer(GRID_DIRECTION), lines)
         
         if edge_point:
             edge_point = (min(gd - 1, max(0, edge_point[0])), min(gd - 1, max(0, edge_point[1])))
-            pygame.draw.circle(direction_pixel_window, (255, 255, 255), edge_point, line_width)
-        
-        if edge_point:
+        if edge_point and wants(GRID_DIRECTION_PIXEL):
+            x, y = to_grid((edge_point[0] + 0.5, edge_point[1] + 0.5))[0]
+            fill_disk(layer(GRID_DIRECTION_PIXEL), x, y, line_width * scale)
+
+        # Bands along the side of the grid the trajectory leaves through
+        if edge_point and wants(GRID_DIRECTION_EDGE):
+            half = line_width // 2
+            bands = []
             if edge_point[0] == 0:
-                pygame.draw.line(direction_edge_window, (255, 255, 255), (0, 0), (0, gd - 1), line_width)
+                bands.append((0, 0, half, gd))
             if edge_point[0] == gd - 1:
-                pygame.draw.line(direction_edge_window, (255, 255, 255), (gd - 1, 0), (gd - 1, gd - 1), line_width)
+                bands.append((gd - half, 0, gd, gd))
             if edge_point[1] == 0:
-                pygame.draw.line(direction_edge_window, (255, 255, 255), (0, 0), (gd - 1, 0), line_width)
+                bands.append((0, 0, gd, half))
             if edge_point[1] == gd - 1:
-                pygame.draw.line(direction_edge_window, (255, 255, 255), (0, gd - 1), (gd - 1, gd - 1), line_width)
-
-
-        self.pygame_rep = [pygame.transform.rotate(window, 90) for window in [terrain_window,
-                                                                              drivable_window,
-                                                                              undrivable_window,
-                                                                              car_window,
-                                                                              ped_window,
-                                                                              light_window_red,
-                                                                              light_window_green,
-                                                                              light_window_yellow,
-                                                                              direction_window,
-                                                                              direction_pixel_window,
-                                                                              direction_edge_window
-                                                                              ]]
+                bands.append((0, gd - half, gd, gd))
+            fill_polygons(layer(GRID_DIRECTION_EDGE),
+                          [to_grid([(x0, y0), (x1, y0), (x1, y1), (x0, y1)])
+                           for x0, y0, x1, y1 in bands])
 
     def render(self, surface):
         self.grid_square.render(surface, border=10)
@@ -154,111 +289,21 @@ class GridObservation(FluidsObs):
             if self.car.vis_level > 4:
                 for obj in self.all_collideables:
                     obj.render_debug(surface)
+            pygame_rep = [pygame.surfarray.make_surface((self.grid[:, :, i] * 255).astype(np.uint8))
+                          for i in range(self.grid.shape[2])]
+            if self.shape != (self.grid_dim, self.grid_dim):
+                pygame_rep = [pygame.transform.scale(rep, (self.grid_dim, self.grid_dim))
+                              for rep in pygame_rep]
             for y in range(4):
                 for x in range(2):
                     i = y + x * 4
-                    if i < len(self.pygame_rep):
-                        surface.blit(self.pygame_rep[i], (surface.get_size()[0] - self.grid_dim * (x+1), self.grid_dim * y))
+                    if i < len(pygame_rep):
+                        surface.blit(pygame_rep[i], (surface.get_size()[0] - self.grid_dim * (x+1), self.grid_dim * y))
                         pygame.draw.rect(surface, (200, 0, 0),
                                          pygame.Rect((surface.get_size()[0] - self.grid_dim*(x+1)-5, 0-5+self.grid_dim*y),
                                                      (self.grid_dim+10, self.grid_dim+10)), 10)
 
     def get_array(self):
-        arr = np.zeros((self.grid_dim, self.grid_dim, len(self.pygame_rep)))
-        for i in range(len(self.pygame_rep)):
-            arr[:,:,i] = pygame.surfarray.array2d(self.pygame_rep[i]) != 0
-            # print(pygame.surfarray.array2d(self.pygame_rep[i]) != 0)
-            
-        if self.downsample:
-            arr = self.sp_imresize(arr, self.shape)
-        return arr
-    
-    def sp_imresize(self, arr, shape):
-        return np.array([imresize(arr[:,:,i],shape) for i in range(arr.shape[2])]).T
-            
-    # def label_distribution_from_block(self, arr, start, end):
-    #     """Returns the distribution of labels in a block from arr.
-
-    #     If start or end are floats, the distribution includes weighted elements
-    #     on the edge of the block.
-
-    #     Args:
-    #         arr (np.ndarray): 3D array from which to obtain the block where the
-    #             3rd dimension is a one-hot encoded vector of labels.
-    #         start (tuple of floats): top left corner of the block.
-    #         end (tuple of floats): bottom right corner of block.
-
-    #     Returns:
-    #         Array containing the distribution of labels.
-    #     """
-    #     assert len(start) == len(end) == 2
-    #     assert len(arr.shape) == 3
-    #     start = np.array(start)
-    #     end = np.array(end)
-
-    #     start_idx = np.ceil(start).astype(np.int)
-    #     end_idx = np.floor(end).astype(np.int)
-
-    #     counts = np.sum(arr[start_idx[0]:end_idx[0], start_idx[1]:end_idx[1]],
-    #                     axis=(0, 1))
-
-    #     NUM_DECIMALS = 7    # Prevents floating point errors
-    #     top_weight, left_weight = np.round(-start % 1, NUM_DECIMALS)
-    #     bottom_weight, right_weight = np.round(end, NUM_DECIMALS) % 1
-
-    #     counts = counts.astype(np.float)
-
-    #     # Edges not including corners
-    #     if top_weight > 1e-4:   # Tolerate floating point errors with small numbers
-    #         counts += top_weight * \
-    #                 np.sum(arr[start_idx[0] - 1, start_idx[1]:end_idx[1]], axis=0)
-    #     if bottom_weight > 1e-4:
-    #         counts += bottom_weight * \
-    #                 np.sum(arr[end_idx[0], start_idx[1]:end_idx[1]], axis=0)
-    #     if left_weight > 1e-4:
-    #         counts += left_weight * \
-    #                 np.sum(arr[start_idx[0]:end_idx[0], start_idx[1] - 1],
-    #                        axis=0)
-    #     if right_weight > 1e-4:
-    #         counts += right_weight * \
-    #                 np.sum(arr[start_idx[0]:end_idx[0], end_idx[1]],
-    #                        axis=0)
-    #     # Corners
-    #     if top_weight and left_weight:
-    #         counts += top_weight * left_weight * arr[start_idx[0], start_idx[1]]
-    #     if top_weight and right_weight:
-    #         counts += top_weight * right_weight * arr[start_idx[0], end_idx[1]]
-    #     if bottom_weight and left_weight:
-    #         counts += bottom_weight * left_weight * arr[end_idx[0], start_idx[1]]
-    #     if bottom_weight and right_weight:
-    #         counts += bottom_weight * right_weight * arr[end_idx[0], end_idx[1]]
-
-    #     return counts / np.sum(counts)
-
-    # def to_low_res_truth(self, labeled_img, shape, nsamples=None):
-    #     """Calculates the distrubution of each region.
-
-    #     Uses the area of intersection between each pixel and the larger low-res
-    #     region to weight each label in order to construct the distribution.
-
-    #     Args:
-    #         labeled_img (np.ndarray): 3D array from which to obtain the block
-    #             where the 3rd dimension is a one-hot encoded vector of labels.
-    #         shape (tuple of length 2): output resolution.
-    #         nsamples: dummy argument to mantain API consistency.
-
-    #     Returns:
-    #         Low resolution array where the 3rd dimension contains the distribution
-    #         of labels present within the high resolution elements corresponding
-    #         to the location in the low resolution array.
-    #     """
-    #     assert len(labeled_img.shape) == 3
-
-    #     row_step, col_step = np.divide(labeled_img.shape[0:2], shape)
-
-    #     low_res = np.array([[self.label_distribution_from_block(
-    #                             labeled_img, (i, j), (i + row_step, j + col_step))
-    #                          for j in np.arange(0, labeled_img.shape[1], col_step)]
-    #                         for i in np.arange(0, labeled_img.shape[0], row_step)])
-
-    #     return low_res
+        if self.packed:
+            return pack_grid(self.grid)
+        return self.grid.astype(self.dtype)
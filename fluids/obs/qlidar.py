@@ -1,10 +1,9 @@
 from six import iteritems
 import numpy as np
 import pygame
-import shapely
 
 from fluids.obs.obs import FluidsObs
-from fluids.utils import distance, fluids_assert
+from fluids.utils import fluids_assert, ray_polygon_distances
 
 
 class QLidarObservation(FluidsObs):
@@ -33,7 +32,7 @@ class QLidarObservation(FluidsObs):
                  ped_buffer=0,
                  layers=None,
                  goal_distance=4):
-        from fluids.assets import Shape, Pedestrian, Car
+        from fluids.assets import Shape, Pedestrian
 
         state = car.state
 
@@ -45,22 +44,35 @@ class QLidarObservation(FluidsObs):
                                  angle=car.angle,
                                  color=None)
 
+        # Static hits come from the state's segment grid. Dynamic candidates come
+        #  from the spatial index, and their polygons are intersected with every
+        #  beam at once
+        scene = state.get_observation_scene()
         self.all_collideables = []
         if layers == None:
             layers = [self.car.collideables]
-        layer_collideables = [[] for l in layers]
-        for c in self.car.collideables:
-            for k, obj in iteritems(state.type_map[c]):
-                if car.can_collide(obj) and self.grid_square.intersects(obj):
-                    self.all_collideables.append(obj)
-                    for l in range(len(layers)):
-                        if c in layers[l]:
-                            layer_collideables[l].append(obj)
+        static_allowed = np.array([[type(obj) in layer and type(obj) in self.car.collideables
+                                    and car.can_collide(obj)
+                                    for obj in state.static_segment_groups]
+                                   for layer in layers], dtype=bool)
+        polygons = []
+        in_layer = []
+        for k in scene.query(self.grid_square, static=False):
+            obj = state.objects[k]
+            if type(obj) in self.car.collideables and car.can_collide(obj):
+                self.all_collideables.append(obj)
+                if ped_buffer and type(obj) == Pedestrian:
+                    coords = np.array(obj.shapely_obj.buffer(ped_buffer).exterior.coords)[:, :2]
+                else:
+                    coords = scene.coords(k)
+                polygons.append(coords)
+                in_layer.append([type(obj) in layer for layer in layers])
+        in_layer = np.array(in_layer, dtype=bool).reshape(-1, len(layers))
 
 
         x, y = car.x, car.y
-        goal_distance = min(goal_distance, len(car.waypoints)-1)
-        goal_wp = car.waypoints[goal_distance]
+        goal_distance = min(goal_distance, len(car.route)-1)
+        goal_wp = car.waypoint(goal_distance)
         goalx, goaly = goal_wp.x, goal_wp.y
 
 
@@ -80,37 +92,19 @@ class QLidarObservation(FluidsObs):
             beam_deltas = np.array(beam_distribution) * np.pi
         else:
             beam_deltas = np.linspace(-1, 1, n_beams + 1) * np.pi
-        self.linestrings = []
-        self.detections = []
-        for beam_delta in beam_deltas:
-            beam_angle = (car.angle + beam_delta) % (2 * np.pi)
-
-            xd = x + np.cos(beam_angle) * det_range
-            yd = y - np.sin(beam_angle) * det_range
-            linestring = shapely.geometry.LineString([(x, y), (xd, yd)])
-            self.linestrings.append((beam_delta, linestring))
-
-            min_coll_ds = []
-            for i in range(len(layers)):
-                min_coll_d = det_range
-                for obj in layer_collideables[i]:
-                    other_shape = obj.shapely_obj
-                    if (ped_buffer and type(obj) == Pedestrian):
-                        other_shape = other_shape.buffer(ped_buffer)
-                    isect = linestring.intersection(other_shape)
-                    if not isect.is_empty:
-                        d = distance((x, y), list(isect.coords)[0])
-                        if d < min_coll_d:
-                            min_coll_d = d
-
-
-                min_coll_ds.append(min_coll_d)
-            d_gangle = min(abs(beam_angle - gangle),
-                    2*np.pi - abs(beam_angle - gangle))
-            min_coll_ds.append(d_gangle)
-            self.detections.append(min_coll_ds)
-
-        self.detections = np.array(self.detections)
+        self.beam_deltas = beam_deltas
+        beam_angles = (car.angle + beam_deltas) % (2 * np.pi)
+
+        # Closest hit of every beam in every layer, capped at det_range
+        static_hits = state.static_segments.cast(x, y, beam_angles, det_range, static_allowed)
+        hits = ray_polygon_distances(x, y, beam_angles, det_range, polygons)
+        self.detections = [np.where(in_layer[:, l], hits, np.inf).min(axis=1, initial=det_range)
+                           for l in range(len(layers))]
+        self.detections = [np.minimum(d, static_hits[:, l])
+                           for l, d in enumerate(self.detections)]
+        d_gangle = np.abs(beam_angles - gangle)
+        self.detections.append(np.minimum(d_gangle, 2 * np.pi - d_gangle))
+        self.detections = np.stack(self.detections, axis=1)
 
         min_angle_index = min(enumerate(self.detections[:,1]), key=lambda x:x[1])[0]
         self.detections[:,1] = 0
@@ -135,8 +129,7 @@ class QLidarObservation(FluidsObs):
             #                    (int(self.goalx), int(self.goaly)),
             #                    10)
 
-            for det, (beam_delta, ls) in \
-                zip(self.detections, self.linestrings):
+            for det, beam_delta in zip(self.detections, self.beam_deltas):
 
                 # pygame.draw.line(surface, (0, 255, 0),
                 #                  (self.car.x, self.car.y),
@@ -0,0 +1,65 @@
+import numpy as np
+
+from fluids.utils import rotation_array, shape_bounds
+
+
+class ObservationScene(object):
+    """
+    Work shared by the observations of every car during one step of a State.
+
+    Candidate objects are found with the state's spatial indices instead of a scan
+    over every object, and the exterior coordinates of each object are only read
+    from shapely once: once per state for static objects and once per step for
+    dynamic objects.
+
+    Parameters
+    ----------
+    state: fluids.State
+        State to observe
+    static_coords: dict of (key -> np.array), optional
+        Exterior coordinates of static objects from an earlier scene of the same state
+    """
+    def __init__(self, state, static_coords=None):
+        self.state          = state
+        self.time           = state.time
+        self.static_coords  = {} if static_coords is None else static_coords
+        self.dynamic_coords = {}
+
+    def query(self, shape, static=True):
+        """
+        Returns the keys of all objects intersecting shape, in the order objects
+        were added to the state. Static objects are skipped unless static is set.
+        """
+        state = self.state
+        bounds = shape_bounds(shape)
+        keys = state.dynamic_index.query(bounds)
+        if static:
+            keys = keys | state.static_index.query(bounds)
+        return [k for k in sorted(keys) if shape.intersects(state.objects[k])]
+
+    def coords(self, key):
+        """
+        Returns the exterior coordinates of object key as an (n, 2) array
+        """
+        cache = self.static_coords if key in self.state.static_objects \
+            else self.dynamic_coords
+        if key not in cache:
+            coords = np.array(self.state.objects[key].shapely_obj.exterior.coords)
+            cache[key] = coords[:, :2]
+        return cache[key]
+
+    def relative_coords(self, key, rel):
+        """
+        Returns the exterior coordinates of object key in the frame rel, which is
+        an (x, y, angle) tuple. Matches Shape.get_relative.
+        """
+        return to_frame(self.coords(key), rel)
+
+
+def to_frame(coords, rel):
+    """
+    Transforms an (n, 2) array of world coordinates into the frame rel, an
+    (x, y, angle) tuple
+    """
+    x, y, angle = rel
+    return (coords - np.array([x, y])).dot(rotation_array(-angle))
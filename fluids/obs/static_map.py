@@ -0,0 +1,145 @@
+import numpy as np
+from six import iteritems
+
+from fluids.utils import fill_polygons, load_npz
+
+
+class StaticMap(object):
+    """
+    World frame raster of the static objects of a State.
+
+    Terrain, sidewalks, ped crossings, lanes and streets never move, so they are
+    drawn once per layout and every observation crops its window out of the map
+    instead of drawing them for every car on every step. One pixel covers one
+    world unit, and a pixel is set when its center is inside an object.
+
+    Layers:
+
+    - terrain: bool, Terrain, Sidewalk and PedCrossing
+    - street: bool, Street
+    - lanes: uint8 bitmask of shape (n_bytes, H, W). Lanes are grouped by angle
+      and color, and bit g % 8 of byte g // 8 is set where a lane of group g lies.
+
+    Parameters
+    ----------
+    state: fluids.State
+        State whose static objects are drawn
+    layers: dict of (str -> np.array), optional
+        Previously drawn layers of the same layout, as returned by get_layers
+    """
+    LAYERS = ("origin", "terrain", "street", "lanes")
+
+    def __init__(self, state, layers=None):
+        from fluids.assets import Lane
+        # Whether a car may drive on a lane only depends on the lane's angle,
+        #  so one lane stands in for its whole group
+        self.lane_groups = {}
+        for k, lane in iteritems(state.type_map[Lane]):
+            self.lane_groups.setdefault((lane.angle, lane.color), []).append(lane)
+        self.lane_groups = list(self.lane_groups.values())
+
+        if layers is None:
+            layers = self.draw(state)
+        for name in self.LAYERS:
+            setattr(self, name, layers[name])
+        self.height, self.width = self.terrain.shape
+
+    def draw(self, state):
+        from fluids.assets import Terrain, Sidewalk, PedCrossing, Street
+        # The map has an empty border pixel, which windows sample past its edges
+        objs = list(state.static_objects.values())
+        origin = np.floor([min(o.minx for o in objs), min(o.miny for o in objs)]) - 1
+        width = int(np.ceil(max(o.maxx for o in objs) - origin[0])) + 1
+        height = int(np.ceil(max(o.maxy for o in objs) - origin[1])) + 1
+
+        def coords(obj):
+            return np.array(obj.shapely_obj.exterior.coords)[:, :2] - origin
+
+        def mask(objs):
+            out = np.zeros((height, width), dtype=bool)
+            return fill_polygons(out, [coords(o) for o in objs if o.color])
+
+        def of_type(typ):
+            return list(state.type_map[typ].values())
+
+        lanes = np.zeros((max(1, (len(self.lane_groups) + 7) // 8), height, width),
+                         dtype=np.uint8)
+        for g, group in enumerate(self.lane_groups):
+            lanes[g // 8][mask(group)] |= np.uint8(1 << (g % 8))
+        return {"origin" : origin,
+                "terrain": mask(of_type(Terrain) + of_type(Sidewalk) + of_type(PedCrossing)),
+                "street" : mask(of_type(Street)),
+                "lanes"  : lanes}
+
+    def get_layers(self):
+        return {name: getattr(self, name) for name in self.LAYERS}
+
+    def save(self, outfile):
+        """
+        Writes the layers uncompressed, so that load can memory map them
+
+        Parameters
+        ----------
+        outfile: str or file
+            File name or binary file object
+        """
+        np.savez(outfile, **self.get_layers())
+
+    @classmethod
+    def load(cls, fname, state):
+        """
+        Memory maps layers written by save. They are read only, and shared by
+        every process that loads the same file.
+        """
+        return cls(state, load_npz(fname))
+
+    def window(self, rel, size, shape=None):
+        """
+        Finds the map pixels under a size x size observation window, drawn at
+        shape pixels. Window pixel (i, j) has its center at
+        (size - (j + 0.5) * size / shape[1], (i + 0.5) * size / shape[0]) in the
+        frame rel, an (x, y, angle) tuple, which is how GridObservation arrays are
+        laid out. Sampling is nearest neighbor, and pixels past the edges of the
+        map sample its empty border.
+
+        Returns
+        -------
+        np.array of int with shape shape, the flat map index of every window pixel
+        """
+        x, y, angle = rel
+        h, w = (size, size) if shape is None else shape
+        rx = size - (np.arange(w) + 0.5) * (size / float(w))
+        ry = (np.arange(h) + 0.5) * (size / float(h))
+        cosa, sina = np.cos(angle), np.sin(angle)
+        # Single precision is exact to well under a pixel on any layout, and much
+        #  faster. Truncation only differs from floor below zero, which is clipped
+        #  to the border.
+        cols = np.add.outer((ry * sina).astype(np.float32),
+                            (x - self.origin[0] + rx * cosa).astype(np.float32))
+        rows = np.add.outer((ry * cosa).astype(np.float32),
+                            (y - self.origin[1] - rx * sina).astype(np.float32))
+        cols = np.clip(cols.astype(np.int32), 0, self.width - 1)
+        rows = np.clip(rows.astype(np.int32), 0, self.height - 1)
+        rows *= self.width
+        rows += cols
+        return rows.astype(np.intp)
+
+    def crop(self, layer, window):
+        """
+        Samples a layer under a window from the window method
+        """
+        layer = getattr(self, layer)
+        return np.take(layer.reshape((self.height * self.width,) + layer.shape[2:]),
+                       window, axis=0)
+
+    def lane_mask(self, window, groups):
+        """
+        Returns where lanes from any of the given lane groups lie under a window
+        """
+        select = np.zeros(len(self.lanes), dtype=np.uint8)
+        for g in groups:
+            select[g // 8] |= np.uint8(1 << (g % 8))
+        mask = np.zeros(window.shape, dtype=bool)
+        for b in np.flatnonzero(select):
+            mask |= (np.take(self.lanes[b].ravel(), window) & select[b]) != 0
+        return mask
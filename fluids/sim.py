@@ -3,7 +3,6 @@ import json
 import pygame
 from pygame.locals import DOUBLEBUF
 from six import iteritems
-from ortools.constraint_solver import pywrapcp
 from copy import deepcopy
 
 from shapely import speedups
@@ -14,6 +13,7 @@ if speedups.available:
 
 from fluids.state import State
 from fluids.assets import *
+from fluids.assets.car import batch_raw_step
 from fluids.utils import *
 from fluids.actions import *
 from fluids.consts import *
@@ -48,6 +48,21 @@ class FluidSim(object):
         fluids.BIRDSEYE or fluids.NONE
     screen_dim: int
         Height of the visualization screen. Default is 800
+    background_control: str
+        How background cars and pedestrians are planned. fluids.BACKGROUND_CSP
+        solves a constraint satisfaction problem with ortools every step.
+        fluids.BACKGROUND_PRIORITY makes the same move/stop decisions greedily,
+        letting the agents that have waited longest go first, without a solver.
+        fluids.BACKGROUND_NULL disables background planning.
+    integrator: str
+        How car dynamics are integrated. fluids.INTEGRATOR_ODEINT integrates each car
+        separately with scipy's odeint. fluids.INTEGRATOR_BATCH advances all cars
+        together with a vectorized RK4 integrator, which is much faster with many cars.
+    planner_pool: multiprocessing.pool.ThreadPool or multiprocessing.pool.Pool
+        If set, the background planner solves large clusters of interacting agents
+        on this pool. Default is None, which solves every cluster in this process
+    planner_pool_min_size: int
+        Number of agents a cluster needs before it is sent to planner_pool
     """
     def __init__(self,
                  visualization_level =1,
@@ -57,6 +72,9 @@ class FluidSim(object):
                  background_control  =BACKGROUND_NULL,
                  reward_fn           =REWARD_PATH,
                  screen_dim          =800,
+                 integrator          =INTEGRATOR_ODEINT,
+                 planner_pool        =None,
+                 planner_pool_min_size=16,
                  ):
 
         self.state                 = None
@@ -74,12 +92,16 @@ class FluidSim(object):
         self.reward_fn             = {REWARD_PATH    : path_reward,
                                       REWARD_NONE    : lambda s : 0}[reward_fn]
         self.background_control    = background_control
+        self.integrator            = integrator
         self.vis_level             = visualization_level
         self.fps                   = fps
         self.last_keys_pressed     = None
         self.last_obs              = {}
         self.next_actions          = {}
         self.data_saver = None
+        self.planner_pool          = planner_pool
+        self.planner_pool_min_size = planner_pool_min_size
+        self.planner_stats = {}
 
         self.collision_count = 0
         self.reached_goal = False
@@ -208,10 +230,8 @@ class FluidSim(object):
         for k in list(self.next_actions):
             if k in car_keys and k in actions:
                 if type(actions[k]) == SteeringAction:
-                    actions[k] = SteeringAccAction(
-                        actions[k].steer,
-                        self.state.dynamic_objects[k].PIDController(self.next_actions[k],
-                                                                    update=False).acc)
+                    actions[k] = SteeringAccAction(actions[k].steer,
+                                                   self.supervisor_control(k).acc)
                 self.next_actions.pop(k)
         self.next_actions.update(actions)
         for k, v in iteritems(self.next_actions):
@@ -228,9 +248,13 @@ class FluidSim(object):
 
 
         # Simulate the objects
-        for k, v in iteritems(self.state.dynamic_objects):
-            self.state.objects[k].step(self.next_actions[k] if k in self.next_actions \
-                                       else None)
+        if self.integrator == INTEGRATOR_BATCH:
+            self.batch_step_objects()
+        else:
+            for k, v in iteritems(self.state.dynamic_objects):
+                self.state.objects[k].step(self.next_actions[k] if k in self.next_actions \
+                                           else None)
+        self.state.update_dynamic_index()
 
         self.state.time += 1
 
@@ -258,6 +282,27 @@ class FluidSim(object):
         self.save_data()
 
         return reward_step
+    def batch_step_objects(self):
+        """
+        Steps all dynamic objects, integrating the dynamics of every car in one batch
+        """
+        cars, controls = [], []
+        for k, v in iteritems(self.state.dynamic_objects):
+            obj = self.state.objects[k]
+            if type(obj) == Car:
+                cars.append(obj)
+                controls.append(obj.begin_step(self.next_actions[k] if k in self.next_actions \
+                                               else None))
+        batch_raw_step(cars, controls)
+
+        # Remaining work happens in the same order as unbatched stepping
+        for k, v in iteritems(self.state.dynamic_objects):
+            obj = self.state.objects[k]
+            if type(obj) == Car:
+                obj.end_step()
+            else:
+                obj.step(self.next_actions[k] if k in self.next_actions else None)
+
     def get_observations(self, keys={}):
         """
         Get observations from controlled cars in the scene.
@@ -272,12 +317,33 @@ class FluidSim(object):
             Dictionary mapping keys of controlled cars to FluidsObs object
         """
         fluids_assert(self.state, "get_observations called without setting the state")
-        observations = {k:self.state.objects[k].make_observation(self.obs_space,
-                                                                 **self.obs_args)
+        observations = {k:self.state.get_observation(k, self.obs_space, **self.obs_args)
                         for k in keys}
         self.last_obs = observations
         return observations
 
+    def get_observation_array(self, keys={}):
+        """
+        Get observations from controlled cars in the scene as one array.
+        Work shared between cars, like finding nearby objects and reading their
+        geometry, is only done once per step.
+
+        Parameters
+        ----------
+        keys: iterable of keys
+            Keys should refer to cars in the scene
+        Returns
+        -------
+        np.array
+            Array of shape (n_cars, ...) stacking the array representation of
+            each car's observation, in the order of keys
+        """
+        fluids_assert(self.obs_space != OBS_NONE,
+                      "get_observation_array called without an observation space")
+        keys = list(keys)
+        observations = self.get_observations(keys)
+        return np.stack([observations[k].get_array() for k in keys])
+
     def get_supervisor_actions(self, action_type=SteeringAccAction, keys={}):
         """
         Get the actions assigned to the selected car by the FLUIDS multiagent planer
@@ -297,158 +363,184 @@ class FluidSim(object):
         if action_type == VelocityAction:
             return {k:self.next_actions[k] for k in keys}
         elif action_type == SteeringAccAction:
-            return {k:self.state.dynamic_objects[k].PIDController(self.next_actions[k],
-                                                                  update=False)
-                    for k in keys}
+            return {k:self.supervisor_control(k) for k in keys}
         elif action_type == SteeringAction:
-            return {k:self.state.dynamic_objects[k].PIDController(
-                self.next_actions[k],
-                update=False).asSteeringAction() for k in keys}
+            return {k:self.supervisor_control(k).asSteeringAction() for k in keys}
         elif action_type == SteeringVelAction:
-            return {k:SteeringVelAction(self.state.dynamic_objects[k].PIDController(
-                self.next_actions[k], update=False).get_action()[0],
-                                    self.next_actions[k].get_action())
+            return {k:SteeringVelAction(self.supervisor_control(k).get_action()[0],
+                                        self.next_actions[k].get_action())
                     for k in keys}
         else:
             fluids_assert(false, "Illegal action type")
 
+    def supervisor_control(self, k):
+        """
+        Returns the SteeringAccAction the PID controller of car k would take to
+        follow its planned velocity, computed once per step
+        """
+        action = self.next_actions[k]
+        return self.state.memoize(
+            ("pid", k, freeze(action.get_action())),
+            lambda: self.state.dynamic_objects[k].PIDController(action, update=False))
+
     def multiagent_plan(self):
         if self.background_control == BACKGROUND_NULL:
             return {}
 
         # "Futures" represents the future zones where the car will occupy if the car
         #     chooses to move
-        # "Buffered_objs" represents a buffered region around the car, which is
+        # "Stops" represents a buffered region around the car, which is
         #     approximately where the car will occupy if it chooses to stop
-        futures            = { k:o.get_future_shape() \
-                               for k, o in iteritems(self.state.type_map[Car])}
-        futures_lights     = [(o, o.get_future_color()) \
-                              for k, o in iteritems(self.state.type_map[TrafficLight])]
-        futures_crosswalks = [(o, o.get_future_color()) \
-                              for k, o in iteritems(self.state.type_map[CrossWalkLight])]
-        futures_peds       = { k:o.get_future_shape() \
-                               for k, o in iteritems(self.state.type_map[Pedestrian])}
-        buffered_objs      = { k: o.shapely_obj.buffer(10) \
-                               for k, o in iteritems(self.state.type_map[Car])}
-
-
-        keys = list(futures.keys())
-        ped_keys = list(futures_peds.keys())
-
-        # Create the CSP solver for this instance of the problem
-        solver = pywrapcp.Solver("FLUIDS Background CSP")
-
-        # Maps fluids object keys to CSP solver "variable" objects
-        var_map = {}
-
-        for k in futures:
-            # For all cars, possible vel values are (-1, 0, 1)
-            # Technically only 0 and 1 are allowed, but restricting
-            #   values to 0/1 will result in unsolvable problems occasionaly
-            # To avoid fatal crashes when this happens, let "-1" be adummy value
-            var = solver.IntVar(-1, 1, str(k))
-            var_map[k] = var
-
-        for k in futures_peds:
-            # Pedestrian velocities are 0 or 1
-            var = solver.IntVar(0, 1, str(k))
-            var_map[k] = var
-
-        fast_map = {}
-        might_collide = False
-        # For every car1-car2 pair,
-        for k1x in range(len(keys)):
-            k1 = keys[k1x]
-            k1v = var_map[k1]
-            car1 = self.state.objects[k1]
-            for k2x in range(k1x + 1, len(keys)):
-                k2 = keys[k2x]
-                k2v = var_map[k2]
-                car2 = self.state.objects[k2]
-
-                # If there is no possibility of these car's colliding,
-                #  we don't generate a constraint
-                might_collide = futures[k1].intersects(futures[k2])
-                if might_collide:
-
-                    # f1 is True if there is no collision when car2 moves and car1 stops
-                    # f2 is True if there is no collision when car1 moves and car2 stops
-                    f1 = not futures[k2].intersects(buffered_objs[k1])
-                    f2 = not futures[k1].intersects(buffered_objs[k2])
-
-                    # We know at this point that if both cars move, there is collision,
-                    #  so add a constraint for that here
-                    solver.Add(k1v + k2v < 2)
-
-                    # If car2 will collide when it moves, prevent it from moving
-                    if not f1:
-                        solver.Add((k2v == 1) == False)
-
-                    # If car1 will collide when it moves, prevent it from moving
-                    if not f2:
-                        solver.Add((k1v == 1) == False)
-
-            # For every car-ped pair
-            for k2x in range(len(ped_keys)):
-                k2 = ped_keys[k2x]
-                k2v = var_map[k2]
-                ped2 = self.state.objects[k2]
-                #might_collide = futures[k1].intersects(futures_peds[k2])
-
-                # Same logic as for car-car interactions
-                if might_collide:
-                    f1 = not futures_peds[k2].intersects(buffered_objs[k1])
-                    f2 = not futures[k1].intersects(ped2.shapely_obj)
-                    solver.Add(k1v + k2v < 2)
-                    if not f1:
-                        solver.Add((k2v == 1) == False)
-                    if not f2:
-                        solver.Add((k1v == 1) == False)
-
-            # For every car-light pair
-            for fl, flc in futures_lights:
-                # If the light will be rec, and the car will collide with it when it moves,
-                #  limit the movement of the car
-                if flc == "red" and futures[k1].intersects(fl.shapely_obj) \
-                   and not car1.intersects(fl):
-                    solver.Add(k1v == 0)
+        # Every zone is a set of rounded boxes, so the tests between them run
+        #     through NumPy in one batch per kind of test
+        keys     = list(self.state.type_map[Car].keys())
+        ped_keys = list(self.state.type_map[Pedestrian].keys())
+        cars     = [self.state.objects[k] for k in keys]
+        peds     = [self.state.objects[k] for k in ped_keys]
+        red_lights = [o for k, o in iteritems(self.state.type_map[TrafficLight])
+                      if o.get_future_color() == "red"]
+
+        def pack(piece_lists):
+            # Rounded boxes of every zone, with the bounds of every zone
+            offsets = np.cumsum([0] + [len(p) for p in piece_lists])
+            boxes = np.concatenate([np.reshape(p, (-1, 9)) for p in piece_lists]
+                                   + [np.zeros((0, 9))]).astype(np.float64)
+            ex, ey = boxes[:, 6] + boxes[:, 8], boxes[:, 7] + boxes[:, 8]
+            bounds = np.zeros((len(piece_lists), 4))
+            if len(boxes):
+                bounds = np.stack([np.minimum.reduceat(boxes[:, 0] - ex, offsets[:-1]),
+                                   np.minimum.reduceat(boxes[:, 1] - ey, offsets[:-1]),
+                                   np.maximum.reduceat(boxes[:, 0] + ex, offsets[:-1]),
+                                   np.maximum.reduceat(boxes[:, 1] + ey, offsets[:-1])], axis=1)
+            return boxes, offsets, bounds
+
+        futures, future_offsets, car_bounds = pack([o.get_future_pieces() for o in cars])
+        ped_futures, ped_offsets, ped_bounds = pack([o.get_future_pieces() for o in peds])
+        stops, stop_offsets, _  = pack([[o.box + (10,)] for o in cars])
+        bodies, body_offsets, _ = pack([[o.box + (0,)] for o in peds])
+        lights, light_offsets, light_bounds = pack([[o.box + (0,)] for o in red_lights])
+
+        # Broadphase: exact intersection tests are only run for pairs whose
+        #  bounding boxes overlap
+        car_pairs    = np.triu(bounds_overlap(car_bounds, car_bounds), 1)
+        ped_pairs    = bounds_overlap(car_bounds, ped_bounds)
+        light_pairs  = bounds_overlap(car_bounds, light_bounds)
+
+        n_cars = len(keys)
+        self.planner_stats = {
+            "car_pairs_tested"   : int(car_pairs.sum()),
+            "car_pairs_pruned"   : n_cars * (n_cars - 1) // 2 - int(car_pairs.sum()),
+            "ped_pairs_tested"   : int(ped_pairs.sum()),
+            "ped_pairs_pruned"   : ped_pairs.size - int(ped_pairs.sum()),
+            "light_pairs_tested" : int(light_pairs.sum()),
+            "light_pairs_pruned" : light_pairs.size - int(light_pairs.sum()),
+        }
+
+        # For all cars, possible vel values are (-1, 0, 1)
+        #   Technically only 0 and 1 are allowed, but restricting
+        #   values to 0/1 will result in unsolvable problems occasionaly
+        #   To avoid fatal crashes when this happens, let "-1" be adummy value
+        # Pedestrian velocities are 0 or 1
+        # Agents are branched on in reverse order of creation, which is the
+        #   order the single CSP over all agents used
+        graph = ConflictGraph(list(reversed(keys + ped_keys)),
+                              [0] * len(ped_keys) + [-1] * len(keys))
+
+        # For every car1-car2 pair whose futures intersect, both cars moving is a
+        #  collision.
+        # f1 is True if there is no collision when car2 moves and car1 stops
+        # f2 is True if there is no collision when car1 moves and car2 stops
+        # If car2 will collide when it moves, prevent it from moving, and the
+        #  same for car1
+        k1x, k2x = np.nonzero(car_pairs)
+        hit = rounded_box_sets_intersect(futures, future_offsets, futures, future_offsets,
+                                         k1x, k2x)
+        k1x, k2x = k1x[hit], k2x[hit]
+        f1 = ~rounded_box_sets_intersect(futures, future_offsets, stops, stop_offsets,
+                                         k2x, k1x)
+        f2 = ~rounded_box_sets_intersect(futures, future_offsets, stops, stop_offsets,
+                                         k1x, k2x)
+        for a, b, free1, free2 in zip(k1x.tolist(), k2x.tolist(), f1.tolist(), f2.tolist()):
+            graph.add_conflict(keys[a], keys[b])
+            if not free1:
+                graph.block(keys[b])
+            if not free2:
+                graph.block(keys[a])
+
+        # For every car-ped pair, with the same logic as for car-car interactions
+        k1x, k2x = np.nonzero(ped_pairs)
+        hit = rounded_box_sets_intersect(futures, future_offsets, ped_futures, ped_offsets,
+                                         k1x, k2x)
+        k1x, k2x = k1x[hit], k2x[hit]
+        f1 = ~rounded_box_sets_intersect(ped_futures, ped_offsets, stops, stop_offsets,
+                                         k2x, k1x)
+        f2 = ~rounded_box_sets_intersect(futures, future_offsets, bodies, body_offsets,
+                                         k1x, k2x)
+        for a, b, free1, free2 in zip(k1x.tolist(), k2x.tolist(), f1.tolist(), f2.tolist()):
+            graph.add_conflict(keys[a], ped_keys[b])
+            if not free1:
+                graph.block(ped_keys[b])
+            if not free2:
+                graph.block(keys[a])
+
+        # For every car-light pair. If the light will be red, and the car will
+        #  collide with it when it moves, limit the movement of the car
+        k1x, lx = np.nonzero(light_pairs)
+        hit = rounded_box_sets_intersect(futures, future_offsets, lights, light_offsets,
+                                         k1x, lx)
+        for a, l in zip(k1x[hit].tolist(), lx[hit].tolist()):
+            if not cars[a].intersects(red_lights[l]):
+                graph.block(keys[a])
 
         # For every ped-light pair
         """
         for k1x in range(len(ped_keys)):
             k1 = ped_keys[k1x]
-            k1v = var_map[k1]
             ped1 = self.state.objects[k1]
             for fl, flc in futures_crosswalks:
                 if abs(ped1.angle - fl.angle) < np.pi / 2:
                     if flc == "red" and ped1.intersects(fl):
-                        solver.Add(k1v == 0)
+                        graph.block(k1)
         """
 
-        # Solve the CSP, try to assign max allowable velocity to every car/pedestrian
-        #  (everything stop is a trivial solution)
-        db = solver.Phase(sorted([v for k,v in iteritems(var_map)]),
-                          solver.CHOOSE_FIRST_UNBOUND,
-                          solver.ASSIGN_MAX_VALUE)
-        solver.NewSearch(db)
-
-        solver.NextSolution()
+        if self.background_control == BACKGROUND_PRIORITY:
+            # Cars and pedestrians that have been stopped the longest get to
+            #  move first
+            priority = [o.stopped_time for o in reversed(cars + peds)]
+            values = graph.solve_priority(priority)
+        else:
+            # Solve every cluster of interacting agents as its own CSP
+            values = graph.solve(pool=self.planner_pool,
+                                 pool_min_size=self.planner_pool_min_size)
+        self.planner_stats.update(graph.stats)
         actions = {}
 
         # Interpret the solver solution
-        for k, v in iteritems(var_map):
+        for k, v in iteritems(values):
             if k in self.state.type_map[Car]:
 
-                    actions[k] = VelocityAction(v.Value()*0.7)
+                    actions[k] = VelocityAction(v*0.7)
 
             elif k in self.state.type_map[Pedestrian]:
 
-                    actions[k] = v.Value()
+                    actions[k] = v
 
 
         self.next_actions = actions
 
 
+    def get_planner_stats(self):
+        """
+        Returns counts of the object pairs the background planner ran exact
+        intersection tests on in the last step, of the pairs the bounding box
+        broadphase pruned, and of the clusters of interacting agents it solved
+
+        Returns
+        -------
+        dict of (str -> int)
+        """
+        return self.planner_stats
+
     def run_time(self):
         fluids_assert(self.state, "run_time called without setting the state")
         return self.state.time
@@ -0,0 +1,253 @@
+import numpy as np
+
+from fluids.assets import Car, Lane, Pedestrian
+from fluids.utils import SpatialGrid, make_box, batch_make_box, boxes_intersect, \
+    batch_boxes_intersect, bounds_overlap, fluids_assert
+
+
+# Cars are placed on the center line of a lane, at least this far from its ends
+LANE_END_MARGIN   = 50
+# Largest difference between the angle of a new car and the angle of its lane
+ANGLE_JITTER      = 0.1
+# Smallest distance between a new car and anything it could collide with
+CAR_SPACING       = 10
+# Lanes are probed for static obstacles at this spacing
+SLOT_SPACING      = 5
+# Candidate poses drawn at a time
+SPAWN_BATCH       = 256
+# Batches in a row that may place nothing before the layout counts as full
+MAX_EMPTY_BATCHES = 20
+# Cell size of the index of cars placed in one call
+SPAWN_CELL_SIZE   = 100
+
+
+def object_box(obj):
+    """
+    Returns the oriented box of a Shape, or the box of its bounds for shapes
+    that are not rectangles
+    """
+    if obj.box is not None:
+        return obj.box
+    return make_box((obj.minx + obj.maxx) / 2.0, (obj.miny + obj.maxy) / 2.0, 0,
+                    obj.maxx - obj.minx, obj.maxy - obj.miny)
+
+
+def waypoint_box(waypoint):
+    """
+    Returns the oriented box of a waypoint. Pedestrian waypoints have no width,
+    and make flat boxes.
+    """
+    if waypoint.box is not None:
+        return waypoint.box
+    return make_box(waypoint.x, waypoint.y, waypoint.angle, waypoint.xdim, waypoint.ydim)
+
+
+def box_bounds(box):
+    """
+    Returns the (minx, miny, maxx, maxy) bounds of a box made by make_box, or
+    of the columns of an (8, n) array of boxes
+    """
+    x, y, ex, ey = box[0], box[1], box[6], box[7]
+    return (x - ex, y - ey, x + ex, y + ey)
+
+
+class Spawner(object):
+    """
+    Places cars and pedestrians on a State in batches.
+
+    Cars are drawn uniformly from the free lane intervals: the stretches of lane
+    center line, away from the lane ends, where a car at about the lane's angle
+    clears every static object it could collide with. These are found once for
+    the layout. Candidates only have to be checked against the dynamic objects
+    around them, through the State's dynamic index. They keep CAR_SPACING from
+    everything they could collide with, and start on the first waypoint past
+    the one they stand on.
+
+    Pedestrians start at random pedestrian waypoints, clear of the cars that
+    could hit them.
+
+    Parameters
+    ----------
+    state: fluids.State
+        State to place objects on. Spawned objects are returned, and have to
+        be added to the State before spawning more.
+    """
+    def __init__(self, state):
+        self.state     = state
+        self.car       = Car(state=state, vis_level=0)
+        self.ped       = Pedestrian(state=state, vis_level=0)
+        self.intervals = None
+
+    def get_free_intervals(self):
+        """
+        Finds the free lane intervals, the first time they are needed.
+
+        Returns
+        -------
+        dict of np.array: lane, the lane each interval is on; t0 and t1, its
+        ends as distances from the lane center along the lane; x, y and angle,
+        the pose of the lane center
+        """
+        if self.intervals is not None:
+            return self.intervals
+        state = self.state
+        car = self.car
+        lanes = list(state.type_map[Lane].values())
+        static = [obj for obj in state.static_objects.values()
+                  if type(obj) in car.collideables]
+
+        # A car within ANGLE_JITTER of the lane and within half a slot of a slot
+        #  lies inside the slot's probe box
+        hx, hy = car.xdim / 2.0, car.ydim / 2.0
+        jitter = np.sin(ANGLE_JITTER)
+        probe_hx = hx + hy * jitter + SLOT_SPACING / 2.0
+        probe_hy = hy + hx * jitter
+        half = np.array([lane.xdim / 2.0 - LANE_END_MARGIN for lane in lanes])
+        n_slots = np.maximum(np.floor(2 * half / SLOT_SPACING).astype(np.int64) + 1, 0)
+        lane_of = np.repeat(np.arange(len(lanes)), n_slots)
+        t = np.arange(len(lane_of)) - np.repeat(np.cumsum(n_slots) - n_slots, n_slots)
+        t = t * float(SLOT_SPACING) - half[lane_of]
+        lx = np.array([lane.x for lane in lanes], dtype=np.float64).reshape(-1)
+        ly = np.array([lane.y for lane in lanes], dtype=np.float64).reshape(-1)
+        la = np.array([lane.angle for lane in lanes], dtype=np.float64).reshape(-1)
+        a = la[lane_of]
+        probes = batch_make_box(lx[lane_of] + t * np.cos(a), ly[lane_of] - t * np.sin(a),
+                                a, 2 * probe_hx, 2 * probe_hy)
+
+        # Cars collide with lanes going the other way, which a car at up to
+        #  ANGLE_JITTER from its lane may do
+        blocks = np.ones((len(lanes), len(static)), dtype=bool)
+        for j, obj in enumerate(static):
+            if type(obj) is Lane:
+                dangle = (la - obj.angle) % (2 * np.pi)
+                blocks[:, j] = (dangle > np.pi / 2 - ANGLE_JITTER) \
+                    & (dangle < 3 * np.pi / 2 + ANGLE_JITTER)
+        boxes = np.array([object_box(obj) for obj in static]).reshape(-1, 8)
+        near = bounds_overlap(np.transpose(box_bounds(probes.T)),
+                              np.transpose(box_bounds(boxes.T)))
+        probe, obstacle = np.nonzero(near & blocks[lane_of])
+        hits = batch_boxes_intersect(probes[probe], boxes[obstacle])
+        free = np.bincount(probe[hits], minlength=len(probes)) == 0
+
+        # Runs of free slots on the same lane make an interval
+        starts = free & ~np.concatenate([[False], free[:-1] & (lane_of[1:] == lane_of[:-1])])
+        ends = free & ~np.concatenate([free[1:] & (lane_of[1:] == lane_of[:-1]), [False]])
+        lane = lane_of[starts]
+        t0 = np.maximum(t[starts] - SLOT_SPACING / 2.0, -half[lane])
+        t1 = np.minimum(t[ends] + SLOT_SPACING / 2.0, half[lane])
+        self.intervals = {"lane": lane, "t0": t0, "t1": t1,
+                          "x": lx[lane], "y": ly[lane], "angle": la[lane]}
+        return self.intervals
+
+    def sample_lane_poses(self, n):
+        """
+        Draws n poses uniformly from the free lane intervals
+
+        Returns
+        -------
+        (x, y, angle), arrays of length n
+        """
+        intervals = self.get_free_intervals()
+        length = intervals["t1"] - intervals["t0"]
+        fluids_assert(length.sum() > 0, "Layout has no room for cars")
+        cumulative = np.cumsum(length)
+        u = np.random.uniform(0, cumulative[-1], n)
+        k = np.minimum(np.searchsorted(cumulative, u, side="right"), len(length) - 1)
+        t = intervals["t1"][k] - (cumulative[k] - u)
+        lane_angle = intervals["angle"][k]
+        x = intervals["x"][k] + t * np.cos(lane_angle)
+        y = intervals["y"][k] - t * np.sin(lane_angle)
+        angle = lane_angle + np.random.uniform(-ANGLE_JITTER, ANGLE_JITTER, n)
+        return x, y, angle
+
+    def is_blocked(self, probe, box, index=None, boxes=None):
+        """
+        Returns whether box, of an object like probe, intersects a dynamic
+        object of the State that probe could collide with or be hit by, or one
+        of boxes, which are indexed by position in the SpatialGrid index
+        """
+        state = self.state
+        bounds = box_bounds(box)
+        for k in state.dynamic_index.query(bounds):
+            obj = state.objects[k]
+            if (probe.can_collide(obj) or obj.can_collide(probe)) \
+               and boxes_intersect(box, object_box(obj)):
+                return True
+        if index is not None:
+            for k in index.query(bounds):
+                if boxes_intersect(box, boxes[k]):
+                    return True
+        return False
+
+    def spawn_cars(self, n, vis_level=0):
+        """
+        Returns n new cars with their routes started
+        """
+        state = self.state
+        probe = self.car
+        index, boxes, poses = SpatialGrid(cell_size=SPAWN_CELL_SIZE), [], []
+        empty_batches = 0
+        while len(poses) < n:
+            before = len(poses)
+            for x, y, angle in zip(*[v.tolist() for v in self.sample_lane_poses(SPAWN_BATCH)]):
+                box = make_box(x, y, angle, probe.xdim + 2 * CAR_SPACING,
+                               probe.ydim + 2 * CAR_SPACING)
+                if self.is_blocked(probe, box, index, boxes):
+                    continue
+                box = make_box(x, y, angle, probe.xdim, probe.ydim)
+                index.insert(len(boxes), box_bounds(box))
+                boxes.append(box)
+                poses.append((x, y, angle))
+                if len(poses) == n:
+                    break
+            empty_batches = 0 if len(poses) > before else empty_batches + 1
+            fluids_assert(empty_batches < MAX_EMPTY_BATCHES,
+                          "Layout is full after placing {} of {} cars".format(
+                              len(poses), n))
+
+        cars = [Car(state=state, x=x, y=y, angle=angle, vis_level=vis_level)
+                for x, y, angle in poses]
+        graph = state.waypoint_graph
+        bounds = np.array([box_bounds(box) for box in boxes]).reshape(-1, 4)
+        overlaps = bounds_overlap(bounds, graph.bounds[:graph.n_waypoints])
+        for car, candidates in zip(cars, overlaps):
+            for i in np.flatnonzero(candidates).tolist():
+                if car.intersects(graph.waypoints[i]):
+                    while car.intersects(graph.waypoints[i]):
+                        i = graph.choose_next(i)
+                    car.route = [graph.choose_next(i)]
+                    break
+        return cars
+
+    def spawn_peds(self, n, vis_level=0):
+        """
+        Returns n new pedestrians with their routes started
+        """
+        state = self.state
+        graph = state.waypoint_graph
+        fluids_assert(not n or len(graph.waypoints) > graph.n_waypoints,
+                      "Layout has no pedestrian waypoints")
+        probe = self.ped
+        peds = []
+        empty_batches = 0
+        while len(peds) < n:
+            before = len(peds)
+            starts = np.random.randint(graph.n_waypoints, len(graph.waypoints), SPAWN_BATCH)
+            for i in starts.tolist():
+                wp = graph.waypoints[i]
+                box = make_box(wp.x, wp.y, wp.angle, probe.xdim, probe.ydim)
+                if self.is_blocked(probe, box):
+                    continue
+                while boxes_intersect(box, waypoint_box(graph.waypoints[i])):
+                    i = graph.choose_next(i)
+                ped = Pedestrian(state=state, x=wp.x, y=wp.y, angle=wp.angle,
+                                 vis_level=vis_level)
+                ped.route = [i]
+                peds.append(ped)
+                if len(peds) == n:
+                    break
+            empty_batches = 0 if len(peds) > before else empty_batches + 1
+            fluids_assert(empty_batches < MAX_EMPTY_BATCHES,
+                          "Layout is full after placing {} of {} pedestrians".format(
+                              len(peds), n))
+        return peds
@@ -1,19 +1,23 @@
 import numpy as np
-import json
 import os
 from six import iteritems
 import random
 import pygame
-import hashlib
 
 from fluids.consts import *
 from fluids.assets import *
+from fluids.obs import ObservationScene, StaticMap, DynamicMap
+from fluids.layout import CompiledLayout, STATIC_TYPES
+from fluids.spawn import Spawner
 from fluids.utils import *
 from fluids.version import __version__
 
 
 basedir = os.path.dirname(__file__)
 
+INDEX_CELL_SIZE = 100
+SEGMENT_CELL_SIZE = 50
+
 id_index = 0
 def get_id():
     global id_index
@@ -30,7 +34,9 @@ class State(object):
     ----------
     layout: str
         Name of json layout file specifiying environment object positions.
-        Default is "fluids_state_city"
+        Default is "fluids_state_city". Layouts are compiled into the layout cache
+        the first time they are used. See fluids.utils.set_cache_folder. A path to a layout compiled with
+        "python -m fluids compile-layout --out" may also be given.
     controlled_cars: int
         Number of cars to accept external control for
     background_cars: int
@@ -56,17 +62,27 @@ class State(object):
                  tunable_parameters =None):
 
         fluids_print("Loading layout: " + layout)
-        layout = open(os.path.join(basedir, "layouts", layout + ".json"))
-        cfilename = "{}{}.json".format(
-            hashlib.md5(str(layout).encode()).hexdigest()[:10],
-            __version__)
-        cached_layout = lookup_cache(cfilename)
-        cache_found = cached_layout is not False
-        if cached_layout:
-            fluids_print("Cached layout found")
-            layout = cached_layout
-
-        layout = json.load(layout)
+        if layout.endswith(".npz"):
+            compiled = CompiledLayout.load(layout)
+            fluids_assert(int(compiled.waypoint_width) == waypoint_width,
+                          "Layout {} was compiled with waypoint_width {}".format(
+                              layout, compiled.waypoint_width))
+        else:
+            with open(os.path.join(basedir, "layouts", layout + ".json"), "rb") as infile:
+                source = infile.read()
+            cfilename = "layout_{}.npz".format(cache_key(source, __version__,
+                                                         CompiledLayout.FORMAT,
+                                                         waypoint_width))
+            fname = get_cache_filename(cfilename)
+            if os.path.exists(fname):
+                fluids_print("Compiled layout found")
+            else:
+                fluids_print("Compiling layout to: " + cfilename)
+                write_cache(cfilename, CompiledLayout.compile(source, waypoint_width).save)
+            compiled = CompiledLayout.load(fname)
+        self.static_map_filename = "static_map_{}.npz".format(
+            cache_key(str(compiled.source), __version__))
+        layout = compiled.get_layout()
 
 
         self.time             = 0
@@ -82,31 +98,38 @@ class State(object):
         self.dimensions       = (layout['dimension_x'] + 800,
                                  layout['dimension_y'])
         self.vis_level        = vis_level
+        self.static_index     = SpatialGrid(cell_size=INDEX_CELL_SIZE)
+        self.dynamic_index    = SpatialGrid(cell_size=INDEX_CELL_SIZE)
+        self.dynamic_store    = DynamicStore()
+        self.obs_scene        = None
+        self.static_map       = None
+        self.dynamic_map      = None
+        self.step_memo        = {}
+        self.step_memo_time   = self.time
 
 
-        lanes = []
-        sidewalks = []
         fluids_print("Creating objects")
         for obj_info in layout['static_objects']:
-            typ = {"Terrain"    : Terrain,
-                   "Lane"       : Lane,
-                   "Street"     : Street,
-                   "CrossWalk"  : CrossWalk,
-                   "PedCrossing": PedCrossing,
-                   "Sidewalk"   : Sidewalk}[obj_info['type']]
+            typ = STATIC_TYPES[obj_info.pop('type')]
             if typ == Lane:
                 obj_info["wp_width"] = waypoint_width
             obj = typ(state=self, vis_level=vis_level, **obj_info)
-
-            if typ == Lane:
-                lanes.append(obj)
-            if typ == Sidewalk:
-                sidewalks.append(obj)
             key = get_id()
             self.type_map[typ][key] = obj
             self.objects[key] = obj
             self.static_objects[key] = obj
-            obj_info['fluids_obj'] = obj
+            self.static_index.insert(key, shape_bounds(obj))
+        # Edges of static objects for lidar. Objects with the same type and angle
+        #  collide alike, so they share a label and one of them stands in for all
+        static_groups = {}
+        labels = [static_groups.setdefault((type(obj), obj.angle), len(static_groups))
+                  for obj in self.static_objects.values()]
+        self.static_segment_groups = [None] * len(static_groups)
+        for obj, label in zip(self.static_objects.values(), labels):
+            self.static_segment_groups[label] = obj
+        self.static_segments = SegmentGrid(compiled.get_static_rings(),
+                                           labels=labels, cell_size=SEGMENT_CELL_SIZE)
+
         car_ids = []
         for obj_info in layout['dynamic_objects']:
             typ = {"Car"           : Car,
@@ -124,101 +147,39 @@ class State(object):
             self.type_map[typ][key] = obj
             self.objects[key] = obj
             self.dynamic_objects[key] = obj
+            self.dynamic_index.insert(key, shape_bounds(obj))
 
 
         fluids_print("Generating trajectory map")
-        if 'waypoints' in layout:
-            wp_map = {}
-            self.waypoints = []
-            self.ped_waypoints = []
-
-            for wp_info in layout['waypoints']:
-                index = wp_info.pop('index')
-                wp = Waypoint(owner=None, ydim=waypoint_width, **wp_info)
-                wp_map[index] = wp
-                self.waypoints.append(wp)
-            for wp in self.waypoints:
-                wp.nxt = [wp_map[index] for index in wp.nxt]
-
-
-            for wp_info in layout['ped_waypoints']:
-                index = wp_info.pop('index')
-                wp = Waypoint(owner=None, **wp_info)
-                wp_map[index] = wp
-                self.ped_waypoints.append(wp)
-            for wp in self.ped_waypoints:
-                wp.nxt = [wp_map[index] for index in wp.nxt]
-
-
-            for k, obj in iteritems(self.objects):
-                obj.waypoints       = [wp_map[i] for i in obj.waypoints]
-                for wp in obj.waypoints:
-                    wp.owner = obj
-            for k, obj in iteritems(self.type_map[Lane]):
-                obj.start_waypoint  = wp_map[obj.start_waypoint]
-                obj.end_waypoint    = wp_map[obj.end_waypoint]
-            for k, obj in iteritems(self.type_map[Sidewalk]):
-                obj.start_waypoints = [wp_map[i] for i in obj.start_waypoints]
-                obj.end_waypoints   = [wp_map[i] for i in obj.end_waypoints]
-            for k, obj in iteritems(self.type_map[CrossWalk]):
-                obj.start_waypoints = [wp_map[i] for i in obj.start_waypoints]
-                obj.end_waypoints   = [wp_map[i] for i in obj.end_waypoints]
-
-        else:
-            self.generate_waypoints_init()
-
-            layout['waypoints'] = []
-            layout['ped_waypoints'] = []
-            for wp in self.waypoints:
-                wpdict = {"index":wp.index, "x":wp.x, "y": wp.y, "angle":wp.angle,
-                          "nxt":[w.index for w in wp.nxt]}
-                layout['waypoints'].append(wpdict)
-            for wp in self.ped_waypoints:
-                wpdict = {"index":wp.index, "x":wp.x, "y": wp.y, "angle":wp.angle,
-                          "nxt":[w.index for w in wp.nxt]}
-                layout['ped_waypoints'].append(wpdict)
-
-            for obj_info in layout['static_objects']:
-                obj = obj_info.pop('fluids_obj')
-                if obj_info['type'] == 'Lane':
-                    obj_info['start_wp']  = obj.start_waypoint.index
-                    obj_info['end_wp']    = obj.end_waypoint.index
-                elif obj_info['type'] in ['Sidewalk', 'CrossWalk']:
-                    obj_info['start_wps'] = [wp.index for wp in obj.start_waypoints]
-                    obj_info['end_wps']   = [wp.index for wp in obj.end_waypoints]
-                obj_info['waypoints']     = [wp.index for wp in obj.waypoints]
-
-
-        for waypoint in self.waypoints:
-            waypoint.create_edges(buff=20)
-        for waypoint in self.ped_waypoints:
-            waypoint.create_edges(buff=5)
+        self.waypoint_graph = compiled.get_waypoint_graph()
+        wp_map = self.waypoint_graph.waypoints
+        self.waypoints      = wp_map[:self.waypoint_graph.n_waypoints]
+        self.ped_waypoints  = wp_map[self.waypoint_graph.n_waypoints:]
+        for k, obj in iteritems(self.objects):
+            obj.waypoints       = [wp_map[i] for i in obj.waypoints]
+            for wp in obj.waypoints:
+                wp.owner = obj
+        for k, obj in iteritems(self.type_map[Lane]):
+            obj.start_waypoint  = wp_map[obj.start_waypoint]
+            obj.end_waypoint    = wp_map[obj.end_waypoint]
+        for k, obj in iteritems(self.type_map[Sidewalk]):
+            obj.start_waypoints = [wp_map[i] for i in obj.start_waypoints]
+            obj.end_waypoints   = [wp_map[i] for i in obj.end_waypoints]
+        for k, obj in iteritems(self.type_map[CrossWalk]):
+            obj.start_waypoints = [wp_map[i] for i in obj.start_waypoints]
+            obj.end_waypoints   = [wp_map[i] for i in obj.end_waypoints]
 
 
         fluids_print("Generating cars")
-        for i in range(controlled_cars + background_cars):
-            while True:
-                start = lanes[np.random.random_integers(0, len(lanes)-1)]
-                x = np.random.uniform(start.minx + 50, start.maxx - 50)
-                y = np.random.uniform(start.miny + 50, start.maxy - 50)
-                angle = start.angle + np.random.uniform(-0.1, 0.1)
-                car = Car(state=self, x=x, y=y, angle=angle, vis_level=vis_level)
-                min_d = min([car.dist_to(other) for k, other \
-                             in iteritems(self.type_map[Car])] + [np.inf])
-                if min_d > 10 and not self.is_in_collision(car):
-                    key = get_id()
-                    for waypoint in self.waypoints:
-                        if car.intersects(waypoint):
-                            while car.intersects(waypoint):
-                                waypoint = random.choice(waypoint.nxt).out_p
-                            waypoint = random.choice(waypoint.nxt).out_p
-                            car.waypoints = [waypoint]
-                            break
-                    self.type_map[Car][key] = car
-                    self.objects[key] = car
-                    car_ids.append(key)
-                    self.dynamic_objects[key] = car
-                    break
+        self.spawner = Spawner(self)
+        for car in self.spawner.spawn_cars(controlled_cars + background_cars, vis_level):
+            key = get_id()
+            self.type_map[Car][key] = car
+            self.objects[key] = car
+            car_ids.append(key)
+            self.dynamic_objects[key] = car
+            self.dynamic_store.add(key, car)
+            self.dynamic_index.insert(key, shape_bounds(car))
 
         self.controlled_cars = {k: self.objects[k] for k in car_ids[:controlled_cars]}
         for k, car in iteritems(self.controlled_cars):
@@ -229,26 +190,17 @@ class State(object):
             c.set_tunable_parameters(tunable_parameters)
 
         fluids_print("Generating peds")
-        for i in range(background_peds):
-            while True:
-                wp = random.choice(self.ped_waypoints)
-                ped = Pedestrian(state=self, x=wp.x, y=wp.y,
-                                 angle=wp.angle, vis_level=vis_level)
-                while ped.intersects(wp):
-                    wp = random.choice(wp.nxt).out_p
-                ped.waypoints = [wp]
-                if not self.is_in_collision(ped):
-                    key = get_id()
-                    self.objects[key] = ped
-                    self.type_map[Pedestrian][key] = ped
-                    self.dynamic_objects[key] = obj
-                    break
-
-
-        if not cache_found:
-            fluids_print("Caching layout to: " + cfilename)
-            with open(get_cache_filename(cfilename), "w") as outfile:
-                json.dump(layout, outfile, indent=1)
+        for ped in self.spawner.spawn_peds(background_peds, vis_level):
+            key = get_id()
+            self.objects[key] = ped
+            self.type_map[Pedestrian][key] = ped
+            self.dynamic_objects[key] = ped
+            self.dynamic_store.add(key, ped)
+            self.dynamic_index.insert(key, shape_bounds(ped))
+
+
+        self.update_dynamic_index()
+
         fluids_print("State creation complete")
         if vis_level:
             self.static_surface       = pygame.Surface(self.dimensions)
@@ -267,76 +219,11 @@ class State(object):
                 waypoint.render(self.static_debug_surface)
             for waypoint in self.ped_waypoints:
                 waypoint.render(self.static_debug_surface, color=(255, 255, 0))
-
-    def generate_waypoints_init(self):
-        self.waypoints      = [lane.start_waypoint for k, lane in \
-                               iteritems(self.type_map[Lane])]
-        self.waypoints.extend([lane.end_waypoint   for k, lane in \
-                               iteritems(self.type_map[Lane])])
-
-        new_waypoints = []
-        for k, street in iteritems(self.type_map[Street]):
-            for waypoint in self.waypoints:
-                if street.intersects(waypoint):
-                    test_point = (waypoint.x + np.cos(waypoint.angle),
-                                  waypoint.y - np.sin(waypoint.angle))
-                    if street.contains_point(test_point):
-                        street.in_waypoints.append(waypoint)
-                        assert(waypoint == waypoint.owner.end_waypoint)
-                        waypoint.owner = street
-                    else:
-                        street.out_waypoints.append(waypoint)
-            for in_p in street.in_waypoints:
-                for out_p in street.out_waypoints:
-                    dangle = (in_p.angle - out_p.angle) % (2 * np.pi)
-                    if dangle < 0.75*np.pi or dangle > 1.25*np.pi:
-                        in_p.nxt.append(out_p)
-
-        for waypoint in self.waypoints:
-            new_points = waypoint.smoothen(smooth_level=2000)
-            new_waypoints.extend(new_points)
-            for wp in new_points:
-                wp.owner = waypoint.owner
-        self.waypoints.extend(new_waypoints)
-
-        self.ped_waypoints = []
-        for k, obj in iteritems(self.objects):
-            if type(obj) in {CrossWalk, Sidewalk}:
-                self.ped_waypoints.extend(obj.start_waypoints)
-                self.ped_waypoints.extend(obj.end_waypoints)
-        for k, cross in iteritems(self.type_map[PedCrossing]):
-            for waypoint in self.ped_waypoints:
-                if cross.intersects(waypoint):
-                    test_point = (waypoint.x + np.cos(waypoint.angle),
-                                  waypoint.y - np.sin(waypoint.angle))
-                    if cross.contains_point(test_point):
-                        cross.in_waypoints.append(waypoint)
-                    else:
-                        cross.out_waypoints.append(waypoint)
-            for in_p in cross.in_waypoints:
-                for out_p in cross.out_waypoints:
-                    dangle = (in_p.angle - out_p.angle) % (2 * np.pi)
-                    if dangle < 0.75*np.pi or dangle > 1.25*np.pi:
-                        in_p.nxt.append(out_p)
-
-        new_waypoints = []
-        for waypoint in self.ped_waypoints:
-            new_points = waypoint.smoothen(smooth_level=1500)
-            new_waypoints.extend(new_points)
-            for wp in new_points:
-                wp.owner = waypoint.owner
-        self.ped_waypoints.extend(new_waypoints)
-        print(self.ped_waypoints)
-
-        i = 0
-        for wp in self.waypoints:
-            wp.index = i
-            i += 1
-            wp.owner.waypoints.append(wp)
-        for wp in self.ped_waypoints:
-            wp.index = i
-            i += 1
-            wp.owner.waypoints.append(wp)
+            graph = self.waypoint_graph
+            xy = graph.xy.astype(int).tolist()
+            for i, j in zip(graph.source_list, graph.target_list):
+                color = Waypoint.COLOR if i < graph.n_waypoints else (255, 255, 0)
+                pygame.draw.line(self.static_debug_surface, color, xy[i], xy[j], 1)
 
     def get_static_surface(self):
         return self.static_surface
@@ -355,7 +242,7 @@ class State(object):
             car.render(dynamic_surface)
         if self.vis_level > 1:
             for kd, obj in iteritems(self.dynamic_objects):
-                for ko, sobj in iteritems(self.objects):
+                for sobj in self.get_nearby_objects(obj):
                     if obj.collides(sobj):
                         pygame.draw.circle(dynamic_surface,
                                            (255, 0, 255),
@@ -363,27 +250,111 @@ class State(object):
                                            10)
         return dynamic_surface
 
+    def update_dynamic_index(self):
+        """
+        Moves every car and pedestrian to its current bounding box in the dynamic index.
+        Must be called after they move and before collisions are queried.
+        """
+        self.dynamic_index.update_many(self.dynamic_store.keys, self.dynamic_store.bounds())
+
+    def get_observation_scene(self):
+        """
+        Returns the ObservationScene for the current time step, which is shared
+        by every observation made during the step
+        """
+        if self.obs_scene is None or self.obs_scene.time != self.time:
+            self.obs_scene = ObservationScene(
+                self, None if self.obs_scene is None else self.obs_scene.static_coords)
+        return self.obs_scene
+
+    def memoize(self, key, create):
+        """
+        Returns the value stored under key for the current time step, calling
+        create() to make it if missing. Entries are dropped as soon as time
+        advances, so every consumer during a step shares one computation.
+        """
+        if self.step_memo_time != self.time:
+            self.step_memo = {}
+            self.step_memo_time = self.time
+        if key not in self.step_memo:
+            self.step_memo[key] = create()
+        return self.step_memo[key]
+
+    def get_observation(self, key, obs_space, **kwargs):
+        """
+        Returns the observation of object key in obs_space, made at most once per
+        time step for the same kwargs
+        """
+        obj = self.objects[key]
+        obs = self.memoize(("obs", key, obs_space, freeze(kwargs)),
+                           lambda: obj.make_observation(obs_space, **kwargs))
+        obj.last_obs = obs
+        return obs
+
+    def get_static_map(self):
+        """
+        Returns the StaticMap of this layout. It is drawn the first time it is needed
+        and kept in the layout cache for later states.
+        """
+        if self.static_map is None:
+            fname = get_cache_filename(self.static_map_filename)
+            if os.path.exists(fname):
+                fluids_print("Cached static map found")
+                self.static_map = StaticMap.load(fname, self)
+            else:
+                self.static_map = StaticMap(self)
+                fluids_print("Caching static map to: " + self.static_map_filename)
+                write_cache(self.static_map_filename, self.static_map.save)
+        return self.static_map
+
+    def get_dynamic_map(self):
+        """
+        Returns the DynamicMap of the current time step, drawn the first time
+        an observation asks for it
+        """
+        if self.dynamic_map is None or self.dynamic_map.time != self.time:
+            self.dynamic_map = DynamicMap(self, self.dynamic_map)
+        return self.dynamic_map
+
+    def get_nearby_keys(self, obj, buf=0):
+        """
+        Returns keys of all objects whose bounding boxes are within buf of obj's
+        """
+        bounds = shape_bounds(obj, buf)
+        return self.static_index.query(bounds) | self.dynamic_index.query(bounds)
+
+    def get_nearby_objects(self, obj, buf=0):
+        return [self.objects[k] for k in self.get_nearby_keys(obj, buf)]
+
     def is_in_collision(self, obj):
         collideables = obj.collideables
-        for ctype in collideables:
-            if ctype in self.type_map:
-                for k, other in iteritems(self.type_map[ctype]):
-                    if obj.collides(other):
-                        return True
+        for other in self.get_nearby_objects(obj):
+            if type(other) in collideables and obj.collides(other):
+                return True
         return False
 
     def min_distance_to_collision(self, obj):
-        collideables = obj.collideables
-        mind = 0
-        for ctype in collideables:
-            for k, other in iteritems(self.type_map[ctype]):
-                d = obj.dist_to(other)
-                if d < mind:
-                    mind = d
-        return mind
+        """
+        Returns the distance from obj to the nearest object it could collide
+        with, the ones is_in_collision tests. This is 0 for objects in collision,
+        and inf when there is nothing to collide with.
+        """
+        max_buf = max(self.dimensions)
+        buf = INDEX_CELL_SIZE
+        while True:
+            mind = np.inf
+            for other in self.get_nearby_objects(obj, buf):
+                if obj.can_collide(other):
+                    mind = min(mind, obj.dist_to(other))
+            # Anything outside the searched region is further than buf away
+            if mind <= buf or buf > max_buf:
+                return mind
+            buf = buf * 2
 
     def update_vis_level(self, new_vis_level):
         self.vis_level = new_vis_level
+        # Observations keep debug geometry depending on the vis level
+        self.step_memo = {}
         for k, obj in iteritems(self.objects):
             obj.vis_level = new_vis_level
 
@@ -2,3 +2,10 @@ from fluids.utils.utils import *
 from fluids.utils.debug import *
 from fluids.utils.rewards import path_reward
 from fluids.utils.pid import PIDController
+from fluids.utils.spatial import SpatialGrid, SegmentGrid, shape_bounds, bounds_overlap
+from fluids.utils.geometry import make_box, boxes_intersect, batch_boxes_intersect, \
+    batch_make_box, make_capsule, batch_rounded_boxes_intersect, rounded_box_sets_intersect, \
+    rounded_box_polygon, ray_segment_distances, pack_polygons, \
+    ray_polygon_distances
+from fluids.utils.planner import ConflictGraph, solve_components
+from fluids.utils.raster import fill_polygons, fill_disk, segment_polygon, polygon_masks
@@ -0,0 +1,281 @@
+import math
+import numpy as np
+import shapely.geometry
+
+
+def make_box(x, y, angle, xdim, ydim):
+    """
+    Returns the oriented box representation of a rectangle with the given center,
+    angle and dimensions. This is (x, y, cos, sin, half_xdim, half_ydim, half_width,
+    half_height), where the last two are the half extents of its axis aligned bounds.
+    """
+    c, s = math.cos(angle), math.sin(angle)
+    hx, hy = xdim / 2.0, ydim / 2.0
+    return (x, y, c, s, hx, hy,
+            hx * abs(c) + hy * abs(s),
+            hx * abs(s) + hy * abs(c))
+
+
+def boxes_intersect(a, b):
+    """
+    Separating axis test between two oriented boxes made by make_box.
+    Boxes that only touch are intersecting, same as shapely's intersects.
+    """
+    ax, ay, ac, as_, ahx, ahy, aex, aey = a
+    bx, by, bc, bs, bhx, bhy, bex, bey = b
+    tx, ty = bx - ax, by - ay
+    if abs(tx) > aex + bex or abs(ty) > aey + bey:
+        return False
+    # Box axes are u = (cos, -sin) and v = (sin, cos)
+    d_uu = abs(ac * bc + as_ * bs)
+    d_uv = abs(ac * bs - as_ * bc)
+    if abs(tx * ac - ty * as_) > ahx + bhx * d_uu + bhy * d_uv:
+        return False
+    if abs(tx * as_ + ty * ac) > ahy + bhx * d_uv + bhy * d_uu:
+        return False
+    if abs(tx * bc - ty * bs) > bhx + ahx * d_uu + ahy * d_uv:
+        return False
+    if abs(tx * bs + ty * bc) > bhy + ahx * d_uv + ahy * d_uu:
+        return False
+    return True
+
+
+def batch_boxes_intersect(a, b):
+    """
+    Vectorized boxes_intersect.
+
+    Parameters
+    ----------
+    a, b: np.array of shape (..., 8)
+        Oriented boxes. Leading dimensions are broadcast against each other,
+        so (n, 1, 8) and (1, m, 8) tests all n x m pairs.
+
+    Returns
+    -------
+    np.array of bool
+    """
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    ac, as_, ahx, ahy = a[..., 2], a[..., 3], a[..., 4], a[..., 5]
+    bc, bs, bhx, bhy = b[..., 2], b[..., 3], b[..., 4], b[..., 5]
+    tx = b[..., 0] - a[..., 0]
+    ty = b[..., 1] - a[..., 1]
+    d_uu = np.abs(ac * bc + as_ * bs)
+    d_uv = np.abs(ac * bs - as_ * bc)
+    separated = np.abs(tx * ac - ty * as_) > ahx + bhx * d_uu + bhy * d_uv
+    separated |= np.abs(tx * as_ + ty * ac) > ahy + bhx * d_uv + bhy * d_uu
+    separated |= np.abs(tx * bc - ty * bs) > bhx + ahx * d_uu + ahy * d_uv
+    separated |= np.abs(tx * bs + ty * bc) > bhy + ahx * d_uv + ahy * d_uu
+    return ~separated
+
+
+def batch_make_box(x, y, angle, xdim, ydim):
+    """
+    Vectorized make_box. Arguments are broadcast, and an (n, 8) array of boxes
+    is returned.
+    """
+    c, s = np.cos(angle), np.sin(angle)
+    x, y, c, s, hx, hy = np.broadcast_arrays(x, y, c, s, np.divide(xdim, 2.0),
+                                             np.divide(ydim, 2.0))
+    return np.stack([x, y, c, s, hx, hy,
+                     hx * np.abs(c) + hy * np.abs(s),
+                     hx * np.abs(s) + hy * np.abs(c)], axis=-1).reshape(-1, 8)
+
+
+def make_capsule(x0, y0, x1, y1, r):
+    """
+    Returns the rounded box of the points within r of the segment
+    (x0, y0) - (x1, y1). Rounded boxes are oriented boxes made by make_box with
+    a radius appended, and hold every point within that radius of the box.
+    A segment is a box without width.
+    """
+    dx, dy = x1 - x0, y1 - y0
+    return make_box((x0 + x1) / 2.0, (y0 + y1) / 2.0, math.atan2(-dy, dx),
+                    math.hypot(dx, dy), 0) + (r,)
+
+
+def batch_rounded_boxes_intersect(a, b):
+    """
+    Vectorized intersection test of rounded boxes, made by make_capsule or as
+    make_box(...) + (r,). Rounded boxes intersect when the distance between
+    their boxes is at most the sum of their radii. Touching counts, same as
+    shapely's intersects.
+
+    Parameters
+    ----------
+    a, b: np.array of shape (n, 9)
+
+    Returns
+    -------
+    np.array of bool with shape (n,)
+    """
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 9)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 9)
+
+    def corner_distance(a, b):
+        # Distance from the closest corner of a to box b
+        sx = np.array([1, 1, -1, -1])
+        sy = np.array([1, -1, -1, 1])
+        ac, as_, ahx, ahy = a[:, 2:3], a[:, 3:4], a[:, 4:5], a[:, 5:6]
+        tx = a[:, 0:1] + sx * ahx * ac + sy * ahy * as_ - b[:, 0:1]
+        ty = a[:, 1:2] - sx * ahx * as_ + sy * ahy * ac - b[:, 1:2]
+        bc, bs = b[:, 2:3], b[:, 3:4]
+        u = np.maximum(np.abs(tx * bc - ty * bs) - b[:, 4:5], 0)
+        v = np.maximum(np.abs(tx * bs + ty * bc) - b[:, 5:6], 0)
+        return np.hypot(u, v).min(axis=1)
+
+    # Boxes that do not overlap are closest at a corner of one of them
+    distance = np.minimum(corner_distance(a, b), corner_distance(b, a))
+    return (distance <= a[:, 8] + b[:, 8]) | batch_boxes_intersect(a[:, :8], b[:, :8])
+
+
+def rounded_box_sets_intersect(a, a_offsets, b, b_offsets, i, j):
+    """
+    Tests pairs of sets of rounded boxes for intersection. A set intersects
+    another when any of its rounded boxes intersects one of the other's.
+
+    Parameters
+    ----------
+    a, b: np.array of shape (m, 9)
+        Rounded boxes of every set, in order
+    a_offsets, b_offsets: np.array of int
+        The rounded boxes of set k are a[a_offsets[k]:a_offsets[k + 1]]
+    i, j: np.array of int with shape (n,)
+        Sets to test, a[i] against b[j]
+
+    Returns
+    -------
+    np.array of bool with shape (n,)
+    """
+    i, j = np.asarray(i, dtype=np.int64), np.asarray(j, dtype=np.int64)
+    na = a_offsets[i + 1] - a_offsets[i]
+    nb = b_offsets[j + 1] - b_offsets[j]
+    counts = na * nb
+    total = counts.sum()
+    if not total:
+        return np.zeros(len(i), dtype=bool)
+    pair = np.repeat(np.arange(len(i)), counts)
+    k = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    hits = batch_rounded_boxes_intersect(a[a_offsets[i][pair] + k // nb[pair]],
+                                         b[b_offsets[j][pair] + k % nb[pair]])
+    return np.bincount(pair[hits], minlength=len(i)) > 0
+
+
+def rounded_box_polygon(box):
+    """
+    Returns a shapely polygon of a rounded box
+    """
+    x, y, c, s, hx, hy = box[:6]
+    corners = [(x + sx * hx * c + sy * hy * s, y - sx * hx * s + sy * hy * c)
+               for sx, sy in [(1, 1), (1, -1), (-1, -1), (-1, 1)]]
+    if hy == 0 or hx == 0:
+        return shapely.geometry.LineString(corners[1:3] if hy == 0 else corners[:2]).buffer(box[8])
+    return shapely.geometry.Polygon(corners).buffer(box[8])
+
+
+def ray_segment_distances(x, y, angles, max_dist, starts, ends):
+    """
+    Distances along rays from (x, y) to where they cross segments.
+    Rays point along (cos(angle), -sin(angle)), like headings, and have length
+    max_dist. Segments parallel to a ray are misses. Along a polygon's boundary,
+    their endpoints are still hit through the neighboring edges.
+
+    Parameters
+    ----------
+    angles: np.array of shape (n,)
+    starts, ends: np.array of shape (m, 2)
+        Segment endpoints
+
+    Returns
+    -------
+    np.array of shape (n, m), inf where a ray misses a segment
+    """
+    angles = np.asarray(angles, dtype=np.float64).reshape(-1, 1)
+    starts = np.asarray(starts, dtype=np.float64).reshape(-1, 2)
+    ends = np.asarray(ends, dtype=np.float64).reshape(-1, 2)
+    return ray_hits(x, y, np.cos(angles), -np.sin(angles), max_dist,
+                    starts[:, 0], starts[:, 1], ends[:, 0], ends[:, 1])
+
+
+def ray_hits(x, y, dx, dy, max_dist, x0, y0, x1, y1):
+    """
+    Elementwise ray_segment_distances for rays from (x, y) along unit directions
+    (dx, dy) and segments (x0, y0) - (x1, y1). Arguments are broadcast.
+    """
+    ex, ey = x1 - x0, y1 - y0
+    wx, wy = x0 - x, y0 - y
+    denom = dx * ey - dy * ex
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (wx * ey - wy * ex) / denom
+        u = (wx * dy - wy * dx) / denom
+    # A little slack on u keeps rays through a vertex from slipping between edges
+    eps = 1e-9
+    hit = (t >= 0) & (t <= max_dist) & (u >= -eps) & (u <= 1 + eps)
+    return np.where(hit, t, np.inf)
+
+
+def point_in_polygons(x, y, starts, ends, owner, n_polygons):
+    """
+    Even-odd test of the point (x, y) against packed polygons from pack_polygons.
+    Returns an np.array of bool with shape (n_polygons,).
+    """
+    (x0, y0), (x1, y1) = starts.T, ends.T
+    straddles = (y0 > y) != (y1 > y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cross_x = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+    crossings = np.bincount(owner[straddles & (cross_x > x)], minlength=n_polygons)
+    return crossings % 2 == 1
+
+
+def pack_polygons(polygons):
+    """
+    Packs polygon rings into one edge list
+
+    Parameters
+    ----------
+    polygons: list of np.array of shape (k, 2)
+        Polygon vertices. Rings may be closed or open.
+
+    Returns
+    -------
+    (starts, ends, owner): edge endpoints as (m, 2) arrays, and the index of the
+    polygon each edge belongs to. Edges of a polygon are contiguous.
+    """
+    polygons = [np.asarray(p, dtype=np.float64).reshape(-1, 2) for p in polygons]
+    if not polygons:
+        return np.zeros((0, 2)), np.zeros((0, 2)), np.zeros(0, dtype=np.int64)
+    sizes = np.array([len(p) for p in polygons])
+    starts = np.concatenate(polygons)
+    owner = np.repeat(np.arange(len(polygons)), sizes)
+    # Each edge ends at the next vertex, and the last edge of a ring at its first
+    following = np.arange(1, len(starts) + 1)
+    last = np.cumsum(sizes) - 1
+    following[last[sizes > 0]] = (last - sizes + 1)[sizes > 0]
+    return starts, starts[following], owner
+
+
+def ray_polygon_distances(x, y, angles, max_dist, polygons):
+    """
+    Exact distances along rays from (x, y) to the closest point of every polygon,
+    with the same rays as ray_segment_distances. Rays that start inside a polygon
+    hit it at distance 0.
+
+    Parameters
+    ----------
+    angles: np.array of shape (n,)
+    polygons: list of np.array of shape (k, 2)
+
+    Returns
+    -------
+    np.array of shape (n, len(polygons)), inf where a ray misses a polygon
+    """
+    n = len(np.atleast_1d(angles))
+    out = np.full((n, len(polygons)), np.inf)
+    starts, ends, owner = pack_polygons(polygons)
+    if not len(owner):
+        return out
+    d = ray_segment_distances(x, y, angles, max_dist, starts, ends)
+    present, first = np.unique(owner, return_index=True)
+    out[:, present] = np.minimum.reduceat(d, first, axis=1)
+    out[:, point_in_polygons(x, y, starts, ends, owner, len(polygons))] = 0
+    return out
@@ -0,0 +1,217 @@
+import numpy as np
+from ortools.constraint_solver import pywrapcp
+
+
+def solve_components(tasks):
+    """
+    Solves the move/stop CSP for connected components of a ConflictGraph.
+    Building a solver is much more expensive than searching these small problems,
+    so all components share one solver model, and each is searched separately
+    over its own variables. This is a module level function so that it can be
+    sent to a process pool.
+
+    Parameters
+    ----------
+    tasks: list of tuple of (lower, blocked, pairs)
+        lower is the lowest value of each variable, blocked marks variables that
+        may not move and pairs lists (i, j) index pairs that may not both move.
+        Variables are branched on in index order.
+
+    Returns
+    -------
+    list of list of int, the value assigned to each variable of each task
+    """
+    if not tasks:
+        return []
+    solver = pywrapcp.Solver("FLUIDS Background CSP")
+    results = []
+    for t, (lower, blocked, pairs) in enumerate(tasks):
+        variables = [solver.IntVar(int(lo), 1, "%d_%d" % (t, i))
+                     for i, lo in enumerate(lower)]
+        for i, j in pairs:
+            solver.Add(variables[i] + variables[j] < 2)
+        for i, b in enumerate(blocked):
+            if b:
+                solver.Add((variables[i] == 1) == False)
+
+        # Try to assign max allowable velocity to every variable
+        #  (everything stop is a trivial solution)
+        db = solver.Phase(variables,
+                          solver.CHOOSE_FIRST_UNBOUND,
+                          solver.ASSIGN_MAX_VALUE)
+        solver.NewSearch(db)
+        solver.NextSolution()
+        results.append([v.Value() for v in variables])
+        solver.EndSearch()
+    return results
+
+
+class ConflictGraph(object):
+    """
+    Move/stop constraints between background agents for one planning step.
+
+    Each agent is a variable that is 1 if the agent moves and 0 if it stops.
+    Edges join agents that may not both move, and blocked agents may not move at all.
+    Agents only interact through edges, so every connected component of the graph
+    can be solved on its own.
+
+    Parameters
+    ----------
+    keys: list of int
+        Agent keys, in the order the solver should branch on them
+    lower: list of int
+        Lowest value of each agent's variable. Cars use -1 as a dummy value so
+        the CSP never becomes unsolvable.
+    """
+    def __init__(self, keys, lower):
+        self.keys    = list(keys)
+        self.index   = {k: i for i, k in enumerate(self.keys)}
+        self.lower   = list(lower)
+        self.blocked = [False] * len(self.keys)
+        self.edges   = []
+        self.stats   = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add_conflict(self, k1, k2):
+        """
+        Prevents k1 and k2 from both moving
+        """
+        self.edges.append((self.index[k1], self.index[k2]))
+
+    def block(self, k):
+        """
+        Prevents k from moving
+        """
+        self.blocked[self.index[k]] = True
+
+    def labels(self):
+        """
+        Returns the component label of every agent, which is the smallest
+        agent index in its component
+        """
+        parent = list(range(len(self.keys)))
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        for i, j in self.edges:
+            ri, rj = find(i), find(j)
+            if ri != rj:
+                parent[max(ri, rj)] = min(ri, rj)
+        return [find(i) for i in range(len(parent))]
+
+    def components(self):
+        """
+        Returns a list of index lists, one per connected component, each sorted
+        in branching order
+        """
+        groups = {}
+        for i, label in enumerate(self.labels()):
+            groups.setdefault(label, []).append(i)
+        return list(groups.values())
+
+    def solve(self, pool=None, pool_min_size=16):
+        """
+        Assigns a value to every agent by solving each connected component
+        independently. Agents without conflicts skip the solver, and stats is
+        updated with the component sizes.
+
+        Parameters
+        ----------
+        pool: object with a map_async method, optional
+            A multiprocessing.pool.ThreadPool or Pool. Components with at least
+            pool_min_size agents are solved on it.
+        pool_min_size: int
+            Smallest component to send to the pool
+
+        Returns
+        -------
+        dict of (key -> int)
+        """
+        comps = self.components()
+        comp_of = {}
+        for c, comp in enumerate(comps):
+            for i in comp:
+                comp_of[i] = c
+        comp_edges = [[] for comp in comps]
+        for i, j in self.edges:
+            comp_edges[comp_of[i]].append((i, j))
+
+        values = [0 if b else 1 for b in self.blocked]
+        local = {}
+        tasks, task_comps = [], []
+        for comp, edges in zip(comps, comp_edges):
+            if len(comp) == 1:
+                continue
+            for li, i in enumerate(comp):
+                local[i] = li
+            tasks.append(([self.lower[i] for i in comp],
+                          [self.blocked[i] for i in comp],
+                          [(local[i], local[j]) for i, j in edges]))
+            task_comps.append(comp)
+
+        # Large components go to the pool while the rest are solved here
+        pooled = [pool is not None and len(c) >= pool_min_size for c in task_comps]
+        async_result = None
+        if any(pooled):
+            async_result = pool.map_async(solve_components,
+                                          [[t] for t, p in zip(tasks, pooled) if p])
+        local_results = iter(solve_components([t for t, p in zip(tasks, pooled)
+                                               if not p]))
+        pool_results = iter(async_result.get() if async_result else [])
+        for comp, p in zip(task_comps, pooled):
+            result = next(pool_results)[0] if p else next(local_results)
+            for i, v in zip(comp, result):
+                values[i] = v
+
+        self.stats = {"components"       : len(comps),
+                      "largest_component": max([len(c) for c in comps] or [0]),
+                      "singletons"       : len(comps) - len(tasks),
+                      "solver_calls"     : len(tasks)}
+        return dict(zip(self.keys, values))
+
+    def solve_priority(self, priority):
+        """
+        Assigns a value to every agent without a solver. Agents are visited in
+        order of decreasing priority, ties broken by branching order, and move
+        unless they are blocked or a conflicting agent already moves.
+        With equal priorities this matches the CSP, which never has to backtrack.
+
+        The greedy order is resolved in rounds with NumPy: every undecided agent
+        that outranks all of its undecided neighbors moves, and its neighbors stop.
+
+        Parameters
+        ----------
+        priority: np.array of shape (n,)
+            Priority of every agent, in key order
+
+        Returns
+        -------
+        dict of (key -> int)
+        """
+        n = len(self.keys)
+        order = np.lexsort((np.arange(n), -np.asarray(priority, dtype=np.float64)))
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.arange(n)
+
+        edges = np.array(self.edges, dtype=np.int64).reshape(-1, 2)
+        values = np.zeros(n, dtype=np.int64)
+        undecided = ~np.array(self.blocked, dtype=bool)
+        rounds = 0
+        while undecided.any():
+            live = edges[undecided[edges[:, 0]] & undecided[edges[:, 1]]]
+            best_neighbor = np.full(n, n, dtype=np.int64)
+            np.minimum.at(best_neighbor, live[:, 0], rank[live[:, 1]])
+            np.minimum.at(best_neighbor, live[:, 1], rank[live[:, 0]])
+            moves = undecided & (rank < best_neighbor)
+            values[moves] = 1
+            undecided[moves] = False
+            undecided[live[moves[live[:, 0]], 1]] = False
+            undecided[live[moves[live[:, 1]], 0]] = False
+            rounds += 1
+
+        self.stats = {"priority_rounds": rounds}
+        return dict(zip(self.keys, values.tolist()))
@@ -0,0 +1,133 @@
+import numpy as np
+
+from fluids.utils.geometry import pack_polygons
+
+
+def fill_polygons(out, polygons):
+    """
+    Rasterizes polygons into a 2D array, without pygame.
+
+    Rows of out run along y and columns along x, and pixel (row, col) covers the
+    unit square with corner (col, row). A pixel is filled when its center lies
+    inside any of the polygons. Each polygon is filled with the even-odd rule.
+
+    Parameters
+    ----------
+    out: np.array of shape (H, W)
+        Array to fill. It is or-ed with the polygons, and may be a view into
+        one channel of an (H, W, C) array.
+    polygons: list of np.array of shape (n, 2)
+        Polygon vertices as (x, y). Rings may be closed or open.
+
+    Returns
+    -------
+    out
+    """
+    polygons = [np.asarray(p, dtype=np.float64).reshape(-1, 2) for p in polygons]
+    polygons = [p for p in polygons if len(p) > 2]
+    if not polygons:
+        return out
+    h, w = out.shape
+
+    # Every edge crosses the scanlines through the pixel centers in [y0, y1)
+    start, end, poly = pack_polygons(polygons)
+    ya, yb = start[:, 1], end[:, 1]
+    r0 = np.clip(np.ceil(np.minimum(ya, yb) - 0.5), 0, h).astype(np.int64)
+    r1 = np.clip(np.ceil(np.maximum(ya, yb) - 0.5), 0, h).astype(np.int64)
+    n_rows = r1 - r0
+    edges = np.flatnonzero(n_rows > 0)
+    if not len(edges):
+        return out
+    n_rows = n_rows[edges]
+    edge = np.repeat(edges, n_rows)
+    rows = np.repeat(r0[edges] - np.cumsum(n_rows) + n_rows, n_rows) + np.arange(len(edge))
+
+    # Crossings of each scanline, sorted within each polygon and row so that
+    #  consecutive pairs bound the filled spans
+    xa, xb = start[edge, 0], end[edge, 0]
+    ya, yb = ya[edge], yb[edge]
+    xs = xa + (rows + 0.5 - ya) * (xb - xa) / (yb - ya)
+    order = np.lexsort((xs, rows, poly[edge]))
+    xs, rows = xs[order], rows[order]
+    span_rows = rows[0::2]
+    c0 = np.clip(np.ceil(xs[0::2] - 0.5), 0, w).astype(np.int64)
+    c1 = np.clip(np.ceil(xs[1::2] - 0.5), 0, w).astype(np.int64)
+
+    # Mark span starts and ends, and sum along each row to get coverage
+    row_min, row_max = span_rows.min(), span_rows.max() + 1
+    n = row_max - row_min
+    span_rows = (span_rows - row_min) * (w + 1)
+    diff = np.bincount(span_rows + c0, minlength=n * (w + 1)) \
+        - np.bincount(span_rows + c1, minlength=n * (w + 1))
+    coverage = np.cumsum(diff.reshape(n, w + 1), axis=1)[:, :w]
+    out[row_min:row_max] |= coverage > 0
+    return out
+
+
+def fill_disk(out, x, y, radius):
+    """
+    Fills the pixels of a 2D array whose centers are within radius of (x, y).
+    radius may also be an (x radius, y radius) pair to fill an ellipse.
+    """
+    h, w = out.shape
+    rx, ry = radius if np.iterable(radius) else (radius, radius)
+    r0, r1 = max(int(np.floor(y - ry)), 0), min(int(np.ceil(y + ry)) + 1, h)
+    c0, c1 = max(int(np.floor(x - rx)), 0), min(int(np.ceil(x + rx)) + 1, w)
+    if r0 >= r1 or c0 >= c1:
+        return out
+    rows = np.arange(r0, r1)[:, None] + 0.5 - y
+    cols = np.arange(c0, c1)[None, :] + 0.5 - x
+    out[r0:r1, c0:c1] |= (rows * rx) ** 2 + (cols * ry) ** 2 <= (rx * ry) ** 2
+    return out
+
+
+def segment_polygon(x0, y0, x1, y1, width):
+    """
+    Returns the rectangle covering a line of the given width from (x0, y0) to
+    (x1, y1), as a (4, 2) array. Zero length segments give an empty rectangle.
+    """
+    dx, dy = x1 - x0, y1 - y0
+    length = np.hypot(dx, dy)
+    if length == 0:
+        return np.array([[x0, y0]] * 4, dtype=np.float64)
+    nx, ny = -dy / length * width / 2.0, dx / length * width / 2.0
+    return np.array([[x0 + nx, y0 + ny],
+                     [x1 + nx, y1 + ny],
+                     [x1 - nx, y1 - ny],
+                     [x0 - nx, y0 - ny]])
+
+
+def polygon_masks(polygons):
+    """
+    Rasterizes polygons one by one over their own bounding boxes, with a single
+    fill_polygons call for all of them. The patches are stacked in one canvas,
+    which is much faster than filling each polygon on its own.
+
+    Parameters
+    ----------
+    polygons: list of np.array of shape (n, 2)
+        Polygon vertices as (x, y), in the pixel convention of fill_polygons
+
+    Returns
+    -------
+    list of ((row, col), np.array of bool), the top left pixel and the mask of
+    every polygon's bounding box
+    """
+    polygons = [np.asarray(p, dtype=np.float64).reshape(-1, 2) for p in polygons]
+    if not polygons:
+        return []
+    sizes = [len(p) for p in polygons]
+    points = np.concatenate(polygons)
+    first = np.cumsum(sizes) - sizes
+    lo = np.floor(np.minimum.reduceat(points, first, axis=0)).astype(np.int64)
+    hi = np.ceil(np.maximum.reduceat(points, first, axis=0)).astype(np.int64) + 1
+    width, height = (hi - lo).T
+
+    # Every patch gets its own band of rows
+    band = np.cumsum(height) - height
+    shift = np.repeat(np.stack([-lo[:, 0], band - lo[:, 1]], axis=1), sizes, axis=0)
+    canvas = np.zeros((height.sum(), width.max()), dtype=bool)
+    points = points + shift
+    fill_polygons(canvas, np.split(points, np.cumsum(sizes)[:-1]))
+    return [((r, c), canvas[b:b + h, :w]) for (c, r), b, h, w in
+            zip(lo.tolist(), band.tolist(), height.tolist(), width.tolist())]
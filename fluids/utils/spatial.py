@@ -0,0 +1,332 @@
+import math
+import numpy as np
+
+from fluids.utils.geometry import pack_polygons, ray_hits, point_in_polygons
+
+
+# SegmentGrid.cast tests every ray against every nearby edge up to this many pairs
+BRUTE_FORCE_PAIRS = 20000
+
+
+class SpatialGrid(object):
+    """
+    Uniform grid over axis aligned bounding boxes.
+
+    Every key is bucketed into all the cells its bounding box touches, so a query
+    only has to look at keys that share a cell with the query box.
+
+    Parameters
+    ----------
+    cell_size: float
+        Side length of a grid cell. Should be on the order of the size of the
+        objects being stored.
+    """
+    def __init__(self, cell_size=100):
+        self.cell_size = float(cell_size)
+        self.cells     = {}
+        self.key_cells = {}
+        self.bounds    = {}
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def __contains__(self, key):
+        return key in self.bounds
+
+    def cell_range(self, bounds):
+        minx, miny, maxx, maxy = bounds
+        c = self.cell_size
+        return (int(math.floor(minx / c)), int(math.floor(miny / c)),
+                int(math.floor(maxx / c)), int(math.floor(maxy / c)))
+
+    def insert(self, key, bounds):
+        """
+        Adds key with bounding box (minx, miny, maxx, maxy) to the grid
+        """
+        if key in self.bounds:
+            self.remove(key)
+        cells = self.cell_range(bounds)
+        x0, y0, x1, y1 = cells
+        for i in range(x0, x1 + 1):
+            for j in range(y0, y1 + 1):
+                self.cells.setdefault((i, j), set()).add(key)
+        self.key_cells[key] = cells
+        self.bounds[key] = tuple(bounds)
+
+    def remove(self, key):
+        x0, y0, x1, y1 = self.key_cells.pop(key)
+        for i in range(x0, x1 + 1):
+            for j in range(y0, y1 + 1):
+                cell = self.cells[(i, j)]
+                cell.discard(key)
+                if not cell:
+                    del self.cells[(i, j)]
+        del self.bounds[key]
+
+    def update(self, key, bounds):
+        """
+        Moves key to a new bounding box. Cell membership is only rewritten
+        when the box crosses a cell boundary.
+        """
+        if key in self.key_cells and self.key_cells[key] == self.cell_range(bounds):
+            self.bounds[key] = tuple(bounds)
+            return
+        self.insert(key, bounds)
+
+    def update_many(self, keys, bounds):
+        """
+        update for every key in keys, with bounds an (n, 4) array. Cell ranges
+        are computed for all keys at once.
+        """
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        cells = np.floor(bounds / self.cell_size).astype(np.int64).tolist()
+        for key, box, key_cells in zip(keys, bounds.tolist(), cells):
+            if self.key_cells.get(key) == tuple(key_cells):
+                self.bounds[key] = tuple(box)
+            else:
+                self.insert(key, box)
+
+    def query(self, bounds):
+        """
+        Returns the set of keys whose bounding boxes overlap bounds
+        """
+        minx, miny, maxx, maxy = bounds
+        x0, y0, x1, y1 = self.cell_range(bounds)
+        candidates = set()
+        for i in range(x0, x1 + 1):
+            for j in range(y0, y1 + 1):
+                cell = self.cells.get((i, j))
+                if cell:
+                    candidates.update(cell)
+        found = set()
+        for key in candidates:
+            ominx, ominy, omaxx, omaxy = self.bounds[key]
+            if ominx <= maxx and omaxx >= minx and ominy <= maxy and omaxy >= miny:
+                found.add(key)
+        return found
+
+
+def bounds_overlap(bounds_a, bounds_b):
+    """
+    Tests every box in bounds_a against every box in bounds_b
+
+    Parameters
+    ----------
+    bounds_a: np.array of shape (n, 4)
+    bounds_b: np.array of shape (m, 4)
+        Rows of (minx, miny, maxx, maxy)
+
+    Returns
+    -------
+    np.array of bool with shape (n, m)
+    """
+    a = np.asarray(bounds_a, dtype=np.float64).reshape(-1, 4)[:, None, :]
+    b = np.asarray(bounds_b, dtype=np.float64).reshape(-1, 4)[None, :, :]
+    return (a[..., 0] <= b[..., 2]) & (a[..., 2] >= b[..., 0]) \
+        & (a[..., 1] <= b[..., 3]) & (a[..., 3] >= b[..., 1])
+
+
+def shape_bounds(obj, buf=0):
+    """
+    Returns the (minx, miny, maxx, maxy) bounding box of a Shape, grown by buf
+    """
+    return (obj.minx - buf, obj.miny - buf, obj.maxx + buf, obj.maxy + buf)
+
+
+class SegmentGrid(object):
+    """
+    Uniform grid over the edges of a fixed set of polygons, for casting rays.
+
+    Every edge is bucketed into all the cells its bounding box touches. Rays walk
+    the cells they pass through (DDA) in bands of doubling length, and stop after
+    the first band that holds a hit, so the cost of a ray depends on how far it
+    travels before hitting something rather than on its length. Cells are stored
+    CSR style: the edges of cell c are index[offsets[c]:offsets[c + 1]].
+
+    Parameters
+    ----------
+    polygons: list of np.array of shape (k, 2)
+        Polygon vertices
+    labels: list of int, optional
+        Label of every polygon, used to choose which polygons a ray can hit.
+        Defaults to the polygon indices.
+    cell_size: float
+        Side length of a grid cell
+    """
+    def __init__(self, polygons, labels=None, cell_size=50):
+        self.cell_size = float(cell_size)
+        self.starts, self.ends, self.owner = pack_polygons(polygons)
+        self.n_polygons = len(polygons)
+        self.labels = np.arange(self.n_polygons) if labels is None \
+            else np.asarray(labels, dtype=np.int64)
+        self.bounds = np.array([[p[:, 0].min(), p[:, 1].min(), p[:, 0].max(), p[:, 1].max()]
+                                for p in map(np.asarray, polygons)]).reshape(-1, 4)
+
+        points = np.concatenate([self.starts, self.ends]).reshape(-1, 2)
+        self.origin = points.min(axis=0) if len(points) else np.zeros(2)
+        extent = points.max(axis=0) - self.origin if len(points) else np.zeros(2)
+        self.nx, self.ny = (np.floor(extent / self.cell_size).astype(int) + 1).tolist()
+
+        lo = np.floor((np.minimum(self.starts, self.ends) - self.origin) / self.cell_size)
+        hi = np.floor((np.maximum(self.starts, self.ends) - self.origin) / self.cell_size)
+        cells, edges = [], []
+        for e, ((cx0, cy0), (cx1, cy1)) in enumerate(zip(lo.astype(int).tolist(),
+                                                           hi.astype(int).tolist())):
+            for cy in range(cy0, cy1 + 1):
+                for cx in range(cx0, cx1 + 1):
+                    cells.append(cy * self.nx + cx)
+                    edges.append(e)
+        cells = np.array(cells, dtype=np.int64)
+        order = np.argsort(cells, kind="stable")
+        self.index = np.array(edges, dtype=np.int64)[order]
+        self.offsets = np.concatenate([[0], np.cumsum(
+            np.bincount(cells, minlength=self.nx * self.ny))])
+
+    def cast(self, x, y, angles, max_dist, allowed):
+        """
+        Closest hit of rays from (x, y) with the polygons, using the rays of
+        ray_segment_distances. Rays that start inside a polygon hit it at 0.
+
+        Edges are tested against every ray at once when there are no more than
+        BRUTE_FORCE_PAIRS ray and edge pairs within max_dist of (x, y), which is
+        the faster way for short or few rays. Otherwise rays walk the grid.
+
+        Parameters
+        ----------
+        angles: np.array of shape (n,)
+        max_dist: float
+            Length of the rays
+        allowed: np.array of bool with shape (n_layers, n_labels)
+            Labels of the polygons each layer can hit
+
+        Returns
+        -------
+        np.array of shape (n, n_layers), inf where a ray hits nothing in a layer
+        """
+        angles = np.asarray(angles, dtype=np.float64).ravel()
+        allowed = np.asarray(allowed, dtype=bool)
+        allowed = allowed.reshape(-1, allowed.shape[-1])
+        n, n_layers = len(angles), len(allowed)
+        best = np.full((n, n_layers), np.inf)
+        if not len(self.owner):
+            return best
+        polygon_allowed = allowed[:, self.labels]
+
+        # Rays that start inside a polygon
+        candidates = np.flatnonzero((self.bounds[:, 0] <= x) & (self.bounds[:, 2] >= x)
+                                    & (self.bounds[:, 1] <= y) & (self.bounds[:, 3] >= y))
+        if len(candidates):
+            edges = np.flatnonzero(np.isin(self.owner, candidates))
+            inside = point_in_polygons(x, y, self.starts[edges], self.ends[edges],
+                                       self.owner[edges], self.n_polygons)
+            best[:, polygon_allowed[:, inside].any(axis=1)] = 0
+
+        near = polygon_allowed.any(axis=0) \
+            & (self.bounds[:, 0] <= x + max_dist) & (self.bounds[:, 2] >= x - max_dist) \
+            & (self.bounds[:, 1] <= y + max_dist) & (self.bounds[:, 3] >= y - max_dist)
+        edges = np.flatnonzero(near[self.owner])
+        if n * len(edges) <= BRUTE_FORCE_PAIRS:
+            angles = angles.reshape(-1, 1)
+            t = ray_hits(x, y, np.cos(angles), -np.sin(angles), max_dist,
+                         self.starts[edges, 0], self.starts[edges, 1],
+                         self.ends[edges, 0], self.ends[edges, 1])
+            edge_allowed = polygon_allowed[:, self.owner[edges]]
+            for l in range(n_layers):
+                hits = np.where(edge_allowed[l], t, np.inf).min(axis=1, initial=np.inf)
+                np.minimum(best[:, l], hits, out=best[:, l])
+            return best
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.walk(x, y, angles, max_dist, polygon_allowed, best)
+        return best
+
+    def walk(self, x, y, angles, max_dist, polygon_allowed, best):
+        """
+        Walks rays through the grid in bands of doubling length, lowering best
+        to the hits found. A ray stops after the first band that holds a hit in
+        every layer, or once it has left the grid.
+        """
+        n, n_layers = best.shape
+        edge_allowed = polygon_allowed[:, self.owner]
+        can_hit = edge_allowed.any(axis=1)
+
+        # The cells a ray enters within a band come in closed form from the
+        #  times it crosses vertical and horizontal cell boundaries, which are
+        #  evenly spaced
+        cs = self.cell_size
+        dx, dy = np.cos(angles), -np.sin(angles)
+        gx, gy = (x - self.origin[0]) / cs, (y - self.origin[1]) / cs
+        cx, cy = int(math.floor(gx)), int(math.floor(gy))
+        step_x = np.where(dx > 0, 1, -1)
+        step_y = np.where(dy > 0, 1, -1)
+        delta_x = np.where(dx != 0, cs / np.abs(dx), np.inf)
+        delta_y = np.where(dy != 0, cs / np.abs(dy), np.inf)
+        first_x = np.where(dx > 0, (cx + 1 - gx) * cs / dx, (cx - gx) * cs / dx)
+        first_y = np.where(dy > 0, (cy + 1 - gy) * cs / dy, (cy - gy) * cs / dy)
+        first_x[dx == 0] = np.inf
+        first_y[dy == 0] = np.inf
+        # Time each ray leaves the grid for good. Rays that miss it leave at once.
+        exit_x = np.where(dx > 0, (self.nx - gx) * cs / dx, -gx * cs / dx)
+        exit_y = np.where(dy > 0, (self.ny - gy) * cs / dy, -gy * cs / dy)
+        exit_x[dx == 0] = np.inf if 0 <= gx <= self.nx else -np.inf
+        exit_y[dy == 0] = np.inf if 0 <= gy <= self.ny else -np.inf
+        leave = np.minimum(exit_x, exit_y)
+
+        def crossings(t, first, delta, strict):
+            # Number of boundary crossings before t, or at t unless strict
+            if strict:
+                return np.where(t > first, np.ceil((t - first) / delta), 0).astype(np.int64)
+            return np.where(t >= first, np.floor((t - first) / delta) + 1, 0).astype(np.int64)
+
+        def events(rays, lo, hi):
+            # Index and ray of every crossing numbered in (lo, hi]
+            counts = hi - lo
+            ray = np.repeat(rays, counts)
+            index = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum()) + 1
+            return ray, index
+
+        rays = np.flatnonzero((leave >= 0) & ~(best == 0).all(axis=1))
+        t_lo, t_hi = 0.0, 2 * cs
+        while len(rays):
+            t_hi = min(t_hi, max_dist)
+            fx, fy, ddx, ddy = first_x[rays], first_y[rays], delta_x[rays], delta_y[rays]
+            # Entering a cell across a vertical boundary at the same time as a
+            #  horizontal one counts both, so a ray through a corner enters the
+            #  diagonal cell. A ray that starts on a boundary crosses it at 0,
+            #  within the first band.
+            ray_x, ix = events(rays, crossings(t_lo, fx, ddx, t_lo == 0),
+                               crossings(t_hi, fx, ddx, False))
+            tx = first_x[ray_x] + (ix - 1) * delta_x[ray_x]
+            iy_x = crossings(tx, first_y[ray_x], delta_y[ray_x], False)
+            ray_y, iy = events(rays, crossings(t_lo, fy, ddy, t_lo == 0),
+                               crossings(t_hi, fy, ddy, False))
+            ty = first_y[ray_y] + (iy - 1) * delta_y[ray_y]
+            ix_y = crossings(ty, first_x[ray_y], delta_x[ray_y], True)
+            zeros = [np.zeros(len(rays), dtype=np.int64)] if t_lo == 0 else []
+            visit_ray = np.concatenate([ray_x, ray_y] + ([rays] if t_lo == 0 else []))
+            visit_x = cx + np.concatenate([step_x[ray_x] * ix, step_x[ray_y] * ix_y] + zeros)
+            visit_y = cy + np.concatenate([step_y[ray_x] * iy_x, step_y[ray_y] * iy] + zeros)
+
+            in_grid = (visit_x >= 0) & (visit_x < self.nx) & (visit_y >= 0) & (visit_y < self.ny)
+            cell = (visit_y * self.nx + visit_x)[in_grid]
+            visit_ray = visit_ray[in_grid]
+            first = self.offsets[cell]
+            counts = self.offsets[cell + 1] - first
+            total = counts.sum()
+            if total:
+                pair_ray = np.repeat(visit_ray, counts)
+                pair_edge = self.index[np.repeat(first - np.cumsum(counts) + counts, counts)
+                                       + np.arange(total)]
+                t = ray_hits(x, y, dx[pair_ray], dy[pair_ray], max_dist,
+                             self.starts[pair_edge, 0], self.starts[pair_edge, 1],
+                             self.ends[pair_edge, 0], self.ends[pair_edge, 1])
+                for l in range(n_layers):
+                    hit = edge_allowed[l, pair_edge] & (t < np.inf)
+                    np.minimum.at(best[:, l], pair_ray[hit], t[hit])
+
+            # A hit within the band is closer than anything in later bands.
+            #  Layers that cannot hit any polygon never hold a ray back.
+            if t_hi >= max_dist:
+                break
+            done = ((best[rays] <= t_hi) | ~can_hit).all(axis=1) | (leave[rays] <= t_hi)
+            rays = rays[~done]
+            t_lo, t_hi = t_hi, 2 * t_hi
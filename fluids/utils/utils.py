@@ -1,5 +1,12 @@
+import hashlib
+import mmap
 import numpy as np
 import os
+import struct
+import tempfile
+import zipfile
+
+from fluids.utils.debug import fluids_assert
 
 def rotation_array(angle):
     cosa = np.cos(angle)
@@ -8,21 +15,121 @@ def rotation_array(angle):
                      [sina, cosa]])
 
 
-def lookup_cache(fname):
-    cache_folder = os.path.expanduser("~/.fluidscache/")
-    if not os.path.exists(cache_folder):
-        os.mkdir(cache_folder)
-    fname = os.path.join(cache_folder, fname)
-    if not os.path.exists(fname):
-        return False
-    return open(fname, "r")
+CACHE_FOLDER = None
+
+def set_cache_folder(folder):
+    """
+    Sets the folder where compiled layouts and static maps are cached. None
+    restores the default, which is $FLUIDS_CACHE_DIR, or ~/.fluidscache when that
+    is unset. Cache files are content addressed and written atomically, so many
+    processes may share one folder.
+    """
+    global CACHE_FOLDER
+    CACHE_FOLDER = folder
+
+def get_cache_folder():
+    folder = os.path.expanduser(CACHE_FOLDER or
+                                os.environ.get("FLUIDS_CACHE_DIR", "~/.fluidscache"))
+    try:
+        os.makedirs(folder)
+    except OSError:
+        if not os.path.isdir(folder):
+            raise
+    return folder
+
+def cache_key(*parts):
+    """
+    Returns a digest identifying parts, for naming cache files after their inputs.
+    Parts may be bytes, or anything with a stable str such as strings and numbers.
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = str(part).encode()
+        digest.update(hashlib.sha1(part).digest())
+    return digest.hexdigest()
 
 def get_cache_filename(fname):
-    cache_folder = os.path.expanduser("~/.fluidscache/")
-    if not os.path.exists(cache_folder):
-        os.mkdir(cache_folder)
-    fname = os.path.join(cache_folder, fname)
-    return fname
+    return os.path.join(get_cache_folder(), fname)
+
+def write_cache(fname, write):
+    """
+    Atomically creates or replaces a file in the cache. Readers see either the
+    old file or the complete new one, never a partial write.
+
+    Parameters
+    ----------
+    fname: str
+        Name of the file in the cache
+    write: function
+        Called with a binary file object to write the contents to
+    """
+    folder = get_cache_folder()
+    fd, tmp_name = tempfile.mkstemp(dir=folder, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as outfile:
+            write(outfile)
+        os.chmod(tmp_name, 0o644)
+        getattr(os, "replace", os.rename)(tmp_name, os.path.join(folder, fname))
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+
+def load_npz(fname):
+    """
+    Memory maps the arrays of an uncompressed npz file, as written by np.savez.
+    The arrays are read only, and processes loading the same file share its pages.
+    Compressed members can not be mapped, and are read with np.load instead.
+
+    Returns
+    -------
+    dict of (str -> np.array)
+    """
+    with open(fname, "rb") as infile:
+        fluids_assert(zipfile.is_zipfile(infile), "{} is not an npz file".format(fname))
+        buf = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        arrays = {}
+        compressed = []
+        for info in zipfile.ZipFile(infile).infolist():
+            fluids_assert(info.filename.endswith(".npy"),
+                          "{} holds {}, which is not an array".format(fname, info.filename))
+            name = info.filename[:-len(".npy")]
+            if info.compress_type != zipfile.ZIP_STORED:
+                compressed.append(name)
+                continue
+            # Member data follows its local header, whose name and extra field
+            #  lengths may differ from the central directory
+            name_len, extra_len = struct.unpack("<HH", buf[info.header_offset + 26:
+                                                           info.header_offset + 30])
+            infile.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(infile)
+            shape, fortran_order, dtype = getattr(
+                np.lib.format, "read_array_header_{}_{}".format(*version))(infile)
+            fluids_assert(not dtype.hasobject,
+                          "{} holds {}, which is an object array".format(fname, info.filename))
+            array = np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape)),
+                                  offset=infile.tell())
+            arrays[name] = array.reshape(shape, order="F" if fortran_order else "C")
+    if compressed:
+        with np.load(fname) as archive:
+            for name in compressed:
+                arrays[name] = archive[name]
+    return arrays
+
+def freeze(value):
+    """
+    Returns a hashable stand-in for value, for use in cache keys. Dicts, lists,
+    tuples, sets and arrays are frozen recursively into tuples.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((freeze(k), freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(freeze(v) for v in value)
+    if isinstance(value, np.ndarray):
+        return (value.shape, value.dtype.str, value.tobytes())
+    return value
 
 def distance(p0, p1):
     return np.linalg.norm([p0[0] - p1[0], p0[1] - p1[1]])
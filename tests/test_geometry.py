@@ -0,0 +1,149 @@
+import numpy as np
+import shapely.affinity
+import shapely.geometry
+from fluids.assets import Shape
+from fluids.utils import batch_boxes_intersect, fill_polygons, \
+    ray_polygon_distances, SegmentGrid, make_box, make_capsule, \
+    batch_rounded_boxes_intersect, rounded_box_sets_intersect, rounded_box_polygon
+from fluids.utils import spatial
+
+
+# Oriented box tests should agree with shapely on random rectangles
+np.random.seed(0)
+n = 2000
+shapes_a = [Shape(x=x, y=y, angle=a, xdim=w, ydim=h) for x, y, a, w, h in
+            zip(*[np.random.uniform(lo, hi, n) for lo, hi in
+                  [(0, 100), (0, 100), (0, 2 * np.pi), (1, 80), (1, 80)]])]
+shapes_b = [Shape(x=x, y=y, angle=a, xdim=w, ydim=h) for x, y, a, w, h in
+            zip(*[np.random.uniform(lo, hi, n) for lo, hi in
+                  [(0, 100), (0, 100), (0, 2 * np.pi), (1, 80), (1, 80)]])]
+
+expected = np.array([a.shapely_obj.intersects(b.shapely_obj) for a, b in zip(shapes_a, shapes_b)])
+scalar   = np.array([a.intersects(b) for a, b in zip(shapes_a, shapes_b)])
+batch    = batch_boxes_intersect(np.array([a.box for a in shapes_a]),
+                                 np.array([b.box for b in shapes_b]))
+assert(expected.any() and not expected.all())
+assert((scalar == expected).all())
+assert((batch == expected).all())
+
+# Broadcasting tests every pair
+boxes = np.array([a.box for a in shapes_a[:50]])
+pairs = batch_boxes_intersect(boxes[:, None], boxes[None, :])
+assert(pairs.shape == (50, 50) and pairs.diagonal().all())
+for i in range(50):
+    for j in range(50):
+        assert(pairs[i, j] == shapes_a[i].shapely_obj.intersects(shapes_a[j].shapely_obj))
+
+# Shapes without a box fall back to shapely
+poly = Shape(points=np.array([[0, 0], [50, 0], [25, 40]]))
+assert(poly.box is None)
+assert(poly.intersects(Shape(x=25, y=10, xdim=5, ydim=5)))
+assert(not poly.intersects(Shape(x=200, y=10, xdim=5, ydim=5)))
+
+# Rounded boxes intersect when shapely puts their boxes and segments within the
+#  sum of their radii, and sets of them when any two do
+rng = np.random.RandomState(1)
+def random_rounded_box():
+    if rng.rand() < 0.5:
+        x, y, a, w, h = rng.uniform(-50, 50, 5)
+        return make_box(x, y, a, abs(w), abs(h)) + (rng.choice([0, abs(h) / 3]),)
+    return make_capsule(*rng.uniform(-50, 50, 4), r=rng.uniform(0, 15))
+rounded_a = np.array([random_rounded_box() for _ in range(1000)])
+rounded_b = np.array([random_rounded_box() for _ in range(1000)])
+rounded = batch_rounded_boxes_intersect(rounded_a, rounded_b)
+assert(rounded.any() and not rounded.all())
+def box_core(box):
+    x, y, c, s, hx, hy = box[:6]
+    corners = [(x + sx * hx * c + sy * hy * s, y - sx * hx * s + sy * hy * c)
+               for sx, sy in [(1, 1), (1, -1), (-1, -1), (-1, 1)]]
+    if hy == 0:
+        return shapely.geometry.LineString(corners[1:3])
+    return shapely.geometry.Polygon(corners)
+for a, b, hit in zip(rounded_a, rounded_b, rounded):
+    distance = box_core(a).distance(box_core(b))
+    assert(hit == (distance <= a[8] + b[8]) or np.isclose(distance, a[8] + b[8]))
+    assert(hit == rounded_box_polygon(a).intersects(rounded_box_polygon(b))
+           or abs(distance - a[8] - b[8]) < 0.02 * (a[8] + b[8]))
+offsets = np.array([0, 3, 3, 10, 12])
+i, j = np.meshgrid(np.arange(4), np.arange(4))
+sets = rounded_box_sets_intersect(rounded_a, offsets, rounded_b, offsets, i.ravel(), j.ravel())
+for p, q, hit in zip(i.ravel(), j.ravel(), sets):
+    pieces = batch_rounded_boxes_intersect(
+        np.repeat(rounded_a[offsets[p]:offsets[p + 1]], offsets[q + 1] - offsets[q], axis=0),
+        np.tile(rounded_b[offsets[q]:offsets[q + 1]], (offsets[p + 1] - offsets[p], 1)))
+    assert(hit == pieces.any())
+
+# Moving a shape matches applying the same motion to its polygon with shapely
+shape = Shape(x=10, y=20, angle=0.3, xdim=40, ydim=20)
+expected = shapely.affinity.rotate(shapely.affinity.translate(shape.shapely_obj, 5, -7),
+                                   -(1.1 - 0.3), (15, 13), use_radians=True)
+shape.update_points(15, 13, 1.1)
+assert(shape.shapely_obj.symmetric_difference(expected).area < 1e-6)
+assert(np.allclose([shape.minx, shape.miny, shape.maxx, shape.maxy], expected.bounds))
+assert(shape.intersects(Shape(x=15, y=13, xdim=1, ydim=1)))
+
+# Rasterized polygons cover exactly the pixels whose centers shapely puts inside
+H, W = 60, 80
+ys, xs = np.mgrid[0:H, 0:W] + 0.5
+centers = [shapely.geometry.Point(x, y) for x, y in zip(xs.ravel(), ys.ravel())]
+for trial in range(20):
+    polygons = []
+    for _ in range(np.random.randint(1, 4)):
+        n = np.random.randint(3, 9)
+        angles = np.sort(np.random.uniform(0, 2 * np.pi, n))
+        radii = np.random.uniform(3, 40, n)
+        cx, cy = np.random.uniform(-20, 100, 2)
+        polygons.append(np.stack([cx + radii * np.cos(angles), cy + radii * np.sin(angles)], 1))
+    grid = np.zeros((H, W, 2), dtype=bool)
+    fill_polygons(grid[:, :, 1], polygons)
+    expected = np.array([any(shapely.geometry.Polygon(p).contains(c) for p in polygons)
+                         for c in centers]).reshape(H, W)
+    assert((grid[:, :, 1] == expected).all() and not grid[:, :, 0].any())
+
+# Ray hits are the exact distance from the ray origin to shapely's intersection,
+#  including rays that start inside a polygon
+for trial in range(20):
+    polygons = []
+    for _ in range(np.random.randint(1, 6)):
+        n = np.random.randint(3, 9)
+        angles = np.sort(np.random.uniform(0, 2 * np.pi, n))
+        radii = np.random.uniform(3, 40, n)
+        cx, cy = np.random.uniform(-50, 50, 2)
+        polygons.append(np.stack([cx + radii * np.cos(angles), cy + radii * np.sin(angles)], 1))
+    beams = np.linspace(-np.pi, np.pi, 37)
+    hits = ray_polygon_distances(0, 0, beams, 80, polygons)
+    origin = shapely.geometry.Point(0, 0)
+    for i, a in enumerate(beams):
+        ray = shapely.geometry.LineString([(0, 0), (80 * np.cos(a), -80 * np.sin(a))])
+        for j, p in enumerate(polygons):
+            isect = ray.intersection(shapely.geometry.Polygon(p))
+            expected = np.inf if isect.is_empty else origin.distance(isect)
+            assert(np.isclose(hits[i, j], expected) or hits[i, j] == expected)
+
+# Casting through a segment grid gives the closest hit of the allowed polygons,
+#  for rays that start inside, outside and beyond the edges of the grid, and on
+#  cell boundaries. Walking the grid and testing every edge agree.
+polygons, labels = [], []
+for _ in range(60):
+    n = np.random.randint(3, 9)
+    angles = np.sort(np.random.uniform(0, 2 * np.pi, n))
+    radii = np.random.uniform(3, 40, n)
+    cx, cy = np.random.uniform(-300, 300, 2)
+    polygons.append(np.stack([cx + radii * np.cos(angles), cy + radii * np.sin(angles)], 1))
+    labels.append(np.random.randint(3))
+segments = SegmentGrid(polygons, labels=labels, cell_size=37)
+allowed = np.array([[True, False, True], [False, True, False], [False, False, False]])
+beams = np.linspace(-np.pi, np.pi, 91)
+starts = np.random.uniform(-500, 500, (30, 2)).tolist() \
+    + [p[0] * 0.9 + p[1] * 0.1 for p in polygons[:5]] \
+    + (segments.origin + 37 * np.random.randint(0, 16, (5, 2))).tolist()
+brute_force_pairs = spatial.BRUTE_FORCE_PAIRS
+for spatial.BRUTE_FORCE_PAIRS in [-1, brute_force_pairs, np.inf]:
+    for x, y in starts:
+        for max_dist in [50, 300, 2000]:
+            hits = segments.cast(x, y, beams, max_dist, allowed)
+            brute = ray_polygon_distances(x, y, beams, max_dist, polygons)
+            for l in range(len(allowed)):
+                expected = np.where(allowed[l][labels], brute, np.inf).min(axis=1)
+                assert(np.array_equal(hits[:, l], expected))
+spatial.BRUTE_FORCE_PAIRS = brute_force_pairs
@@ -39,3 +39,98 @@ actions = {}
 rew = simulator.step(actions)
 obs = simulator.get_observations(car_keys)
 simulator.render()
+
+# Batched observations stack every car's array in key order
+car_keys = list(car_keys)
+arr = simulator.get_observation_array(car_keys)
+assert(arr.shape == (len(car_keys),) + obs[car_keys[0]].get_array().shape)
+for i, k in enumerate(car_keys):
+    assert((arr[i] == obs[k].get_array()).all())
+
+# The static map is drawn once per layout, and later states load it from the layout cache
+static_map = state.get_static_map()
+reloaded = fluids.State(layout=fluids.STATE_CITY).get_static_map()
+assert(reloaded is not static_map)
+for name in ("origin", "terrain", "street", "lanes"):
+    assert((getattr(reloaded, name) == getattr(static_map, name)).all())
+
+# Coverage grids average samples placed like the pixels of a full resolution grid
+from fluids.obs import GridObservation
+car = state.objects[car_keys[0]]
+full = GridObservation(car, obs_dim=200, shape=(200, 200)).get_array()
+coverage = GridObservation(car, obs_dim=200, shape=(20, 20), coverage=True,
+                           coverage_samples=10).get_array()
+assert(coverage.shape == (20, 20, 11))
+assert(np.allclose(coverage, full.reshape(20, 10, 20, 10, 11).mean(axis=(1, 3))))
+assert(GridObservation(car, obs_dim=200, shape=(20, 20)).get_array().shape == (20, 20, 11))
+
+# Compact grids hold the same occupancy, and packed grids unpack to it
+from fluids.obs import unpack_grid, grid_channel
+compact = GridObservation(car, obs_dim=200, shape=(50, 50), dtype=np.uint8).get_array()
+packed = GridObservation(car, obs_dim=200, shape=(50, 50), packed=True).get_array()
+full = GridObservation(car, obs_dim=200, shape=(50, 50)).get_array()
+assert(compact.dtype == np.uint8 and (compact == full).all())
+assert(packed.dtype == np.uint8 and packed.shape == (50, 50, 2))
+assert((unpack_grid(packed, 11) == full.astype(bool)).all())
+assert((unpack_grid(np.stack([packed, packed]), 11)[1] == full.astype(bool)).all())
+for c in range(11):
+    assert((grid_channel(packed, c) == full[:, :, c].astype(bool)).all())
+
+# Observations are made once per step and shared by every consumer
+again = simulator.get_observations(car_keys)
+assert(all(again[k] is obs[k] for k in car_keys))
+assert(state.get_observation(car_keys[0], fluids.OBS_GRID, shape=(50, 50)) is obs[car_keys[0]])
+assert(state.get_observation(car_keys[0], fluids.OBS_GRID, shape=(40, 40)) is not obs[car_keys[0]])
+simulator.step(actions)
+assert(simulator.get_observations(car_keys)[car_keys[0]] is not obs[car_keys[0]])
+
+# Shared grids crop dynamic objects from one world frame map per step. At one
+#  pixel per world unit they only differ from drawn grids along object edges,
+#  and leave out the observing car
+shared = GridObservation(car, obs_dim=200, shape=(200, 200), shared=True).get_array()
+drawn = GridObservation(car, obs_dim=200, shape=(200, 200)).get_array()
+assert(state.get_dynamic_map() is state.get_dynamic_map())
+assert((shared[:, :, :3] == drawn[:, :, :3]).all() and (shared[:, :, 8:] == drawn[:, :, 8:]).all())
+assert(np.abs(shared - drawn)[:, :, 3:8].sum() <= 0.1 * drawn[:, :, 3:8].sum())
+dynamic_map = state.get_dynamic_map()
+window = state.get_static_map().window(GridObservation(car, obs_dim=200, shape=(200, 200)).rel,
+                                       200, (200, 200))
+assert(dynamic_map.car_mask(dynamic_map.crop(window), window)[90:110, 157:177].all())
+assert(not shared[90:110, 157:177, 3].any())
+
+# A map drawn over the previous step's map matches one drawn from scratch
+from fluids.obs import DynamicMap
+simulator.step(actions)
+reused = state.get_dynamic_map()
+assert(reused.pixels.dtype == np.uint8)
+assert((reused.pixels == DynamicMap(state).pixels).all())
+
+# Selected channels match the same channels of a full grid, in the order asked for
+from fluids.obs.grid import GRID_CARS, GRID_TERRAIN, GRID_DIRECTION_EDGE, GRID_DIRECTION_PIXEL
+for channels in [[GRID_CARS], [GRID_DIRECTION_EDGE, GRID_TERRAIN], [GRID_DIRECTION_PIXEL],
+                 list(range(11))[::-1]]:
+    for kwargs in [{}, {"shared": True}, {"coverage": True}]:
+        full = GridObservation(car, obs_dim=200, shape=(50, 50), **kwargs).get_array()
+        some = GridObservation(car, obs_dim=200, shape=(50, 50), channels=channels,
+                               **kwargs).get_array()
+        assert((some == full[:, :, channels]).all())
+
+# Packed grids of selected channels unpack to those channels, in order
+channels = [GRID_DIRECTION_EDGE, GRID_TERRAIN, GRID_CARS]
+full = GridObservation(car, obs_dim=200, shape=(50, 50)).get_array().astype(bool)
+packed = GridObservation(car, obs_dim=200, shape=(50, 50), channels=channels,
+                         packed=True).get_array()
+assert(packed.shape == (50, 50, 1))
+assert((unpack_grid(packed, len(channels)) == full[:, :, channels]).all())
+for i, c in enumerate(channels):
+    assert((grid_channel(packed, i) == full[:, :, c]).all())
+
+# Bird's eye images are uint8 and can be rendered into a given buffer. Each
+#  one is drawn on its own surface, so images of different cars never mix
+from fluids.obs import BirdsEyeObservation
+batch = np.zeros((2, 200, 200, 3), dtype=np.uint8)
+cars = [state.objects[k] for k in car_keys] + list(state.background_cars.values())[:1]
+images = [BirdsEyeObservation(c, obs_dim=200, out=batch[i]) for i, c in enumerate(cars[:2])]
+assert(np.shares_memory(images[0].get_array(), batch[0]))
+assert((BirdsEyeObservation(cars[0], obs_dim=200).get_array() == batch[0]).all())
+assert(batch[0].any() and not (batch[0] == batch[1]).all())
@@ -0,0 +1,77 @@
+import fluids
+import numpy as np
+import random
+from scipy.integrate import odeint
+from fluids.assets import Car, Shape, DynamicStore
+from fluids.assets.car import integrator, batch_integrator
+from fluids.utils import shape_bounds
+
+
+# The batched integrator should match odeint on random car states
+np.random.seed(0)
+n = 200
+x     = np.random.uniform(0, 2000, n)
+y     = np.random.uniform(0, 2000, n)
+vel   = np.random.uniform(-5, 5, n)
+angle = np.random.uniform(0, 2 * np.pi, n)
+steer = np.radians(30 * np.random.uniform(-1, 1, n))
+acc   = np.random.uniform(-0.25, 0.25, n)
+lr = lf = np.full(n, 17.5)
+
+bx, by, bvel, bangle = batch_integrator(x, y, vel, angle, steer, acc, lr, lf, t=1.0)
+for i in range(n):
+    expected = odeint(integrator, [x[i], y[i], vel[i], angle[i]], [0.0, 0.5, 1.0],
+                      args=(steer[i], acc[i], lr[i], lf[i]))[-1]
+    assert(np.allclose([bx[i], by[i], bvel[i], bangle[i]], expected, atol=1e-5))
+
+
+# Both integrators should produce the same rollout
+def rollout(integrator_type):
+    np.random.seed(3)
+    random.seed(3)
+    simulator = fluids.FluidSim(visualization_level=0,
+                                fps=0,
+                                background_control=fluids.BACKGROUND_CSP,
+                                integrator=integrator_type)
+    state = fluids.State(layout=fluids.STATE_CITY,
+                         background_cars=10,
+                         controlled_cars=1,
+                         vis_level=0)
+    simulator.set_state(state)
+    car_keys = simulator.get_control_keys()
+    for i in range(20):
+        simulator.step({k: fluids.VelocityAction(1) for k in car_keys})
+    return state
+
+ode_state   = rollout(fluids.INTEGRATOR_ODEINT)
+batch_state = rollout(fluids.INTEGRATOR_BATCH)
+ode_poses, batch_poses = [np.array([(car.x, car.y, car.angle)
+                                    for car in state.type_map[Car].values()])
+                          for state in (ode_state, batch_state)]
+assert(np.allclose(ode_poses, batch_poses, atol=1e-3))
+
+# After batched steps, the store, the cars and the dynamic index should agree
+for state in (ode_state, batch_state):
+    store = state.dynamic_store
+    for i, (k, obj) in enumerate(zip(store.keys, store.objects)):
+        assert(np.allclose(store.pose[i], (obj.x, obj.y, obj.angle, obj.vel)))
+        assert(np.shares_memory(obj.points, store.points))
+        expected = Shape(x=obj.x, y=obj.y, xdim=obj.xdim, ydim=obj.ydim, angle=obj.angle)
+        assert(np.allclose(obj.points, expected.points))
+        assert(np.allclose(obj.box, expected.box))
+        assert(np.allclose(store.bounds()[i], shape_bounds(expected)))
+        assert(np.allclose(state.dynamic_index.bounds[k], shape_bounds(expected)))
+
+# Stored objects should keep viewing the store's rows as it grows
+store = DynamicStore(capacity=1)
+cars = [Car(x=100 * i, y=50, angle=0.3 * i) for i in range(3)]
+for i, car in enumerate(cars):
+    store.add(i, car)
+rows = store.indices(cars)
+store.move(rows, np.array([10., 20., 30.]), np.array([5., 6., 7.]),
+           np.array([0., 1., 7.]), np.array([1., 2., 3.]))
+for car in cars:
+    assert(np.shares_memory(car.points, store.points))
+    expected = Shape(x=car.x, y=car.y, xdim=car.xdim, ydim=car.ydim, angle=car.angle)
+    assert(np.allclose(car.points, expected.points))
+assert(np.allclose(store.bounds(), [shape_bounds(car) for car in cars]))
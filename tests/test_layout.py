@@ -0,0 +1,135 @@
+import fluids
+import os
+import tempfile
+import numpy as np
+from fluids.layout import CompiledLayout
+
+
+# States loaded from a compiled layout file should match states built from json
+layout_file = os.path.join(os.path.dirname(fluids.__file__), "layouts",
+                           fluids.STATE_CITY + ".json")
+with open(layout_file, "rb") as f:
+    compiled = CompiledLayout.compile(f.read())
+fname = os.path.join(tempfile.mkdtemp(), "city.npz")
+compiled.save(fname)
+
+state = fluids.State(layout=fluids.STATE_CITY, vis_level=0)
+loaded = fluids.State(layout=fname, vis_level=0)
+
+
+def graph(state):
+    waypoints = state.waypoints + state.ped_waypoints
+    g = state.waypoint_graph
+    return [(wp.x, wp.y, wp.angle, wp.ydim, wp.box, type(wp.owner).__name__,
+             wp.points.tolist(), wp.radius,
+             [(g.targets[e], g.sources[e] == i)
+              for e in range(g.offsets[i], g.offsets[i + 1])])
+            for i, wp in enumerate(waypoints)]
+
+assert(len(state.waypoints) == len(loaded.waypoints))
+assert(len(state.ped_waypoints) == len(loaded.ped_waypoints))
+assert(graph(state) == graph(loaded))
+for obj, other in zip(state.static_objects.values(), loaded.static_objects.values()):
+    assert(type(obj) == type(other))
+    assert(np.array_equal(obj.points, other.points))
+    assert([wp.index for wp in obj.waypoints] == [wp.index for wp in other.waypoints])
+for lane, other in zip(state.type_map[fluids.assets.Lane].values(),
+                       loaded.type_map[fluids.assets.Lane].values()):
+    assert(lane.start_waypoint.index == other.start_waypoint.index)
+    assert(lane.end_waypoint.index == other.end_waypoint.index)
+
+
+# Layouts and static maps are cached under content addressed names, and load
+#  memory mapped and read only
+from fluids.utils import set_cache_folder, get_cache_folder
+set_cache_folder(tempfile.mkdtemp())
+state = fluids.State(layout=fluids.STATE_CITY, vis_level=0)
+state.get_static_map()
+names = sorted(os.listdir(get_cache_folder()))
+assert(len(names) == 2)
+assert(names[0].startswith("layout_") and names[1].startswith("static_map_"))
+state = fluids.State(layout=fluids.STATE_CITY, vis_level=0)
+static_map = state.get_static_map()
+assert(sorted(os.listdir(get_cache_folder())) == names)
+assert(not static_map.terrain.flags.writeable)
+assert(not state.waypoints[0].points.flags.writeable)
+assert(graph(state) == graph(loaded))
+state = fluids.State(layout=fluids.STATE_CITY, waypoint_width=10, vis_level=0)
+assert(len(os.listdir(get_cache_folder())) == 3)
+set_cache_folder(None)
+
+# Compressed npz members are read instead of mapped
+from fluids.utils import load_npz
+fname = os.path.join(tempfile.mkdtemp(), "compressed.npz")
+arrays = {"a": np.arange(10.0).reshape(2, 5), "b": np.array([1, 2, 3], dtype=np.uint8)}
+np.savez_compressed(fname, **arrays)
+loaded = load_npz(fname)
+assert(sorted(loaded) == ["a", "b"])
+assert(all(np.array_equal(loaded[k], arrays[k]) and loaded[k].dtype == arrays[k].dtype
+           for k in arrays))
+
+
+# Batched path planning should match evaluating the Bezier curve one t at a time
+from fluids.assets.waypoint import plan_paths
+
+def scalar_plan(x0, y0, a0, x1, y1, a1, smooth_level):
+    d = np.sqrt((x0-x1)**2+(y0-y1)**2)
+    p = [(x0, y0), (x0 + .3*d*np.cos(a0), y0 - .3*d*np.sin(a0)),
+         (x1 - .3*d*np.cos(a1), y1 + .3*d*np.sin(a1)), (x1, y1)]
+    path = [p[0]]
+    for t in np.arange(0, 1, .001):
+        point = [p[0][i]*1.0*((1-t)**3) + p[1][i]*3.0*t*(1-t)**2
+                 + p[2][i]*3.0*(t**2)*(1-t) + p[3][i]*1.0*(t**3) for i in range(2)]
+        if (point[0] - path[-1][0])**2 + (point[1] - path[-1][1])**2 > smooth_level:
+            path.append(point)
+    return path + [(x1, y1)]
+
+np.random.seed(0)
+poses = np.random.uniform(0, 1000, (6, 100))
+poses[[2, 5]] = np.random.uniform(0, 2 * np.pi, (2, 100))
+for i, (path, angles) in enumerate(plan_paths(*poses, smooth_level=2000)):
+    expected = scalar_plan(*poses[:, i], smooth_level=2000)
+    assert(np.array_equal(np.array(path), np.array(expected)))
+    assert(len(angles) == len(path))
+
+
+# The waypoint graph should describe the same waypoints and links as the
+#  layout, and draw routes from random like random.choice over the links
+import json
+import random
+from fluids.layout import generate_waypoints
+with open(layout_file, "rb") as f:
+    generated = generate_waypoints(json.loads(f.read()), 5)
+links = [wp["nxt"] for key in ["waypoints", "ped_waypoints"] for wp in generated[key]]
+graph = state.waypoint_graph
+waypoints = state.waypoints + state.ped_waypoints
+assert(graph.n_waypoints == len(state.waypoints))
+for i, wp in enumerate(waypoints):
+    assert(wp.index == i)
+    assert(graph.successors(i).tolist() == links[i])
+    for e, j in zip(range(graph.offsets[i], graph.offsets[i + 1]), links[i]):
+        assert(graph.segment(e) == ((wp.x, wp.y), (waypoints[j].x, waypoints[j].y)))
+    assert(np.array_equal(graph.rings[i], np.array(wp.shapely_obj.exterior.coords)[:, :2]))
+for seed in range(20):
+    random.seed(seed)
+    route = [random.randrange(len(waypoints))]
+    edges = graph.extend(route, 10)
+    random.seed(seed)
+    expected = [random.randrange(len(waypoints))]
+    while len(expected) < 10 and len(links[expected[-1]]):
+        expected.append(random.choice(links[expected[-1]]))
+    assert(route == expected)
+    assert(graph.targets[edges].tolist() == route[1:])
+
+# Cars and pedestrians read their waypoints from their route, and cannot set them
+driving = fluids.State(layout=fluids.STATE_CITY, background_cars=3, background_peds=3,
+                       vis_level=0)
+for agent in list(driving.type_map[fluids.assets.Car].values()) \
+        + list(driving.type_map[fluids.assets.Pedestrian].values()):
+    agent.route = [0, 1]
+    assert(agent.waypoints == [driving.waypoint_graph.waypoints[i] for i in [0, 1]])
+    try:
+        agent.waypoints = []
+        assert(False)
+    except AttributeError:
+        pass
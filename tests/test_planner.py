@@ -0,0 +1,64 @@
+import numpy as np
+from ortools.constraint_solver import pywrapcp
+from multiprocessing.pool import ThreadPool
+from fluids.utils import ConflictGraph
+
+
+def solve_single_csp(graph):
+    # Reference: one CSP over every agent, as the background planner used to build
+    solver = pywrapcp.Solver("reference")
+    variables = [solver.IntVar(lo, 1, str(i)) for i, lo in enumerate(graph.lower)]
+    for i, j in graph.edges:
+        solver.Add(variables[i] + variables[j] < 2)
+    for i, b in enumerate(graph.blocked):
+        if b:
+            solver.Add((variables[i] == 1) == False)
+    db = solver.Phase(variables, solver.CHOOSE_FIRST_UNBOUND, solver.ASSIGN_MAX_VALUE)
+    solver.NewSearch(db)
+    solver.NextSolution()
+    return {k: v.Value() for k, v in zip(graph.keys, variables)}
+
+
+def greedy_reference(graph, priority):
+    # Reference for the priority planner: visit agents one at a time
+    order = sorted(range(len(graph)), key=lambda i: (-priority[i], i))
+    values = [0] * len(graph)
+    for i in order:
+        neighbors = [b if a == i else a for a, b in graph.edges if i in (a, b)]
+        if not graph.blocked[i] and not any(values[j] for j in neighbors):
+            values[i] = 1
+    return dict(zip(graph.keys, values))
+
+
+def random_graph(rng, n):
+    keys = rng.permutation(1000)[:n].tolist()
+    graph = ConflictGraph(keys, rng.choice([-1, 0], n).tolist())
+    for _ in range(rng.randint(0, n)):
+        i, j = rng.choice(n, 2, replace=False)
+        graph.add_conflict(keys[i], keys[j])
+    for i in rng.choice(n, rng.randint(0, n // 4 + 1), replace=False):
+        graph.block(keys[i])
+    return graph
+
+
+# Solving components independently should give the same plan as one big CSP
+rng = np.random.RandomState(0)
+pool = ThreadPool(2)
+for trial in range(50):
+    graph = random_graph(rng, rng.randint(1, 60))
+    expected = solve_single_csp(graph)
+    assert(graph.solve() == expected)
+    assert(graph.solve(pool=pool, pool_min_size=3) == expected)
+    assert(sorted(i for c in graph.components() for i in c) == list(range(len(graph))))
+    assert(graph.stats["largest_component"] == max(len(c) for c in graph.components()))
+    assert(graph.stats["components"] == graph.stats["singletons"] + graph.stats["solver_calls"])
+pool.close()
+
+
+# The priority planner should match the CSP when priorities are equal,
+#  and visit agents in priority order otherwise
+for trial in range(50):
+    graph = random_graph(rng, rng.randint(1, 60))
+    assert(graph.solve_priority(np.zeros(len(graph))) == graph.solve())
+    priority = rng.randint(0, 5, len(graph))
+    assert(graph.solve_priority(priority) == greedy_reference(graph, priority))
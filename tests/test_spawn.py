@@ -0,0 +1,46 @@
+import random
+import numpy as np
+import fluids
+from fluids.assets import Car, Pedestrian
+
+
+# Spawned cars and pedestrians should start clear of everything that could hit
+#  them, even on a nearly full layout
+np.random.seed(0)
+random.seed(0)
+state = fluids.State(layout=fluids.STATE_CITY, background_cars=70,
+                     background_peds=200, vis_level=0)
+cars = list(state.type_map[Car].values())
+peds = list(state.type_map[Pedestrian].values())
+assert(len(cars) == 70 and len(peds) == 200)
+for car in cars:
+    assert(not state.is_in_collision(car))
+    assert(len(car.route) == 1)
+    for other in cars:
+        if other is not car:
+            assert(car.dist_to(other) >= 10)
+for ped in peds:
+    assert(not any(car.intersects(ped) for car in cars))
+    assert(state.waypoint_graph.n_waypoints <= ped.route[0])
+
+# Distances to collision match a search over every object, and are only 0 for
+#  cars in collision
+for car in cars[:20]:
+    expected = min(car.dist_to(o) for o in state.objects.values() if car.can_collide(o))
+    assert(np.isclose(state.min_distance_to_collision(car), expected))
+    assert((expected == 0) == state.is_in_collision(car))
+
+
+# Cars head for the waypoint after the first one they are clear of, found
+#  through the waypoints they stand on
+graph = state.waypoint_graph
+for car in cars:
+    standing = [wp.index for wp in state.waypoints if car.intersects(wp)]
+    clear = [j for i in standing for j in graph.successors(i).tolist()
+             if not car.intersects(graph.waypoints[j])]
+    assert(any(car.route[0] in graph.successors(j).tolist() for j in clear))
+
+# A car moved onto another is in collision, at distance 0
+cars[1].update_points(cars[0].x + 10, cars[0].y, cars[0].angle)
+state.update_dynamic_index()
+assert(state.is_in_collision(cars[1]) and state.min_distance_to_collision(cars[1]) == 0)